@@ -0,0 +1,136 @@
+"""Inverted-file (IVF) approximate nearest-neighbour index.
+
+Embeddings are bucketed by their nearest of ``nlist`` k-means centroids. A
+query scores the centroids, then scans only the ``nprobe`` closest buckets,
+so it touches roughly ``nprobe / nlist`` of the gallery instead of all of it.
+Everything is plain numpy; the only state worth persisting is the centroid
+matrix, because re-bucketing the gallery on load is one matrix product.
+"""
+import os
+
+import numpy as np
+
+from gallery import normalize, normalize_rows
+
+
+def train_centroids(vectors, nlist, iterations=10, sample=50000, seed=0):
+    unit = normalize_rows(vectors)
+    rng = np.random.default_rng(seed)
+    if len(unit) > sample:
+        unit = unit[rng.choice(len(unit), sample, replace=False)]
+    nlist = max(1, min(nlist, len(unit)))
+    centroids = unit[rng.choice(len(unit), nlist, replace=False)].copy()
+    for _ in range(iterations):
+        assign = np.argmax(unit @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, unit)
+        counts = np.bincount(assign, minlength=nlist)
+        empty = counts == 0
+        # Re-seed empty buckets with random points so no centroid is wasted.
+        sums[empty] = unit[rng.choice(len(unit), int(empty.sum()))]
+        centroids = normalize_rows(sums)
+    return centroids
+
+
+class _Bucket:
+    __slots__ = ("matrix", "labels")
+
+    def __init__(self, dim):
+        self.matrix = np.zeros((16, dim), dtype=np.float32)
+        self.labels = []
+
+    def append(self, label, vec):
+        n = len(self.labels)
+        if n == self.matrix.shape[0]:
+            grown = np.zeros((n * 2, self.matrix.shape[1]), dtype=np.float32)
+            grown[:n] = self.matrix
+            self.matrix = grown
+        self.matrix[n] = vec
+        self.labels.append(label)
+
+    def remove(self, label):
+        keep = [i for i, lab in enumerate(self.labels) if lab != label]
+        self.matrix[:len(keep)] = self.matrix[keep]
+        self.labels = [self.labels[i] for i in keep]
+
+
+class IVFIndex:
+    def __init__(self, centroids, nprobe=8):
+        self.centroids = np.ascontiguousarray(centroids, dtype=np.float32)
+        self.nprobe = nprobe
+        self.dim = self.centroids.shape[1]
+        self._buckets = [_Bucket(self.dim) for _ in range(len(self.centroids))]
+        self._where = {}  # label -> set of bucket ids
+        self.size = 0
+        self.trained_on = 0
+
+    @classmethod
+    def train(cls, vectors, nlist=None, nprobe=8):
+        nlist = nlist or max(1, int(np.sqrt(len(vectors))))
+        index = cls(train_centroids(vectors, nlist), nprobe=nprobe)
+        index.trained_on = len(vectors)
+        return index
+
+    # ---- persistence ---------------------------------------------------
+    def save(self, path):
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            np.save(f, self.centroids)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path, nprobe=8):
+        return cls(np.load(path), nprobe=nprobe)
+
+    # ---- mutation ------------------------------------------------------
+    def __len__(self):
+        return self.size
+
+    def add(self, label, vecs):
+        """Insert label's rows, replacing any it already had."""
+        self.remove(label)
+        unit = normalize_rows(vecs)
+        assign = np.argmax(unit @ self.centroids.T, axis=1)
+        where = self._where.setdefault(label, set())
+        for vec, b in zip(unit, assign):
+            self._buckets[b].append(label, vec)
+            where.add(int(b))
+        self.size += len(unit)
+
+    def add_many(self, embeddings):
+        for label, vecs in embeddings.items():
+            self.add(label, vecs)
+
+    def remove(self, label):
+        where = self._where.pop(label, None)
+        if not where:
+            return False
+        for b in where:
+            before = len(self._buckets[b].labels)
+            self._buckets[b].remove(label)
+            self.size -= before - len(self._buckets[b].labels)
+        return True
+
+    # ---- query ---------------------------------------------------------
+    def search(self, probe, k=10, nprobe=None):
+        """Approximate k nearest rows as (label, cosine distance), nearest first."""
+        p = normalize(probe)
+        nprobe = min(nprobe or self.nprobe, len(self.centroids))
+        scores = self.centroids @ p
+        probe_ids = np.argpartition(-scores, nprobe - 1)[:nprobe] if nprobe < len(scores) else range(len(scores))
+        dists, labels = [], []
+        for b in probe_ids:
+            bucket = self._buckets[b]
+            n = len(bucket.labels)
+            if n:
+                dists.append(1.0 - bucket.matrix[:n] @ p)
+                labels.extend(bucket.labels)
+        if not labels:
+            return []
+        dists = np.concatenate(dists)
+        k = min(k, len(dists))
+        idx = np.argpartition(dists, k - 1)[:k] if k < len(dists) else np.arange(len(dists))
+        idx = idx[np.argsort(dists[idx])]
+        return [(labels[i], float(dists[i])) for i in idx]
@@ -1,21 +1,47 @@
 import os
+import sys
+import atexit
+import threading
+import multiprocessing
 import time
 import secrets
 import cv2
-import smtplib
-import base64
 import numpy as np
 import json
 import string
+import zlib
+from datetime import datetime
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.mime.base import MIMEBase
 from email.mime.image import MIMEImage
 from email import encoders
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, Response, render_template, request, jsonify, send_from_directory, stream_with_context
 import requests
 from dotenv import load_dotenv
-from deepface import DeepFace
+
+# Sibling modules live next to this file; make them importable both for
+# `python app.py` and for `gunicorn backend.app:app`.
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from face_engine import CascadeDetector, FaceEngine
+from inference_server import InferenceError, RemoteFaceEngine, server_config
+from face_stream import StreamUnlock
+from batcher import MicroBatcher
+from gallery import FaceGallery, reduce_embeddings
+from ann_index import IVFIndex
+from embedding_store import EmbeddingStore
+from mailer import MailDispatcher
+from camera import CaptureService
+from device_client import DeviceClient
+from fleet import DeviceFleet, UnknownDoor, load_doors
+from state_backend import Namespace, make_backend
+from rate_limit import AlertRollup, AuthLimiter
+from event_log import EventLog
+from evidence import EvidenceStore
+from enroll import drop_outliers, embed_image, run_enrollment
+from file_lock import try_lock
+from image_io import ImageError, ImageTooLarge, decode_image, request_images
+from metrics import Registry, SamplingProfiler
 
 # Load env variables
 load_dotenv()
@@ -28,6 +54,10 @@ SMTP_PORT = int(os.getenv("SMTP_PORT", "465"))
 EMAIL_USER = os.getenv("EMAIL_USER")
 EMAIL_PASS = os.getenv("EMAIL_PASS")
 REGISTERED_EMAIL = os.getenv("REGISTERED_EMAIL", EMAIL_USER)
+SMTP_SECURITY = os.getenv("SMTP_SECURITY", "ssl" if SMTP_PORT == 465 else "starttls")  # ssl | starttls | none
+MAIL_WORKERS = int(os.getenv("MAIL_WORKERS", "1"))
+MAIL_QUEUE_SIZE = int(os.getenv("MAIL_QUEUE_SIZE", "100"))
+MAIL_MAX_RETRIES = int(os.getenv("MAIL_MAX_RETRIES", "3"))
 
 AUTH_PASSWORD = os.getenv("AUTH_PASSWORD", "mani")
 AUTH_PIN = os.getenv("AUTH_PIN", "1234")
@@ -40,87 +70,322 @@ DEVICE_API_KEY = os.getenv("DEVICE_API_KEY", "manishankar")
 OTP_TTL = int(os.getenv("OTP_TTL", "180"))
 SESSION_TTL = int(os.getenv("SESSION_TTL", "3600"))
 QR_SESSION_TTL = int(os.getenv("QR_SESSION_TTL", "180"))
+QR_APPROVAL_TTL = int(os.getenv("QR_APPROVAL_TTL", "900"))  # approve/deny links and status polling
+TOKEN_STORE_MAX = int(os.getenv("TOKEN_STORE_MAX", "10000"))
+AUTH_IP_RATE = float(os.getenv("AUTH_IP_RATE", "1.0"))  # attempts/s per client IP, all methods
+AUTH_IP_BURST = int(os.getenv("AUTH_IP_BURST", "20"))
+AUTH_METHOD_RATE = float(os.getenv("AUTH_METHOD_RATE", "0.2"))  # attempts/s per client IP and method
+AUTH_METHOD_BURST = int(os.getenv("AUTH_METHOD_BURST", "5"))
+AUTH_MAX_FAILURES = int(os.getenv("AUTH_MAX_FAILURES", "5"))  # consecutive failures before a lockout
+AUTH_LOCKOUT = float(os.getenv("AUTH_LOCKOUT", "30"))  # seconds; doubles on every further lockout
+AUTH_LOCKOUT_MAX = float(os.getenv("AUTH_LOCKOUT_MAX", "3600"))
+ALERT_WINDOW = float(os.getenv("ALERT_WINDOW", "300"))  # failures after the first are sent as one digest
+
+EVENT_LOG_DIR = os.getenv("EVENT_LOG_DIR", "events")
+EVENT_SEGMENT_BYTES = int(os.getenv("EVENT_SEGMENT_BYTES", str(8 * 1024 * 1024)))
+EVENT_RETENTION_DAYS = float(os.getenv("EVENT_RETENTION_DAYS", "365"))  # 0 keeps everything
+
+# memory (single worker only) | sqlite (shared by local workers) | redis
+STATE_BACKEND = os.getenv("STATE_BACKEND", "sqlite")
+STATE_DB_PATH = os.getenv("STATE_DB_PATH", "state.db")
+STATE_REDIS_URL = os.getenv("STATE_REDIS_URL")
 
 REGISTERED_FACE_DIR = os.getenv("REGISTERED_FACE_DIR", "registered_faces")
-EMBEDDINGS_PATH = os.getenv("EMBEDDINGS_PATH", "embeddings.json")
+EMBEDDINGS_PATH = os.getenv("EMBEDDINGS_PATH", "embeddings.json")  # legacy JSON, migrated on first start
+LABELS_PATH = os.getenv("LABELS_PATH", "labels.json")
+EMBEDDINGS_STORE = os.getenv("EMBEDDINGS_STORE", "embeddings")  # binary store prefix
 FACE_MODEL = os.getenv("FACE_MODEL", "Facenet")
 DETECTOR_BACKEND = os.getenv("DETECTOR_BACKEND", "mtcnn")
 FACE_MATCH_THRESHOLD = float(os.getenv("FACE_MATCH_THRESHOLD", "0.40"))
+FACE_MATCH_MARGIN = float(os.getenv("FACE_MATCH_MARGIN", "0.05"))  # best vs. runner-up identity
+FACE_TOPK = int(os.getenv("FACE_TOPK", "5"))
+FACE_MAX_EMBEDDINGS = int(os.getenv("FACE_MAX_EMBEDDINGS", "8"))  # per user; more get clustered
+ANN_INDEX = os.getenv("ANN_INDEX", "none")  # none | ivf
+ANN_MIN_ROWS = int(os.getenv("ANN_MIN_ROWS", "20000"))  # exact scan below this; see bench/ann_bench.py
+ANN_NLIST = int(os.getenv("ANN_NLIST", "0"))  # 0 = sqrt(rows)
+ANN_NPROBE = int(os.getenv("ANN_NPROBE", "8"))
+FACE_WARMUP = os.getenv("FACE_WARMUP", "1") == "1"
+# server: DeepFace/TensorFlow live in one inference process shared by all
+# workers (see inference_server.py), so web workers boot without them.
+# OpenCV still loads in every worker: decoding, camera and evidence use it.
+# inprocess: every worker loads its own model.
+FACE_INFERENCE = os.getenv("FACE_INFERENCE", "inprocess" if os.name == "nt" else "server")
+INFERENCE_SOCKET = os.getenv("INFERENCE_SOCKET", "inference.sock")
+INFERENCE_TIMEOUT = float(os.getenv("INFERENCE_TIMEOUT", "30"))
+# single: always DETECTOR_BACKEND. cascade: try OpenCV Haar first and fall
+# back to DETECTOR_BACKEND only when it is not confident about one face.
+FACE_DETECT_MODE = os.getenv("FACE_DETECT_MODE", "single")
+FAST_DETECT_MIN_WEIGHT = float(os.getenv("FAST_DETECT_MIN_WEIGHT", "4.0"))
+FAST_DETECT_MIN_SIZE = int(os.getenv("FAST_DETECT_MIN_SIZE", "80"))
+FACE_BATCHING = os.getenv("FACE_BATCHING", "1") == "1"  # micro-batch face inference (in the server, or in-process)
+FACE_BATCH_MAX = int(os.getenv("FACE_BATCH_MAX", "8"))
+FACE_BATCH_WAIT_MS = float(os.getenv("FACE_BATCH_WAIT_MS", "5"))
+FACE_STREAM_SECONDS = float(os.getenv("FACE_STREAM_SECONDS", "20"))  # hands-free unlock attempt length
+FACE_STREAM_DETECT_EVERY = int(os.getenv("FACE_STREAM_DETECT_EVERY", "5"))  # frames; tracked in between
+FACE_STREAM_MIN_FRAMES = int(os.getenv("FACE_STREAM_MIN_FRAMES", "3"))
+FACE_STREAM_MAX_FRAMES = int(os.getenv("FACE_STREAM_MAX_FRAMES", "12"))
+FACE_STREAM_MIN_SHARPNESS = float(os.getenv("FACE_STREAM_MIN_SHARPNESS", "60"))
+FACE_STREAM_MAX_SESSIONS = int(os.getenv("FACE_STREAM_MAX_SESSIONS", "1"))  # per worker
+UPLOAD_MAX_BYTES = int(os.getenv("UPLOAD_MAX_BYTES", str(16 * 1024 * 1024)))  # whole request body
+UPLOAD_MAX_IMAGE_BYTES = int(os.getenv("UPLOAD_MAX_IMAGE_BYTES", str(5 * 1024 * 1024)))  # one encoded image
+UPLOAD_MAX_PIXELS = int(os.getenv("UPLOAD_MAX_PIXELS", "40000000"))
+FACE_DECODE_MAX_SIDE = int(os.getenv("FACE_DECODE_MAX_SIDE", "640"))  # px, long side after decode
+ENROLL_WORKERS = int(os.getenv("ENROLL_WORKERS", "2"))  # 0 = embed in the web process
+ENROLL_BATCH_SIZE = int(os.getenv("ENROLL_BATCH_SIZE", "8"))
+
+CAMERA_SOURCE = os.getenv("CAMERA_SOURCE", "0")  # device index, or a video file/URL
+CAMERA_BACKEND = os.getenv("CAMERA_BACKEND", "dshow" if os.name == "nt" else "any")
+CAMERA_BUFFER = int(os.getenv("CAMERA_BUFFER", "8"))
+CAMERA_PRESTART = os.getenv("CAMERA_PRESTART", "0") == "1"
+# One worker owns the device (whoever holds CAMERA_LOCK); the rest read its
+# frames from CAMERA_RING, which should sit on tmpfs.
+CAMERA_LOCK = os.getenv("CAMERA_LOCK", "camera.lock")
+CAMERA_RING = os.getenv("CAMERA_RING", os.path.join(
+    "/dev/shm" if os.path.isdir("/dev/shm") else ".",
+    f"doorlock-camera-{zlib.crc32(os.path.abspath(CAMERA_LOCK).encode()):08x}.ring"))
+INTRUDER_DIR = os.getenv("INTRUDER_DIR", "intruder_images")
+# Alert snapshots go to a deduplicating evidence store (see evidence.py).
+EVIDENCE_DIR = os.getenv("EVIDENCE_DIR", INTRUDER_DIR)
+EVIDENCE_MAX_MB = float(os.getenv("EVIDENCE_MAX_MB", "500"))
+EVIDENCE_RETENTION_DAYS = float(os.getenv("EVIDENCE_RETENTION_DAYS", "90"))  # 0 = size limit only
+EVIDENCE_CLIP_FRAMES = int(os.getenv("EVIDENCE_CLIP_FRAMES", "3"))  # buffered frames kept per alert
+EVIDENCE_DEDUP_DISTANCE = int(os.getenv("EVIDENCE_DEDUP_DISTANCE", "6"))  # dHash bits; -1 disables
+EVIDENCE_DEDUP_WINDOW = float(os.getenv("EVIDENCE_DEDUP_WINDOW", "300"))  # seconds
+EVIDENCE_THUMB_SIDE = int(os.getenv("EVIDENCE_THUMB_SIDE", "320"))  # px, long side of email thumbnails
 
 NODEMCU_IP = os.getenv("NODEMCU_IP", "10.203.163.205")
-NODEMCU_QR_ENDPOINT = f"http://{NODEMCU_IP}/display_qr"
-
-# In-memory runtime
-current_otp = None
-otp_expire_at = 0
-sessions = {}  # token -> expiry timestamp
-qr_sessions = {}  # short_token -> expiry timestamp
-qr_approval_requests = {}
+DEVICE_CONNECT_TIMEOUT = float(os.getenv("DEVICE_CONNECT_TIMEOUT", "1.0"))
+DEVICE_READ_TIMEOUT = float(os.getenv("DEVICE_READ_TIMEOUT", "3.0"))
+DEVICE_BREAKER_FAILURES = int(os.getenv("DEVICE_BREAKER_FAILURES", "3"))
+DEVICE_BREAKER_RESET = float(os.getenv("DEVICE_BREAKER_RESET", "10"))
+STATUS_CACHE_TTL = float(os.getenv("STATUS_CACHE_TTL", "1.0"))
+STATUS_STREAM_MAX = int(os.getenv("STATUS_STREAM_MAX", "300"))  # seconds per SSE connection
+# Door registry: a JSON file or inline JSON mapping door IDs to ip/url and
+# key (see fleet.py). Unset means one door, "main", at DEVICE_IP.
+DOORS_CONFIG = os.getenv("DOORS_CONFIG") or os.getenv("DOORS")
+FLEET_MAX_WORKERS = int(os.getenv("FLEET_MAX_WORKERS", "32"))  # concurrent device calls per fan-out
+FLEET_TIMEOUT = float(os.getenv("FLEET_TIMEOUT", str(DEVICE_CONNECT_TIMEOUT + DEVICE_READ_TIMEOUT + 0.5)))
+
+# Requests sent with "X-Profile: <token>" are stack-sampled; unset disables it.
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN")
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "2"))
+
+# Oversized bodies are refused by Werkzeug before they are read into memory.
+app.config["MAX_CONTENT_LENGTH"] = UPLOAD_MAX_BYTES
+
+# Prometheus metrics, served on /metrics (see metrics.py). Gauges are read
+# from the services at scrape time and registered once those exist.
+metrics = Registry()
+REQUEST_SECONDS = metrics.histogram("smartlock_request_seconds", "HTTP request latency by endpoint",
+                                    ("endpoint", "status"))
+STAGE_SECONDS = metrics.histogram("smartlock_stage_seconds",
+                                  "Latency of one pipeline stage (upload, decode, detect, embed, match, smtp, ...)",
+                                  ("stage",))
+DEVICE_SECONDS = metrics.histogram("smartlock_device_request_seconds", "Latency of calls to the lock devices",
+                                   ("endpoint",))
+DEVICE_ERRORS = metrics.counter("smartlock_device_errors_total", "Failed or 4xx/5xx device calls", ("endpoint",))
+AUTH_ATTEMPTS = metrics.counter("smartlock_auth_attempts_total", "Authentication attempts by method and outcome",
+                                ("method", "outcome"))
+
+
+def observe_stage(stage, seconds):
+    STAGE_SECONDS.observe(seconds, stage=stage)
+
+
+def observe_device(endpoint, seconds, error):
+    DEVICE_SECONDS.observe(seconds, endpoint=endpoint)
+    if error:
+        DEVICE_ERRORS.inc(endpoint=endpoint)
+
+# Auth runtime state. It lives in a shared backend so a token issued by one
+# gunicorn worker is honoured by all of them; entries expire after their TTL
+# and each namespace is capped.
+state_backend = make_backend(STATE_BACKEND, sqlite_path=STATE_DB_PATH,
+                             redis_url=STATE_REDIS_URL, max_per_ns=TOKEN_STORE_MAX)
+sessions = Namespace(state_backend, "session", SESSION_TTL)  # token -> True
+qr_sessions = Namespace(state_backend, "qr_session", QR_SESSION_TTL)  # short_token -> {"door": id}
+qr_approval_requests = Namespace(state_backend, "qr_approval", QR_APPROVAL_TTL)  # token -> request dict
+otp_store = Namespace(state_backend, "otp", OTP_TTL)  # "current" -> otp
+
+# Audit trail of auth attempts, QR decisions and device calls (see event_log.py).
+event_log = EventLog(EVENT_LOG_DIR, segment_bytes=EVENT_SEGMENT_BYTES, retention_days=EVENT_RETENTION_DAYS)
+
+# Failed attempts are throttled per client, and the alerts they trigger are
+# rolled up so a brute-forcer cannot turn each guess into a webcam capture
+# and an SMTP send.
+auth_limiter = AuthLimiter(Namespace(state_backend, "auth_limit", AUTH_LOCKOUT_MAX),
+                           ip_rate=AUTH_IP_RATE, ip_burst=AUTH_IP_BURST,
+                           method_rate=AUTH_METHOD_RATE, method_burst=AUTH_METHOD_BURST,
+                           max_failures=AUTH_MAX_FAILURES, lockout=AUTH_LOCKOUT, lockout_max=AUTH_LOCKOUT_MAX)
+
+# Enrollment pool workers are spawned, and a spawned child re-imports the
+# parent's __main__. So when app.py is run directly ("python app.py") each
+# pool worker executes this module again and must not kick off warm-ups,
+# rebuilds or an inference server of its own. Under gunicorn, __main__ is
+# gunicorn and pool workers never import app; this is then always False.
+IS_POOL_CHILD = multiprocessing.current_process().name != "MainProcess"
+REMOTE_INFERENCE = FACE_INFERENCE == "server"
+
+# Models are built once per worker, or once in the inference server; the
+# optional warm-up runs in the background so boot is not blocked and the
+# first unlock is not slow either.
+if REMOTE_INFERENCE:
+    # A server started with other settings (or older code) is restarted.
+    face_engine = RemoteFaceEngine(INFERENCE_SOCKET, timeout=INFERENCE_TIMEOUT, spawn=not IS_POOL_CHILD,
+                                   config=server_config(FACE_MODEL, DETECTOR_BACKEND, FACE_DETECT_MODE, FACE_BATCHING,
+                                                        FACE_BATCH_MAX, FACE_BATCH_WAIT_MS, FAST_DETECT_MIN_WEIGHT,
+                                                        FAST_DETECT_MIN_SIZE))
+else:
+    face_engine = FaceEngine(FACE_MODEL, DETECTOR_BACKEND, detect_mode=FACE_DETECT_MODE,
+                             fast_min_weight=FAST_DETECT_MIN_WEIGHT, fast_min_size=FAST_DETECT_MIN_SIZE)
+face_engine.on_timing = observe_stage
+if FACE_WARMUP and not IS_POOL_CHILD:
+    face_engine.warmup_async()
+
+# Concurrent face-logins in this process share one inference thread that
+# runs their frames as a batch (see batcher.py). The inference server does
+# this itself, across all workers.
+face_batcher = MicroBatcher(face_engine.analyze_batch, max_batch=FACE_BATCH_MAX,
+                            max_wait_ms=FACE_BATCH_WAIT_MS) if FACE_BATCHING and not REMOTE_INFERENCE else None
+
+
+def analyze_face(bgr):
+    if face_batcher is not None:
+        return face_batcher.submit(bgr)
+    return face_engine.analyze(bgr)
+
 # Load and save face embeddings
+embedding_store = EmbeddingStore(EMBEDDINGS_STORE)
+
 def load_embeddings():
-    if not os.path.exists(EMBEDDINGS_PATH):
-        return {}
+    if not embedding_store.exists() and os.path.exists(EMBEDDINGS_PATH):
+        try:
+            embedding_store.migrate_from_json(EMBEDDINGS_PATH, LABELS_PATH)
+        except Exception as e:
+            print("[ERROR] Failed to migrate embeddings.json:", e)
     try:
-        with open(EMBEDDINGS_PATH, "r") as f:
-            data = json.load(f)
-        return {k: np.array(v, dtype=np.float32) for k, v in data.items()}
+        return embedding_store.load()
     except Exception as e:
         print("[ERROR] Failed to load embeddings:", e)
         return {}
 
-def save_embeddings(embeddings):
-    serial = {k: v.tolist() for k, v in embeddings.items()}
-    with open(EMBEDDINGS_PATH, "w") as f:
-        json.dump(serial, f, indent=2)
-
-embeddings_db = load_embeddings()
+def save_embeddings(user_id, vectors):
+    # Keep every image's embedding (or k centroids for large sets) rather
+    # than one mean vector, so each look of the user stays matchable.
+    rows = reduce_embeddings(vectors, FACE_MAX_EMBEDDINGS)
+    embedding_store.put(user_id, rows)
+    face_gallery.add(user_id, rows)
+    setup_ann_index()
+
+def sync_embeddings():
+    # Another worker may have registered a face since we loaded.
+    changed = embedding_store.refresh()
+    if changed is None:
+        for label in face_gallery.labels():
+            face_gallery.remove(label)
+        changed = embedding_store.load()
+    for label, rows in changed.items():
+        if rows is None:
+            face_gallery.remove(label)
+        else:
+            face_gallery.add(label, rows)
 
-def build_embeddings_from_images():
-    print("[INFO] embeddings.json not found or empty. Building from images dir...")
-    if not os.path.exists(REGISTERED_FACE_DIR):
-        print("[WARN] Registered faces directory does not exist:", REGISTERED_FACE_DIR)
+def setup_ann_index():
+    # Large galleries switch from the exact scan to an IVF index. Its
+    # centroids are persisted next to the store; the buckets are rebuilt on
+    # load, which is a single matrix product.
+    if ANN_INDEX != "ivf" or face_gallery.index is not None:
         return
-    users = [d for d in os.listdir(REGISTERED_FACE_DIR)
-             if os.path.isdir(os.path.join(REGISTERED_FACE_DIR, d))]
-    for user_id in users:
-        user_folder = os.path.join(REGISTERED_FACE_DIR, user_id)
-        embeddings = []
-        for filename in os.listdir(user_folder):
-            filepath = os.path.join(user_folder, filename)
-            if not os.path.isfile(filepath):
-                continue
-            try:
-                embed = DeepFace.represent(
-                    img_path=filepath,
-                    model_name=FACE_MODEL,
-                    detector_backend=DETECTOR_BACKEND,
-                    enforce_detection=True)
-                if isinstance(embed, list) and len(embed) > 0 and isinstance(embed[0], (list, np.ndarray, float, int)):
-                    vec = np.array(embed, dtype=np.float32)
-                elif isinstance(embed, dict) and 'embedding' in embed:
-                    vec = np.array(embed['embedding'], dtype=np.float32)
-                else:
-                    vec = np.array(embed, dtype=np.float32)
-                embeddings.append(vec)
-            except Exception as e:
-                print(f"[WARN] could not compute embedding for {filepath}: {e}")
-        if len(embeddings) == 0:
-            print(f"[WARN] no valid embeddings for user {user_id}; skipping")
-            continue
-        mean_embedding = np.mean(np.stack(embeddings, axis=0), axis=0)
-        embeddings_db[user_id] = mean_embedding
-    save_embeddings(embeddings_db)
+    path = EMBEDDINGS_STORE + ".ivf.npy"
+    index = None
+    if os.path.exists(path):
+        index = IVFIndex.load(path, nprobe=ANN_NPROBE)
+        if index.dim != face_gallery.dim:
+            index = None  # model changed; retrain below
+    if index is None:
+        if face_gallery.row_count() < ANN_MIN_ROWS:
+            return
+        vectors = np.concatenate(list(face_gallery.to_dict().values()))
+        index = IVFIndex.train(vectors, nlist=ANN_NLIST or None, nprobe=ANN_NPROBE)
+        index.save(path)
+        print(f"[INFO] Trained IVF index: {len(index.centroids)} lists over {len(vectors)} rows")
+    face_gallery.attach_index(index, min_rows=ANN_MIN_ROWS)
+
+face_gallery = FaceGallery.from_dict(load_embeddings())
+setup_ann_index()
+
+# Bulk enrollment runs in a background thread (fanning out to a process
+# pool); progress is kept in the state backend so any worker can report it.
+enroll_jobs = Namespace(state_backend, "enroll_job", 86400)
+
+def start_enrollment(users=None, exclusive=False):
+    """Start a job and return its id; with exclusive=True, None if one is already running in any worker."""
+    lock = try_lock(EMBEDDINGS_STORE + ".rebuild.lock") if exclusive else None
+    if exclusive and lock is None:
+        return None
+    job_id = secrets.token_urlsafe(12)
+    enroll_jobs.set(job_id, {"state": "queued", "users": {}})
+
+    def run():
+        try:
+            progress = run_enrollment(
+                REGISTERED_FACE_DIR, FACE_MODEL, DETECTOR_BACKEND,
+                users=users,
+                # The server already owns the model; a pool would load more copies.
+                workers=0 if REMOTE_INFERENCE else ENROLL_WORKERS,
+                batch_size=ENROLL_BATCH_SIZE,
+                engine=face_engine,
+                on_progress=lambda p: enroll_jobs.set(job_id, p),
+                on_user_done=save_embeddings)
+            print(f"[INFO] Enrollment job {job_id} finished: {len(progress['users'])} user(s)")
+        except Exception as e:
+            print("[ERROR] Enrollment job failed:", e)
+            enroll_jobs.set(job_id, {"state": "failed", "error": str(e), "users": {}})
+        finally:
+            if lock is not None:
+                lock.close()
 
-if not embeddings_db:
-    build_embeddings_from_images()
+    threading.Thread(target=run, name=f"enroll-{job_id}", daemon=True).start()
+    return job_id
+
+# Never block start-up on a rebuild: the app serves requests while the
+# gallery fills in (face-login reports "no registered users" until then).
+if not len(face_gallery) and not IS_POOL_CHILD:
+    if start_enrollment(exclusive=True):
+        print("[INFO] Embeddings store empty. Building from images dir in the background...")
 
 print(f"[INFO] App starting. Registered face dir: {REGISTERED_FACE_DIR}")
 
 # Email helpers
-def send_email(subject: str, html_body: str, to_addr=REGISTERED_EMAIL, attachment_path=None, inline_image=None):
-    if not EMAIL_USER or not EMAIL_PASS:
+# Mail goes out from background workers that keep one SMTP session open, so
+# handlers (and the unlock itself) never wait on the TLS handshake.
+mail_dispatcher = MailDispatcher(
+    SMTP_HOST, SMTP_PORT, EMAIL_USER, EMAIL_PASS,
+    security=SMTP_SECURITY,
+    workers=MAIL_WORKERS,
+    maxsize=MAIL_QUEUE_SIZE,
+    max_retries=MAIL_MAX_RETRIES)
+mail_dispatcher.on_timing = observe_stage
+
+def send_email(subject: str, html_body: str, to_addr=REGISTERED_EMAIL, attachment_path=None, inline_image=None,
+               incident=None):
+    if not EMAIL_USER or (not EMAIL_PASS and SMTP_SECURITY != "none"):
         print("[WARN] EMAIL_USER/EMAIL_PASS not set — skipping email send.")
         return
+    # The message is built on the mail worker: snapshots are still being
+    # encoded by the evidence writer when the handler returns.
+    mail_dispatcher.submit(EMAIL_USER, to_addr,
+                           lambda: build_email(subject, html_body, to_addr, attachment_path, inline_image, incident))
+
+def build_email(subject, html_body, to_addr, attachment_path=None, inline_image=None, incident=None):
+    if incident:
+        # An evidence incident is shown by its small thumbnail; the full
+        # frames stay in the store (/evidence).
+        inline_image = evidence.thumbnail(incident)
+    for path in (attachment_path, inline_image):
+        if path:
+            evidence.wait_written(path)
 
     # Use "related" for HTML + inline images
     msg = MIMEMultipart("related")
@@ -152,30 +417,67 @@ def send_email(subject: str, html_body: str, to_addr=REGISTERED_EMAIL, attachmen
             mime_base.add_header('Content-Disposition', f'attachment; filename={os.path.basename(attachment_path)}')
             msg.attach(mime_base)
 
-    # Send email
-    try:
-        with smtplib.SMTP_SSL(SMTP_HOST, SMTP_PORT) as server:
-            server.login(EMAIL_USER, EMAIL_PASS)
-            server.sendmail(EMAIL_USER, to_addr, msg.as_string())
-        print("[INFO] Email sent:", subject)
-    except Exception as e:
-        print("[ERROR] Failed to send email:", e)
+    return msg
 
 def send_otp_email(otp: str):
     subject = "Your OTP for Smart Lock"
     html = f"<p>Your OTP is: <b>{otp}</b></p><p>Expires in {OTP_TTL//60} minute(s).</p>"
     send_email(subject, html)
 
-def send_alert_email(reason, remote_ip, attachment_path=None):
+def send_alert_email(reason, remote_ip, incident=None):
     subject = f"Alert: {reason}"
     html = f"<p>Alert reason: <b>{reason}</b></p><p>From IP: {remote_ip}</p>"
-    send_email(subject, html, attachment_path=attachment_path)
+    if incident:
+        html += (f'<img src="cid:captureimg" width="{EVIDENCE_THUMB_SIDE}">'
+                 f"<p>Evidence incident <b>{incident['id']}</b> ({len(incident['images'])} frame(s))</p>")
+    send_email(subject, html, incident=incident)
 
 def send_success_email(method, remote_ip):
     subject = f"Success: {method} authentication"
     html = f"<p>{method} authentication succeeded.</p><p>From IP: {remote_ip}</p>"
     send_email(subject, html)
 
+def send_first_alert(event, incident):
+    send_alert_email(f"{event['reason']} (method={event['method']})", event["ip"], incident)
+
+def send_alert_digest(digest):
+    rows = "".join(
+        f"<tr><td>{time.strftime('%H:%M:%S', time.localtime(e['ts']))}</td><td>{e['ip']}</td>"
+        f"<td>{e['method']}</td><td>{e['reason']}</td></tr>" for e in digest["recent"])
+    by_method = ", ".join(f"{m}: {n}" for m, n in sorted(digest["by_method"].items(), key=lambda kv: -kv[1]))
+    by_reason = ", ".join(f"{r}: {n}" for r, n in sorted(digest["by_reason"].items(), key=lambda kv: -kv[1]))
+    html = (f"<p><b>{digest['count']}</b> more failed attempts from {digest['ip']} since "
+            f"{time.strftime('%H:%M:%S', time.localtime(digest['opened']))}.</p>"
+            f"<p>By method: {by_method}</p><p>By reason: {by_reason}</p>"
+            f"<table><tr><th>Time</th><th>IP</th><th>Method</th><th>Reason</th></tr>{rows}</table>")
+    send_email(f"Alert digest: {digest['count']} failed attempts from {digest['ip']}", html)
+
+alert_rollup = AlertRollup(Namespace(state_backend, "alert_rollup", 2 * ALERT_WINDOW + 60),
+                           send_first_alert, send_alert_digest, window=ALERT_WINDOW)
+if not IS_POOL_CHILD:
+    alert_rollup.start()
+
+def alert_failure(reason, remote_ip, method, snapshot=None):
+    # Only the first failure of a window pays for a snapshot and an email.
+    alert_rollup.report(reason, remote_ip, method, snapshot)
+
+def record_auth(method, ok, outcome=None, **fields):
+    # One audit event and one counter sample per attempt.
+    AUTH_ATTEMPTS.inc(method=method, outcome=outcome or ("ok" if ok else "fail"))
+    event_log.record("auth", method=method, ok=ok, result=outcome, **fields)
+
+def rate_limited(method):
+    allowed, retry_after = auth_limiter.check(request.remote_addr, method)
+    if allowed:
+        return None
+    alert_failure("Too many attempts", request.remote_addr, method)
+    AUTH_ATTEMPTS.inc(method=method, outcome="throttled")
+    event_log.record("auth_throttled", method=method, ip=request.remote_addr, retry_after=round(retry_after, 1))
+    resp = jsonify({"ok": False, "error": "Too many attempts, try again later",
+                    "retry_after": int(retry_after) + 1})
+    resp.headers["Retry-After"] = str(int(retry_after) + 1)
+    return resp, 429
+
 # Utility helpers
 def gen_otp():
     return ''.join([str(secrets.randbelow(10)) for _ in range(6)])
@@ -188,104 +490,168 @@ def gen_short_token(length=6):
     return ''.join(secrets.choice(alphabet) for _ in range(length))
 
 def token_valid(token: str):
-    exp = sessions.get(token)
-    return exp is not None and exp > time.time()
+    return sessions.get(token) is not None
 
 def qr_session_valid(token: str):
-    exp = qr_sessions.get(token)
-    return exp is not None and exp > time.time()
+    return qr_sessions.get(token) is not None
+
+def qr_session_door(token: str):
+    # The one door a visitor's QR opens; sessions issued before doors were
+    # recorded are bound to the default door. None if the session is invalid.
+    qr = qr_sessions.get(token)
+    if qr is None:
+        return None
+    return qr.get("door", fleet.default) if isinstance(qr, dict) else fleet.default
+
+def require_session():
+    # Bearer header or ?token=; None when the session is valid.
+    auth_header = request.headers.get("Authorization", "")
+    token = auth_header.split(" ", 1)[1].strip() if auth_header.startswith("Bearer ") else request.args.get("token", "")
+    if not token or not token_valid(token):
+        return jsonify({"ok": False, "error": "Unauthorized or expired session"}), 401
+    return None
 
-def cosine_distance(a: np.ndarray, b: np.ndarray):
-    a = a.astype(np.float32)
-    b = b.astype(np.float32)
-    denom = (np.linalg.norm(a) * np.linalg.norm(b)) + 1e-10
-    return 1.0 - float(np.dot(a, b) / denom)
+# The camera stays open in a background thread (started on first use, or at
+# boot with CAMERA_PRESTART=1); snapshots come from its frame buffer.
+camera = CaptureService(
+    int(CAMERA_SOURCE) if CAMERA_SOURCE.isdigit() else CAMERA_SOURCE,
+    api_preference=cv2.CAP_DSHOW if CAMERA_BACKEND == "dshow" else None,
+    buffer_size=CAMERA_BUFFER, lock_path=CAMERA_LOCK, ring_path=CAMERA_RING)
+if CAMERA_PRESTART:
+    camera.start()
+
+evidence = EvidenceStore(
+    EVIDENCE_DIR,
+    max_bytes=int(EVIDENCE_MAX_MB * 1024 * 1024),
+    retention_days=EVIDENCE_RETENTION_DAYS,
+    thumb_side=EVIDENCE_THUMB_SIDE,
+    dedup_distance=EVIDENCE_DEDUP_DISTANCE,
+    dedup_window=EVIDENCE_DEDUP_WINDOW)
+
+def save_evidence(frames, kind, **meta):
+    try:
+        incident = evidence.save_incident(frames, kind, **meta)
+        if incident:
+            event_log.record("evidence", incident=incident["id"], kind=kind, images=len(incident["images"]),
+                             ip=meta.get("ip"))
+        return incident
+    except Exception as e:
+        print("[WARN] save_evidence exception:", e)
+        return None
 
-def capture_image():
+def capture_image(kind="intruder", **meta):
+    # The last few buffered frames, not just one: the evidence store drops
+    # the ones that are near-identical. Never waits on the camera: without
+    # CAMERA_PRESTART the first call only starts it.
     try:
-        cam = cv2.VideoCapture(0, cv2.CAP_DSHOW)
-        if not cam.isOpened():
-            cam.release()
-            print("[WARN] Camera not accessible.")
-            return None
-        ret, frame = cam.read()
-        cam.release()
-        if ret:
-            os.makedirs("intruder_images", exist_ok=True)
-            filename = os.path.join("intruder_images", f"intruder_{int(time.time())}.jpg")
-            cv2.imwrite(filename, frame)
-            print(f"[INFO] Intruder image saved: {filename}")
-            return filename
+        if camera.latest(wait=0, max_age=2.0) is not None:
+            return save_evidence([f for _, f in camera.clip(EVIDENCE_CLIP_FRAMES)], kind, **meta)
     except Exception as e:
         print("[WARN] capture_image exception:", e)
     print("[WARN] Failed to capture image.")
     return None
 
-def nodemcu_control(action: str):
-    url = f"http://{DEVICE_IP}/control"
-    payload = {"action": action, "key": DEVICE_API_KEY}
+# One pooled keep-alive client per device; while a device is unreachable its
+# circuit breaker fails calls immediately instead of tying up a worker.
+def make_device_client(base_url):
+    client = DeviceClient(
+        base_url,
+        connect_timeout=DEVICE_CONNECT_TIMEOUT,
+        read_timeout=DEVICE_READ_TIMEOUT,
+        failure_threshold=DEVICE_BREAKER_FAILURES,
+        reset_timeout=DEVICE_BREAKER_RESET)
+    client.on_timing = observe_device
+    return client
+
+def fetch_device_status(door, client):
+    res = client.get("/status", params={"key": door.key})
+    return res.json()
+
+# One client, breaker and status cache per door; multi-door calls fan out
+# on the fleet's thread pool.
+fleet = DeviceFleet(load_doors(DOORS_CONFIG, DEVICE_IP, DEVICE_API_KEY), lambda door: make_device_client(door.url),
+                    fetch_device_status, status_max_age=STATUS_CACHE_TTL, max_workers=FLEET_MAX_WORKERS)
+device_client = fleet.client()
+qr_device_client = device_client if device_client.base_url == f"http://{NODEMCU_IP}" else make_device_client(f"http://{NODEMCU_IP}")
+
+def log_device_call(endpoint, start, result, **fields):
+    event_log.record("device", endpoint=endpoint, ok=bool(result.get("ok", True)), error=result.get("error"),
+                     latency_ms=round((time.perf_counter() - start) * 1000, 1), **fields)
+    return result
+
+def nodemcu_control(action: str, door=None):
+    door = door or fleet.door()
+    payload = {"action": action, "key": door.key}
+    start = time.perf_counter()
     try:
-        res = requests.post(url, json=payload, timeout=5)
-        res.raise_for_status()
+        res = fleet.client(door.id).post("/control", json=payload)
         if res.headers.get("Content-Type", "").startswith("application/json"):
-            return res.json()
-        return {"ok": False, "error": "Invalid response from device"}
+            return log_device_call("/control", start, res.json(), action=action, door=door.id, status=res.status_code)
+        return log_device_call("/control", start, {"ok": False, "error": "Invalid response from device"},
+                               action=action, door=door.id, status=res.status_code)
     except requests.exceptions.RequestException as e:
-        return {"ok": False, "error": f"NodeMCU communication error: {str(e)}"}
+        return log_device_call("/control", start, {"ok": False, "error": f"NodeMCU communication error: {str(e)}"},
+                               action=action, door=door.id)
+
+# All /status callers within STATUS_CACHE_TTL share one upstream fetch (per door).
+status_cache = fleet.cache()
 
 def nodemcu_qr_display(url: str, name: str, phone: str):
     payload = {"url": url, "name": name, "phone": phone, "key": DEVICE_API_KEY}
+    start = time.perf_counter()
     try:
-        res = requests.post(NODEMCU_QR_ENDPOINT, json=payload, timeout=5)
-        res.raise_for_status()
-        return res.json()
+        res = qr_device_client.post("/display_qr", json=payload)
+        return log_device_call("/display_qr", start, res.json(), status=res.status_code)
     except requests.exceptions.RequestException as e:
-        return {"ok": False, "error": f"NodeMCU QR communication error: {str(e)}"}
+        return log_device_call("/display_qr", start, {"ok": False, "error": f"NodeMCU QR communication error: {str(e)}"})
 
 # ------------------ Face registration/login ------------------
+@app.errorhandler(413)
+def payload_too_large(e):
+    return jsonify({"ok": False, "error": f"Upload too large (limit {UPLOAD_MAX_BYTES} bytes)"}), 413
+
 @app.route("/register_face", methods=["POST"])
 def register_face():
-    data = request.get_json() or {}
-    images_b64 = data.get("images", [])
-    user_id = data.get("user_id", "").strip()
+    try:
+        blobs, fields = request_images(request, "images", UPLOAD_MAX_IMAGE_BYTES)
+    except ImageTooLarge as e:
+        return jsonify({"ok": False, "error": str(e)}), 413
+    except ImageError as e:
+        return jsonify({"ok": False, "error": str(e)}), 400
+    user_id = str(fields.get("user_id", "")).strip()
     if not user_id:
         return jsonify({"ok": False, "error": "user_id required"}), 400
-    if not images_b64 or not isinstance(images_b64, list):
+    if not blobs:
         return jsonify({"ok": False, "error": "No images provided or invalid format"}), 400
 
     user_folder = os.path.join(REGISTERED_FACE_DIR, user_id)
     os.makedirs(user_folder, exist_ok=True)
 
     collected_embeddings = []
+    qualities = []
     saved_count = 0
 
-    for idx, img_b64 in enumerate(images_b64):
+    for idx, blob in enumerate(blobs):
         try:
-            header, b64 = img_b64.split(",", 1) if "," in img_b64 else ("", img_b64)
-            img_bytes = base64.b64decode(b64)
-            np_img = np.frombuffer(img_bytes, np.uint8)
-            bgr = cv2.imdecode(np_img, cv2.IMREAD_COLOR)
-            if bgr is None:
+            if blob is None:
+                continue
+            try:
+                bgr = decode_image(blob, FACE_DECODE_MAX_SIDE, UPLOAD_MAX_PIXELS)
+            except ImageError as e:
+                qualities.append({"image": idx, "rejected": [str(e)]})
                 continue
             filename = os.path.join(user_folder, f"{user_id}_{int(time.time())}_{idx}.jpg")
             cv2.imwrite(filename, bgr)
             saved_count += 1
             try:
-                embed = DeepFace.represent(
-                    img_path=filename,
-                    model_name=FACE_MODEL,
-                    detector_backend=DETECTOR_BACKEND,
-                    enforce_detection=True)
-                if isinstance(embed, list) and len(embed) > 0 and isinstance(embed[0], (list, np.ndarray, float, int)):
-                    vec = np.array(embed[0], dtype=np.float32)
-                elif isinstance(embed, dict) and 'embedding' in embed:
-                    vec = np.array(embed['embedding'], dtype=np.float32)
-                else:
-                    vec = np.array(embed, dtype=np.float32)
-                collected_embeddings.append(vec)
+                vec, quality = embed_image(face_engine, bgr)
             except Exception as e:
                 print(f"[WARN] embedding failed for saved image {filename}: {e}")
+                qualities.append({"image": idx, "rejected": ["no face detected"]})
                 continue
+            qualities.append({"image": idx, **quality})
+            if not quality["rejected"]:
+                collected_embeddings.append(vec)
         except Exception as e:
             print("[ERROR] Exception during face save:", e)
             continue
@@ -293,83 +659,181 @@ def register_face():
     if saved_count == 0:
         return jsonify({"ok": False, "error": "No valid images uploaded."}), 400
     if len(collected_embeddings) == 0:
-        return jsonify({"ok": False, "error": "No faces detected in provided images."}), 400
+        return jsonify({"ok": False, "error": "No usable faces in provided images.", "quality": qualities}), 400
+
+    kept = [collected_embeddings[i] for i in drop_outliers(collected_embeddings)]
+    save_embeddings(user_id, kept)
+    event_log.record("enroll", user=user_id, ip=request.remote_addr, images=len(blobs), used=len(kept))
+    return jsonify({"ok": True, "message": f"Registered {saved_count} images; embeddings saved for user '{user_id}'.",
+                    "used": len(kept), "quality": qualities})
+
+@app.route("/enroll/bulk", methods=["POST"])
+def enroll_bulk():
+    # Enroll (or re-enroll) users from photo folders under REGISTERED_FACE_DIR.
+    denied = require_session()
+    if denied:
+        return denied
+    data = request.get_json(silent=True) or {}
+    users = data.get("users")
+    if users is not None and not isinstance(users, list):
+        return jsonify({"ok": False, "error": "users must be a list of user ids"}), 400
+    # One job at a time across workers; the embedding store takes one writer.
+    job_id = start_enrollment(users=users or None, exclusive=True)
+    if job_id is None:
+        return jsonify({"ok": False, "error": "An enrollment job is already running"}), 409
+    return jsonify({"ok": True, "job": job_id}), 202
+
+@app.route("/enroll/jobs/<job_id>", methods=["GET"])
+def enroll_job(job_id):
+    denied = require_session()
+    if denied:
+        return denied
+    progress = enroll_jobs.get(job_id)
+    if progress is None:
+        return jsonify({"ok": False, "error": "Unknown job"}), 404
+    return jsonify({"ok": True, "job": job_id, **progress})
+
+# The stream detector is the cascade engine's own when cascade mode is on.
+face_stream_slots = threading.BoundedSemaphore(FACE_STREAM_MAX_SESSIONS)
+_stream_detector = None
+
+
+def stream_detector():
+    global _stream_detector
+    if _stream_detector is None:
+        try:
+            _stream_detector = face_engine.cascade or CascadeDetector(FAST_DETECT_MIN_WEIGHT, FAST_DETECT_MIN_SIZE)
+        except (AttributeError, RuntimeError, cv2.error) as e:
+            print("[WARN] Streaming face unlock unavailable:", e)
+    return _stream_detector
+
+@app.route("/face-unlock/stream", methods=["GET"])
+def face_unlock_stream():
+    # Hands-free unlock from the server camera (see face_stream.py). Progress
+    # and the final decision are pushed as server-sent events; the attempt
+    # ends on a match, a reject, or after FACE_STREAM_SECONDS.
+    detector = stream_detector()
+    if detector is None:
+        return jsonify({"ok": False, "error": "Streaming face unlock is not available"}), 503
+    sync_embeddings()
+    if not len(face_gallery):
+        return jsonify({"ok": False, "error": "No registered users. Please register first."}), 400
+    limited = rate_limited("face")
+    if limited:
+        return limited
+    if not face_stream_slots.acquire(blocking=False):
+        return jsonify({"ok": False, "error": "Camera is busy with another unlock attempt"}), 429
+    remote_ip = request.remote_addr
 
-    mean_embedding = np.mean(np.stack(collected_embeddings, axis=0), axis=0)
-    embeddings_db[user_id] = mean_embedding
-    save_embeddings(embeddings_db)
-    return jsonify({"ok": True, "message": f"Registered {saved_count} images; embeddings saved for user '{user_id}'."})
+    def events():
+        unlock = StreamUnlock(face_engine, lambda p: face_gallery.identify(p, k=FACE_TOPK), detector,
+                              FACE_MATCH_THRESHOLD, FACE_MATCH_MARGIN, detect_every=FACE_STREAM_DETECT_EVERY,
+                              min_frames=FACE_STREAM_MIN_FRAMES, max_frames=FACE_STREAM_MAX_FRAMES,
+                              min_sharpness=FACE_STREAM_MIN_SHARPNESS)
+        result, frame, last_sent = None, None, None
+        for frame in camera.frames(FACE_STREAM_SECONDS, wait=3.0):
+            result = unlock.feed(frame)
+            if result["state"] in ("match", "reject"):
+                break
+            if result != last_sent:
+                last_sent = result
+                yield f"data: {json.dumps(result)}\n\n"
+        if frame is None:
+            payload = {"ok": False, "state": "error", "error": "Camera not available"}
+        elif result is not None and result["state"] == "match":
+            auth_limiter.record(remote_ip, "face", True)
+            token = gen_token()
+            sessions.set(token)
+            send_success_email("face (hands-free)", remote_ip)
+            payload = {"ok": True, "token": token, "expires_in": SESSION_TTL,
+                       "message": f"Face recognized: {result['user']}", **result}
+        elif unlock.counts["embedded"]:
+            # Someone was in front of the camera and did not match: one
+            # alert for the whole attempt rather than one per frame.
+            auth_limiter.record(remote_ip, "face", False)
+            alert_failure("Face not recognized (hands-free)", remote_ip, "face",
+                          lambda: save_evidence([frame], "face_fail", ip=remote_ip, method="face_stream"))
+            best = None if unlock.best is None else unlock.best["distance"]
+            payload = {"ok": False, "state": "reject", "error": "Face not recognized", "best_distance": best}
+        else:
+            payload = {"ok": False, "state": "timeout", "error": "No face seen"}
+        print(f"[INFO] Streaming unlock {payload['state']}: {unlock.counts}")
+        record_auth("face_stream", payload["ok"], payload["state"], ip=remote_ip,
+                    user=payload.get("user"), distance=payload.get("distance", payload.get("best_distance")),
+                    frames=unlock.counts["frames"], embedded=unlock.counts["embedded"])
+        yield f"data: {json.dumps({**payload, 'counts': unlock.counts})}\n\n"
+
+    response = Response(stream_with_context(events()), mimetype="text/event-stream",
+                        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+    # Runs even if the client disconnects before the generator starts.
+    response.call_on_close(face_stream_slots.release)
+    return response
 
 @app.route("/face-login", methods=["POST"])
 def face_login():
-    data = request.get_json() or {}
-    img_data = data.get("image", "")
     remote_ip = request.remote_addr
-    if not img_data:
+    limited = rate_limited("face")
+    if limited:
+        return limited
+    try:
+        with STAGE_SECONDS.time(stage="upload"):
+            blobs, _ = request_images(request, "image", UPLOAD_MAX_IMAGE_BYTES)
+    except ImageTooLarge as e:
+        return jsonify({"ok": False, "error": str(e)}), 413
+    except ImageError:
+        return jsonify({"ok": False, "error": "Invalid image data"}), 400
+    if not blobs:
         return jsonify({"ok": False, "error": "No image provided"}), 400
     try:
-        header, b64 = img_data.split(",", 1) if "," in img_data else ("", img_data)
-        img_bytes = base64.b64decode(b64)
-        np_img = np.frombuffer(img_bytes, np.uint8)
-        bgr = cv2.imdecode(np_img, cv2.IMREAD_COLOR)
-        if bgr is None:
-            return jsonify({"ok": False, "error": "Invalid image data"}), 400
-    except Exception:
+        with STAGE_SECONDS.time(stage="decode"):
+            bgr = decode_image(blobs[0], FACE_DECODE_MAX_SIDE, UPLOAD_MAX_PIXELS)
+    except ImageTooLarge as e:
+        return jsonify({"ok": False, "error": str(e)}), 413
+    except ImageError:
         return jsonify({"ok": False, "error": "Invalid image data"}), 400
 
-    if not embeddings_db:
+    sync_embeddings()
+    if not len(face_gallery):
         return jsonify({"ok": False, "error": "No registered users. Please register first."}), 400
 
+    start = time.perf_counter()
     try:
-        temp_img_path = f"temp_face_{int(time.time())}.jpg"
-        cv2.imwrite(temp_img_path, bgr)
-        embed = DeepFace.represent(
-            img_path=temp_img_path,
-            model_name=FACE_MODEL,
-            detector_backend=DETECTOR_BACKEND,
-            enforce_detection=True)
-        os.remove(temp_img_path)
-        if isinstance(embed, dict) and "embedding" in embed:
-            probe = np.array(embed["embedding"], dtype=np.float32)
-        elif isinstance(embed, list) and len(embed) > 0:
-            first = embed[0]
-            if isinstance(first, dict) and "embedding" in first:
-                probe = np.array(first["embedding"], dtype=np.float32)
-            else:
-                probe = np.array(first, dtype=np.float32)
-        else:
-            probe = np.array(embed, dtype=np.float32)
+        probe, face_info = analyze_face(bgr)
     except Exception as e:
         print("[INFO] Face detection/embedding failed:", e)
-        img_path = capture_image()
-        send_alert_email("Face detection failed or no face in the image", remote_ip, img_path)
+        record_auth("face", False, "no_face", ip=remote_ip,
+                    latency_ms=round((time.perf_counter() - start) * 1000, 1))
+        alert_failure("Face detection failed or no face in the image", remote_ip, "face",
+                      lambda: capture_image(ip=remote_ip, method="face"))
         return jsonify({"ok": False, "error": "Face not detected / could not compute embedding"}), 400
 
-    best_user = None
-    best_distance = float("inf")
-    for user_id, stored_vec in embeddings_db.items():
-        d = cosine_distance(probe, stored_vec)
-        print(f"[DEBUG] compare to {user_id}: distance={d:.4f}")
-        if d < best_distance:
-            best_distance = d
-            best_user = user_id
-
-    print(f"[INFO] Best match: {best_user} distance={best_distance:.4f} (threshold={FACE_MATCH_THRESHOLD})")
-    if best_distance <= FACE_MATCH_THRESHOLD:
+    with STAGE_SECONDS.time(stage="match"):
+        match = face_gallery.identify(probe, k=FACE_TOPK)
+    best_user, best_distance, margin = match["user"], match["distance"], match["margin"]
+    detector_path = face_info.get("path")
+    print(f"[INFO] Best match: {best_user} distance={best_distance:.4f} votes={match['votes']}/{match['k']} "
+          f"margin={margin if margin is None else round(margin, 4)} detector={detector_path} (threshold={FACE_MATCH_THRESHOLD})")
+    matched = best_distance <= FACE_MATCH_THRESHOLD and (margin is None or margin >= FACE_MATCH_MARGIN)
+    record_auth("face", matched,
+                "match" if matched else "ambiguous" if best_distance <= FACE_MATCH_THRESHOLD else "no_match",
+                ip=remote_ip, user=best_user, distance=round(best_distance, 4),
+                margin=None if margin is None else round(margin, 4), votes=match["votes"], detector=detector_path,
+                latency_ms=round((time.perf_counter() - start) * 1000, 1))
+    if matched:
+        auth_limiter.record(remote_ip, "face", True)
         send_success_email("face", remote_ip)
         token = gen_token()
-        sessions[token] = time.time() + SESSION_TTL
-        return jsonify({"ok": True, "token": token, "expires_in": SESSION_TTL, "message": f"Face recognized: {best_user}", "distance": float(best_distance)})
+        sessions.set(token)
+        return jsonify({"ok": True, "token": token, "expires_in": SESSION_TTL, "message": f"Face recognized: {best_user}", "distance": float(best_distance), "detector": detector_path})
+    elif best_distance <= FACE_MATCH_THRESHOLD:
+        # Close to two enrolled identities: not an intruder, just not sure
+        # which user this is. Ask for another frame instead of alerting.
+        return jsonify({"ok": False, "error": "Face match ambiguous, please try again", "best_distance": float(best_distance), "margin": float(margin), "detector": detector_path}), 401
     else:
-        img_path = None
-        try:
-            os.makedirs("intruder_images", exist_ok=True)
-            img_path = os.path.join("intruder_images", f"face_fail_{int(time.time())}.jpg")
-            cv2.imwrite(img_path, bgr)
-        except Exception as e:
-            print("[WARN] Failed to save intruder image:", e)
-        send_alert_email("Face not recognized", remote_ip, img_path)
-        return jsonify({"ok": False, "error": "Face not recognized", "best_distance": float(best_distance)}), 401
+        auth_limiter.record(remote_ip, "face", False)
+        alert_failure("Face not recognized", remote_ip, "face",
+                      lambda: save_evidence([bgr], "face_fail", ip=remote_ip, method="face", user=best_user))
+        return jsonify({"ok": False, "error": "Face not recognized", "best_distance": float(best_distance), "detector": detector_path}), 401
 
 # ------------------ Basic pages ------------------
 @app.route("/")
@@ -385,18 +849,30 @@ def mobile_control(token):
 # ------------------ OTP / Password / PIN / Voice auth ------------------
 @app.route("/request_otp", methods=["POST"])
 def request_otp():
-    global current_otp, otp_expire_at
-    current_otp = gen_otp()
-    otp_expire_at = time.time() + OTP_TTL
-    send_otp_email(current_otp)
+    limited = rate_limited("otp_request")
+    if limited:
+        return limited
+    otp = gen_otp()
+    otp_store.set("current", otp)
+    send_otp_email(otp)
+    event_log.record("otp_request", ip=request.remote_addr)
     return jsonify({"ok": True, "message": "OTP sent to registered email."})
 
+AUTH_METHODS = ("password", "pin", "otp", "voice", "centerpattern")
+
 @app.route("/auth", methods=["POST"])
 def auth():
     data = request.get_json() or {}
     method = data.get("method")
     value = data.get("value", "").strip()
     remote_ip = request.remote_addr
+    # Checked before the limiter so made-up method names cannot mint
+    # limiter keys (and metric labels) of their own.
+    if method not in AUTH_METHODS:
+        return jsonify({"ok": False, "error": "Invalid method"}), 400
+    limited = rate_limited(method)
+    if limited:
+        return limited
 
     ok = False
     reason = ""
@@ -411,8 +887,9 @@ def auth():
         else:
             reason = "Wrong PIN"
     elif method == "otp":
-        now = time.time()
-        if current_otp and now < otp_expire_at and value == current_otp:
+        # Check-and-consume in one step: an OTP unlocks at most once, even
+        # if two workers receive it at the same moment.
+        if value and otp_store.consume("current", expected=value) is not None:
             ok = True
         else:
             reason = "Wrong or expired OTP"
@@ -426,17 +903,20 @@ def auth():
             ok = True
         else:
             reason = "Wrong center pattern"
-    else:
-        return jsonify({"ok": False, "error": "Invalid method"}), 400
 
+    lockout = auth_limiter.record(remote_ip, method, ok)
+    record_auth(method, ok, None if ok else "locked_out" if lockout else "fail", ip=remote_ip,
+                reason=reason or None, locked_out=bool(lockout) or None)
     if not ok:
-        img_path = capture_image()
-        send_alert_email(reason + f" (method={method})", remote_ip, img_path)
-        return jsonify({"ok": False, "error": reason}), 401
+        alert_failure(reason, remote_ip, method, lambda: capture_image(ip=remote_ip, method=method))
+        resp = {"ok": False, "error": reason}
+        if lockout:
+            resp["retry_after"] = int(lockout) + 1
+        return jsonify(resp), 401
 
     send_success_email(method, remote_ip)
     token = gen_token()
-    sessions[token] = time.time() + SESSION_TTL
+    sessions.set(token)
     return jsonify({"ok": True, "token": token, "expires_in": SESSION_TTL})
 
 
@@ -447,23 +927,27 @@ def request_qr():
     phone = data.get("phone")
     if not name or not phone:
         return jsonify({"ok": False, "error": "Name and phone number are required."}), 400
+    limited = rate_limited("qr")
+    if limited:
+        return limited
     
+    # 📸 Capture image
+    incident = capture_image("qr_request", ip=request.remote_addr, name=name)
+
     approval_token = gen_token()
-    qr_approval_requests[approval_token] = {
+    qr_approval_requests.set(approval_token, {
         "name": name,
         "phone": phone,
         "status": "pending",
-        "timestamp": time.time()
-    }
+        "timestamp": time.time(),
+        "evidence": incident["id"] if incident else None
+    })
 
     base_url = "http://10.203.163.227:5000"  # Replace with your actual IP/domain
 
     approve_link = f"{base_url}/qr/approve?token={approval_token}"
     deny_link = f"{base_url}/qr/deny?token={approval_token}"
 
-    # 📸 Capture image
-    img_path = capture_image()
-
     email_html = f"""
     <h3>QR Code Request</h3>
     <p>Name: <b>{name}</b></p>
@@ -474,7 +958,9 @@ def request_qr():
     <img src="cid:captureimg" width="300">
     """
 
-    send_email("Smart Lock QR Code Request Approval", email_html, inline_image=img_path)
+    send_email("Smart Lock QR Code Request Approval", email_html, incident=incident)
+    event_log.record("qr_request", ip=request.remote_addr, name=name, phone=phone,
+                     evidence=incident["id"] if incident else None)
     
     return jsonify({
         'ok': True,
@@ -485,21 +971,25 @@ def request_qr():
 @app.route("/qr/approve")
 def qr_approve():
     token = request.args.get("token")
-    req = qr_approval_requests.get(token)
+    req = qr_approval_requests.get(token) if token else None
     if not req or req["status"] != "pending":
         return "Invalid or expired approval link.", 400
+    # Only one of approve/deny can win, whichever worker handles them.
+    if not qr_approval_requests.cas(token, req, {**req, "status": "approved"}):
+        return "Invalid or expired approval link.", 400
 
-    req["status"] = "approved"
     qr_token = gen_short_token()
-    qr_sessions[qr_token] = time.time() + QR_SESSION_TTL
+    # The QR is shown on the default door's display and opens that door only.
+    qr_sessions.set(qr_token, {"door": fleet.default})
 
     base_url = "http://10.203.163.227:5000"
     qr_url = f"{base_url}/mc/{qr_token}"
 
     device_resp = nodemcu_qr_display(qr_url, req["name"], req["phone"])
-    # Log or handle device_resp if needed
+    event_log.record("qr_decision", decision="approved", ip=request.remote_addr, name=req["name"],
+                     device_ok=bool(device_resp.get("ok", True)))
 
-    # Keep approval request for status polling, cleanup separately later
+    # Approval request stays for status polling until QR_APPROVAL_TTL expires it
 
     return f"""
     <html style='font-family:sans-serif; text-align:center; padding:40px;'>
@@ -513,12 +1003,14 @@ def qr_approve():
 @app.route("/qr/deny")
 def qr_deny():
     token = request.args.get("token")
-    req = qr_approval_requests.get(token)
+    req = qr_approval_requests.get(token) if token else None
     if not req or req["status"] != "pending":
         return "Invalid or expired denial link.", 400
+    if not qr_approval_requests.cas(token, req, {**req, "status": "denied"}):
+        return "Invalid or expired denial link.", 400
 
-    req["status"] = "denied"
-    # Optionally keep request for some time for polling
+    event_log.record("qr_decision", decision="denied", ip=request.remote_addr, name=req["name"])
+    # Request stays for status polling until QR_APPROVAL_TTL expires it
 
     return """
     <html style='font-family:sans-serif; text-align:center; padding:40px;'>
@@ -531,10 +1023,10 @@ def qr_deny():
 @app.route('/qr_status')
 def qr_status():
     token = request.args.get('token')
-    if not token or token not in qr_approval_requests:
+    req = qr_approval_requests.get(token) if token else None
+    if not req:
         return jsonify({'ok': False, 'error': 'Invalid or missing token'})
-    status = qr_approval_requests[token]['status']
-    return jsonify({'ok': True, 'status': status})
+    return jsonify({'ok': True, 'status': req['status']})
 @app.route("/control", methods=["POST"])
 def control():
     auth_header = request.headers.get("Authorization", "")
@@ -545,41 +1037,306 @@ def control():
         data = request.get_json(silent=True) or {}
         token = data.get("token", "")
 
+    qr_door = None
     if not token or not token_valid(token):
-        if not token or not qr_session_valid(token):
+        qr_door = qr_session_door(token) if token else None
+        if qr_door is None:
             return jsonify({"ok": False, "error": "Unauthorized or expired session"}), 401
 
     data = request.get_json() or {}
     action = data.get("action")
     if action not in ("unlock", "close"):
         return jsonify({"ok": False, "error": "Invalid action"}), 400
-
+    # "door" is one door ID, a list of IDs or "all"; default is the first door.
+    selector = data["door"] if data.get("door") is not None else request.args.get("door")
+    if qr_door is not None:
+        # Multi-door control needs a full login; a QR visitor gets their door.
+        if selector is not None and selector != qr_door:
+            return jsonify({"ok": False, "error": "A QR session can only operate its own door"}), 403
+        selector = qr_door
     try:
-        device_resp = nodemcu_control(action)
-        return jsonify({"ok": True, "device": device_resp})
-    except Exception as e:
-        return jsonify({"ok": False, "error": "Device error: " + str(e)}), 500
+        door_ids = fleet.resolve(selector) if selector is not None else [fleet.default]
+    except UnknownDoor as e:
+        return jsonify({"ok": False, "error": f"Unknown door: {e.args[0]}"}), 404
+    except ValueError as e:
+        return jsonify({"ok": False, "error": str(e)}), 400
+    remote_ip = request.remote_addr
+
+    def run(door):
+        device_resp = nodemcu_control(action, door)
+        event_log.record("control", action=action, door=door.id, ip=remote_ip, ok=bool(device_resp.get("ok", True)))
+        fleet.cache(door.id).invalidate()
+        return device_resp
+
+    if selector is None or (isinstance(selector, str) and selector != "all"):
+        try:
+            return jsonify({"ok": True, "door": door_ids[0], "device": run(fleet.door(door_ids[0]))})
+        except Exception as e:
+            return jsonify({"ok": False, "error": "Device error: " + str(e)}), 500
+    results, elapsed = fleet.fan_out(door_ids, run, FLEET_TIMEOUT)
+    failed = sorted(d for d, r in results.items() if not r.get("ok", True))
+    return jsonify({"ok": not failed, "action": action, "doors": results, "failed": failed,
+                    "elapsed_ms": round(elapsed * 1000, 1)})
+
+def door_status(door):
+    device, error, age = fleet.cache(door.id).get()
+    if error:
+        return {"ok": False, "error": "Device error: " + error}
+    return {"ok": True, "device": device, "age_ms": int(age * 1000)}
 
 @app.route("/status", methods=["GET"])
 def status():
+    selector = request.args.get("door")
+    if selector == "all" or (selector and "," in selector):
+        try:
+            door_ids = fleet.resolve("all" if selector == "all" else selector.split(","))
+        except UnknownDoor as e:
+            return jsonify({"ok": False, "error": f"Unknown door: {e.args[0]}"}), 404
+        results, elapsed = fleet.fan_out(door_ids, door_status, FLEET_TIMEOUT)
+        return jsonify({"ok": all(r["ok"] for r in results.values()), "doors": results,
+                        "elapsed_ms": round(elapsed * 1000, 1)})
     try:
-        url = f"http://{DEVICE_IP}/status?key={DEVICE_API_KEY}"
-        res = requests.get(url, timeout=5)
-        return jsonify({"ok": True, "device": res.json()})
-    except Exception as e:
-        return jsonify({"ok": False, "error": "Device error: " + str(e)}), 500
-
-if __name__ == "__main__":
-    port = int(os.environ.get("PORT", 5000))
-    app.run(host="0.0.0.0", port=port, debug=True)
-
-
-
-
-
-
+        door = fleet.door(selector)
+    except UnknownDoor as e:
+        return jsonify({"ok": False, "error": f"Unknown door: {e.args[0]}"}), 404
+    result = door_status(door)
+    return jsonify({**result, "door": door.id}), 200 if result["ok"] else 500
+
+@app.route("/doors", methods=["GET"])
+def doors():
+    denied = require_session()
+    if denied:
+        return denied
+    return jsonify({"ok": True, "default": fleet.default,
+                    "doors": [{**d.to_dict(), "breaker": fleet.client(d.id).breaker.state} for d in fleet.doors.values()]})
+
+@app.route("/status/stream", methods=["GET"])
+def status_stream():
+    # Server-sent events: push the status whenever it changes instead of
+    # having the browser poll. Each connection holds a worker thread, so
+    # connections are recycled after STATUS_STREAM_MAX seconds (EventSource
+    # reconnects on its own).
+    try:
+        cache = fleet.cache(request.args.get("door"))
+    except UnknownDoor as e:
+        return jsonify({"ok": False, "error": f"Unknown door: {e.args[0]}"}), 404
+
+    def events():
+        last_version = -1
+        deadline = time.time() + STATUS_STREAM_MAX
+        while time.time() < deadline:
+            device, error, _ = cache.get()
+            if cache.version != last_version:
+                last_version = cache.version
+                payload = {"ok": False, "error": "Device error: " + error} if error else {"ok": True, "device": device}
+                yield f"data: {json.dumps(payload)}\n\n"
+            else:
+                yield ": keep-alive\n\n"
+            time.sleep(max(STATUS_CACHE_TTL, 0.5))
 
+    return Response(stream_with_context(events()), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
+def inference_server_stats():
+    try:
+        return face_engine.stats()
+    except InferenceError as e:
+        return {"error": str(e)}
+
+@app.route("/face_stats", methods=["GET"])
+def face_stats():
+    denied = require_session()
+    if denied:
+        return denied
+    return jsonify({
+        "ok": True,
+        "engine_ready": face_engine.ready,
+        "detect_mode": FACE_DETECT_MODE,
+        "detector_paths": dict(face_engine.path_counts),
+        "inference": FACE_INFERENCE,
+        "batching": face_batcher.stats() if face_batcher is not None else None,
+        "inference_server": inference_server_stats() if REMOTE_INFERENCE else None,
+        "identities": len(face_gallery),
+        "embeddings": face_gallery.row_count(),
+        "ann": face_gallery.use_ann(),
+    })
 
+@app.route("/device_stats", methods=["GET"])
+def device_stats():
+    denied = require_session()
+    if denied:
+        return denied
+    clients = {"device": device_client.stats()}
+    if qr_device_client is not device_client:
+        clients["qr_display"] = qr_device_client.stats()
+    return jsonify({"ok": True, "status_cache": status_cache.stats(), "fleet": fleet.stats(), **clients})
+
+@app.route("/session_stats", methods=["GET"])
+def session_stats():
+    denied = require_session()
+    if denied:
+        return denied
+    return jsonify({
+        "ok": True,
+        "backend": state_backend.name,
+        "sessions": sessions.stats(),
+        "qr_sessions": qr_sessions.stats(),
+        "qr_approval_requests": qr_approval_requests.stats(),
+    })
 
+def query_time(name):
+    value = request.args.get(name)
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
+
+@app.route("/events", methods=["GET"])
+def events_query():
+    # Audit log query; needs a logged-in session like /control.
+    denied = require_session()
+    if denied:
+        return denied
+    try:
+        since, until = query_time("since"), query_time("until")
+    except ValueError:
+        return jsonify({"ok": False, "error": "since/until must be epoch seconds or ISO 8601"}), 400
+    types = [t for v in request.args.getlist("type") for t in v.split(",") if t] or None
+    try:
+        limit = max(1, min(int(request.args.get("limit", 100)), 1000))
+    except ValueError:
+        return jsonify({"ok": False, "error": "limit must be an integer"}), 400
+    match = {}
+    for key in ("method", "ip", "user", "result", "action", "endpoint", "decision"):
+        if key in request.args:
+            match[key] = request.args[key]
+    if "ok" in request.args:
+        match["ok"] = request.args["ok"].lower() in ("1", "true", "yes")
+    start = time.perf_counter()
+    events = event_log.query(since, until, types, limit, request.args.get("order", "desc") != "asc", **match)
+    return jsonify({"ok": True, "events": events, "count": len(events),
+                    "query_ms": round((time.perf_counter() - start) * 1000, 1)})
+
+@app.route("/event_stats", methods=["GET"])
+def event_stats():
+    denied = require_session()
+    if denied:
+        return denied
+    return jsonify({"ok": True, "events": event_log.stats()})
+
+@app.route("/evidence", methods=["GET"])
+def evidence_query():
+    # One incident with its images (?incident=ID), or recent incidents.
+    denied = require_session()
+    if denied:
+        return denied
+    incident_id = request.args.get("incident")
+    if incident_id:
+        incident = evidence.incident(incident_id)
+        if incident is None:
+            return jsonify({"ok": False, "error": "Unknown incident"}), 404
+        return jsonify({"ok": True, "incident": incident})
+    try:
+        since, until = query_time("since"), query_time("until")
+    except ValueError:
+        return jsonify({"ok": False, "error": "since/until must be epoch seconds or ISO 8601"}), 400
+    try:
+        limit = max(1, min(int(request.args.get("limit", 50)), 500))
+    except ValueError:
+        return jsonify({"ok": False, "error": "limit must be an integer"}), 400
+    match = {key: request.args[key] for key in ("ip", "method", "user", "name") if key in request.args}
+    incidents = evidence.find(since, until, request.args.get("kind"), limit, **match)
+    return jsonify({"ok": True, "incidents": incidents, "count": len(incidents)})
+
+@app.route("/evidence/<image_id>", methods=["GET"])
+def evidence_image(image_id):
+    denied = require_session()
+    if denied:
+        return denied
+    image = evidence.image(image_id)
+    if image is None:
+        return jsonify({"ok": False, "error": "Unknown or expired image"}), 404
+    # Legacy snapshots were indexed without a thumbnail.
+    rel = (image.get("thumb") or image["path"]) if request.args.get("size") == "thumb" else image["path"]
+    evidence.wait_written(os.path.join(evidence.directory, rel))
+    return send_from_directory(os.path.abspath(evidence.directory), rel, mimetype="image/jpeg")
+
+@app.route("/evidence_stats", methods=["GET"])
+def evidence_stats():
+    denied = require_session()
+    if denied:
+        return denied
+    return jsonify({"ok": True, "evidence": evidence.stats()})
+
+@app.route("/auth_stats", methods=["GET"])
+def auth_stats():
+    denied = require_session()
+    if denied:
+        return denied
+    return jsonify({"ok": True, "limiter": auth_limiter.stats(), "alerts": alert_rollup.stats()})
+
+@app.route("/mail_stats", methods=["GET"])
+def mail_stats():
+    denied = require_session()
+    if denied:
+        return denied
+    return jsonify({"ok": True, "mail": mail_dispatcher.stats()})
+
+# ------------------ Metrics and profiling ------------------
+metrics.gauge("smartlock_state_entries", "Live entries per auth state namespace", ("namespace",),
+              fn=lambda: {(ns.ns,): ns.stats()["live"] for ns in (sessions, qr_sessions, qr_approval_requests, otp_store)})
+metrics.gauge("smartlock_queue_depth", "Items waiting in background queues", ("queue",),
+              fn=lambda: {("mail",): mail_dispatcher.queue_depth(), ("events",): event_log.queue_depth(),
+                          ("evidence",): evidence.queue_depth(),
+                          ("face_batch",): face_batcher.queue_depth() if face_batcher is not None else None})
+metrics.gauge("smartlock_face_gallery_identities", "Enrolled identities in this worker's gallery",
+              fn=lambda: len(face_gallery))
+metrics.gauge("smartlock_evidence_bytes", "Bytes of intruder images and thumbnails kept",
+              fn=lambda: evidence.stats()["bytes"])
+metrics.gauge("smartlock_face_engine_ready", "1 once the face model is loaded", fn=lambda: int(face_engine.ready))
+
+
+@app.before_request
+def start_request_timer():
+    request.environ["smartlock.start"] = time.perf_counter()
+    # Compared as bytes: compare_digest raises TypeError on non-ASCII str.
+    if PROFILE_TOKEN and secrets.compare_digest(request.headers.get("X-Profile", "").encode("latin-1", "replace"),
+                                                PROFILE_TOKEN.encode("latin-1", "replace")):
+        request.environ["smartlock.profiler"] = SamplingProfiler(interval=PROFILE_INTERVAL_MS / 1000.0).start()
+
+@app.after_request
+def finish_request_timer(response):
+    start = request.environ.get("smartlock.start")
+    if start is not None and request.endpoint != "metrics_endpoint":
+        REQUEST_SECONDS.observe(time.perf_counter() - start, endpoint=request.endpoint or "unknown",
+                                status=response.status_code)
+    profiler = request.environ.pop("smartlock.profiler", None)
+    if profiler is not None:
+        profiler.stop()
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        path = os.path.join(PROFILE_DIR, f"{int(time.time() * 1000)}-{request.endpoint or 'unknown'}.folded")
+        with open(path, "w") as f:
+            f.write(profiler.folded())
+        print(f"[INFO] Profiled {request.path} for {profiler.elapsed * 1000:.1f}ms "
+              f"({profiler.samples} samples) -> {path}; top: {profiler.top(5)}")
+        response.headers["X-Profile-Samples"] = str(profiler.samples)
+        response.headers["X-Profile-File"] = os.path.basename(path)
+    return response
+
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+atexit.register(mail_dispatcher.stop)
+atexit.register(event_log.stop)
+atexit.register(evidence.stop)
+atexit.register(camera.stop)
+atexit.register(fleet.shutdown)
+if face_batcher is not None:
+    atexit.register(face_batcher.stop)
 
+if __name__ == "__main__":
+    port = int(os.environ.get("PORT", 5000))
+    app.run(host="0.0.0.0", port=port, debug=True)
@@ -0,0 +1,93 @@
+"""Recall/latency of the IVF index against the exact gallery scan.
+
+Builds synthetic galleries (identities with a few noisy embeddings each,
+like real enrollments), then times identify() on the exact path and
+IVFIndex.search() at several nprobe settings. Use the output to pick
+ANN_MIN_ROWS (the crossover) and ANN_NPROBE.
+
+    python bench/ann_bench.py --sizes 1000 10000 50000 --json ann.json
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ann_index import IVFIndex  # noqa: E402
+from gallery import FaceGallery  # noqa: E402
+
+
+def synthetic(identities, per_user, dim, noise, rng):
+    centers = rng.standard_normal((identities, dim)).astype(np.float32)
+    rows = centers[:, None, :] + noise * rng.standard_normal((identities, per_user, dim)).astype(np.float32)
+    return centers, rows
+
+
+def timed(fn, probes):
+    out = []
+    start = time.perf_counter()
+    for p in probes:
+        out.append(fn(p))
+    return out, (time.perf_counter() - start) / len(probes) * 1000
+
+
+def run(size, per_user, dim, queries, nprobes, noise, seed):
+    rng = np.random.default_rng(seed)
+    identities = max(1, size // per_user)
+    centers, rows = synthetic(identities, per_user, dim, noise, rng)
+    gallery = FaceGallery(dim=dim, capacity=identities * per_user)
+    for i in range(identities):
+        gallery.add(f"id{i}", rows[i])
+    truth_ids = rng.integers(0, identities, queries)
+    probes = centers[truth_ids] + noise * rng.standard_normal((queries, dim)).astype(np.float32)
+
+    exact, exact_ms = timed(lambda p: gallery.identify(p, k=5)["user"], probes)
+    exact_top10, _ = timed(lambda p: [lab for lab, _ in gallery.match(p, k=10)], probes)
+
+    start = time.perf_counter()
+    index = IVFIndex.train(rows.reshape(-1, dim))
+    index.add_many({f"id{i}": rows[i] for i in range(identities)})
+    build_s = time.perf_counter() - start
+
+    result = {"rows": identities * per_user, "identities": identities, "exact_ms": round(exact_ms, 3),
+              "nlist": len(index.centroids), "build_s": round(build_s, 2), "ivf": []}
+    for nprobe in nprobes:
+        approx, ms = timed(lambda p: index.search(p, k=10, nprobe=nprobe), probes)
+        recall1 = np.mean([a[0][0] == e for a, e in zip(approx, exact)])
+        recall10 = np.mean([len({lab for lab, _ in a} & set(t)) / max(1, len(set(t)))
+                            for a, t in zip(approx, exact_top10)])
+        result["ivf"].append({"nprobe": nprobe, "ms": round(ms, 3), "recall@1": round(float(recall1), 4),
+                              "recall@10": round(float(recall10), 4), "speedup": round(exact_ms / ms, 2)})
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 50000, 100000])
+    parser.add_argument("--per-user", type=int, default=4)
+    parser.add_argument("--dim", type=int, default=128)  # Facenet
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[1, 4, 8, 16, 32])
+    parser.add_argument("--noise", type=float, default=0.35)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args()
+
+    results = []
+    for size in args.sizes:
+        r = run(size, args.per_user, args.dim, args.queries, args.nprobe, args.noise, args.seed)
+        results.append(r)
+        print(f"rows={r['rows']:>7} exact={r['exact_ms']:.3f}ms nlist={r['nlist']} build={r['build_s']}s")
+        for v in r["ivf"]:
+            print(f"    nprobe={v['nprobe']:>3} {v['ms']:.3f}ms x{v['speedup']:<6} "
+                  f"recall@1={v['recall@1']:.3f} recall@10={v['recall@10']:.3f}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"bench": "ann", "args": vars(args), "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+"""Load test for face-login inference: per-request vs. micro-batched.
+
+In-process mode (default) builds the face engine and drives it from
+``--clients`` concurrent threads, first calling analyze() per request like
+the unbatched /face-login path, then going through MicroBatcher. With
+``--url`` it instead posts JPEG frames to a running server's /face-login
+(start it once with FACE_BATCHING=0 and once with FACE_BATCHING=1).
+
+    python bench/face_load.py --images registered_faces/alice --clients 16 --requests 20
+    python bench/face_load.py --url http://localhost:5000 --clients 16
+"""
+import argparse
+import glob
+import json
+import os
+import sys
+import threading
+import time
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from batcher import MicroBatcher  # noqa: E402
+from face_engine import FaceEngine  # noqa: E402
+
+
+def load_frames(pattern_dir, count=8):
+    paths = sorted(glob.glob(os.path.join(pattern_dir, "*.jpg")) + glob.glob(os.path.join(pattern_dir, "*.png")))
+    frames = [f for f in (cv2.imread(p) for p in paths[:count]) if f is not None]
+    if frames:
+        return frames
+    rng = np.random.default_rng(0)
+    return [rng.integers(0, 255, (480, 640, 3), dtype=np.uint8) for _ in range(count)]
+
+
+def drive(call, frames, clients, per_client):
+    """Run clients threads doing per_client calls each; returns latencies (s), errors, wall time."""
+    latencies, errors = [], [0]
+    lock = threading.Lock()
+    barrier = threading.Barrier(clients + 1)
+
+    def client(c):
+        barrier.wait()
+        for i in range(per_client):
+            frame = frames[(c + i) % len(frames)]
+            start = time.perf_counter()
+            try:
+                call(frame)
+                ok = True
+            except Exception:
+                ok = False
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+                errors[0] += not ok
+
+    threads = [threading.Thread(target=client, args=(c,)) for c in range(clients)]
+    for t in threads:
+        t.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for t in threads:
+        t.join()
+    return latencies, errors[0], time.perf_counter() - start
+
+
+def summarize(name, latencies, errors, wall):
+    lat = np.array(latencies) * 1000
+    out = {
+        "mode": name,
+        "requests": len(lat),
+        "errors": errors,
+        "throughput_rps": round(len(lat) / wall, 2),
+        "p50_ms": round(float(np.percentile(lat, 50)), 1),
+        "p99_ms": round(float(np.percentile(lat, 99)), 1),
+    }
+    print(f"{name:>12}: {out['throughput_rps']:8.2f} req/s  p50={out['p50_ms']:7.1f}ms  "
+          f"p99={out['p99_ms']:7.1f}ms  errors={errors}")
+    return out
+
+
+def http_call(url):
+    import requests
+
+    local = threading.local()  # one keep-alive session per client thread
+
+    def call(frame):
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+        ok, buf = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, 85])
+        r = local.session.post(url.rstrip("/") + "/face-login", data=buf.tobytes(),
+                               headers={"Content-Type": "image/jpeg"}, timeout=60)
+        if r.status_code >= 500:
+            raise RuntimeError(r.status_code)
+    return call
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--images", default="", help="folder of probe frames (default: random frames)")
+    parser.add_argument("--url", help="load-test a running server instead of the in-process engine")
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=10, help="per client")
+    parser.add_argument("--batch", type=int, default=8)
+    parser.add_argument("--wait-ms", type=float, default=5.0)
+    parser.add_argument("--model", default=os.getenv("FACE_MODEL", "Facenet"))
+    parser.add_argument("--detector", default=os.getenv("DETECTOR_BACKEND", "mtcnn"))
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args()
+
+    frames = load_frames(args.images)
+    results = []
+    if args.url:
+        lat, err, wall = drive(http_call(args.url), frames, args.clients, args.requests)
+        results.append(summarize("http", lat, err, wall))
+    else:
+        # Random frames have no face; don't let that turn every call into an error.
+        enforce = bool(args.images)
+        engine = FaceEngine(args.model, args.detector)
+        engine.warmup()
+        lat, err, wall = drive(lambda f: engine.analyze(f, enforce_detection=enforce),
+                               frames, args.clients, args.requests)
+        results.append(summarize("per-request", lat, err, wall))
+
+        batcher = MicroBatcher(lambda fs: engine.analyze_batch(fs, enforce_detection=enforce),
+                               max_batch=args.batch, max_wait_ms=args.wait_ms)
+        lat, err, wall = drive(batcher.submit, frames, args.clients, args.requests)
+        results.append(summarize("batched", lat, err, wall))
+        stats = batcher.stats()
+        batcher.stop()
+        print(f"{'':>12}  avg batch={stats.get('avg_batch')} sizes={stats['batch_sizes']}")
+        results[-1]["batcher"] = stats
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"bench": "face_load", "args": vars(args), "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+"""A pool of local fake lock controllers, and a fleet fan-out benchmark.
+
+Each fake door is a threaded HTTP server on 127.0.0.1 answering the
+controller's /control and /status endpoints (API key checked) after a
+configurable delay; --slow and --dead make some doors lag or drop
+requests so timeouts and circuit breakers can be exercised.
+
+Serve a pool and write the matching DOORS_CONFIG, then point the app at it:
+
+    python bench/fake_devices.py --doors 30 --latency-ms 150 --config doors.json
+    DOORS_CONFIG=doors.json python app.py
+
+Or compare sequential calls with the fleet's fan-out in one go:
+
+    python bench/fake_devices.py --doors 30 --latency-ms 150 --bench --json fleet.json
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from device_client import DeviceClient  # noqa: E402
+from fleet import DeviceFleet, load_doors  # noqa: E402
+
+
+class FakeDoor(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, key, latency, jitter=0.0, dead=False):
+        super().__init__(("127.0.0.1", 0), FakeDoorHandler)
+        self.key = key
+        self.latency = latency
+        self.jitter = jitter
+        self.dead = dead
+        self.state = "locked"
+        self.requests = 0
+
+
+class FakeDoorHandler(BaseHTTPRequestHandler):
+    def log_message(self, fmt, *args):
+        pass
+
+    def _reply(self, code, body):
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _delay(self):
+        srv = self.server
+        srv.requests += 1
+        if srv.dead:
+            time.sleep(3600)  # accept, then never answer: a hung controller
+        time.sleep(max(0.0, srv.latency + random.uniform(-srv.jitter, srv.jitter)))
+
+    def do_GET(self):
+        self._delay()
+        url = urlparse(self.path)
+        if url.path != "/status":
+            return self._reply(404, {"ok": False, "error": "not found"})
+        if parse_qs(url.query).get("key", [""])[0] != self.server.key:
+            return self._reply(403, {"ok": False, "error": "bad key"})
+        self._reply(200, {"ok": True, "state": self.server.state})
+
+    def do_POST(self):
+        self._delay()
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if self.path != "/control":
+            return self._reply(404, {"ok": False, "error": "not found"})
+        if body.get("key") != self.server.key:
+            return self._reply(403, {"ok": False, "error": "bad key"})
+        self.server.state = "unlocked" if body.get("action") == "unlock" else "locked"
+        self._reply(200, {"ok": True, "state": self.server.state})
+
+
+def start_pool(n, latency, jitter=0.0, slow=0, slow_latency=1.0, dead=0):
+    """Start n fake doors; returns (servers, registry dict for DOORS_CONFIG)."""
+    servers, registry = [], {}
+    for i in range(n):
+        is_dead = i >= n - dead
+        is_slow = not is_dead and i >= n - dead - slow
+        srv = FakeDoor(f"key-{i}", slow_latency if is_slow else latency, jitter, dead=is_dead)
+        threading.Thread(target=srv.serve_forever, name=f"fake-door-{i}", daemon=True).start()
+        servers.append(srv)
+        registry[f"door{i:02d}"] = {"url": f"http://127.0.0.1:{srv.server_address[1]}", "key": srv.key,
+                                    "name": f"Door {i}"}
+    return servers, registry
+
+
+def bench(registry, rounds, connect_timeout, read_timeout, max_workers):
+    def make_client(door):
+        return DeviceClient(door.url, connect_timeout=connect_timeout, read_timeout=read_timeout)
+
+    def fetch(door, client):
+        return client.get("/status", params={"key": door.key}).json()
+
+    def control(door, action):
+        return fleet.client(door.id).post("/control", json={"action": action, "key": door.key}).json()
+
+    fleet = DeviceFleet(load_doors(json.dumps(registry)), make_client, fetch, status_max_age=0,
+                        max_workers=max_workers)
+    timeout = connect_timeout + read_timeout + 0.5
+    results = []
+    for mode in ("sequential", "fan_out"):
+        times, failures = [], 0
+        for r in range(rounds):
+            action = "close" if r % 2 else "unlock"
+            start = time.perf_counter()
+            if mode == "sequential":
+                for door in fleet.doors.values():
+                    try:
+                        control(door, action)
+                    except Exception:
+                        failures += 1
+            else:
+                out, _ = fleet.fan_out(list(fleet.doors), lambda d: control(d, action), timeout)
+                failures += sum(1 for v in out.values() if not v.get("ok"))
+            times.append(time.perf_counter() - start)
+        row = {"mode": mode, "doors": len(fleet.doors), "rounds": rounds, "failures": failures,
+               "avg_ms": round(sum(times) / len(times) * 1000, 1), "max_ms": round(max(times) * 1000, 1)}
+        print(f"{mode:>12}: {row['avg_ms']:8.1f}ms per all-doors call (max {row['max_ms']}ms, failures={failures})")
+        results.append(row)
+    fleet.shutdown()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--doors", type=int, default=10)
+    parser.add_argument("--latency-ms", type=float, default=100)
+    parser.add_argument("--jitter-ms", type=float, default=20)
+    parser.add_argument("--slow", type=int, default=0, help="doors answering after --slow-ms")
+    parser.add_argument("--slow-ms", type=float, default=1500)
+    parser.add_argument("--dead", type=int, default=0, help="doors that accept and never answer")
+    parser.add_argument("--config", help="write the DOORS_CONFIG JSON here and serve until interrupted")
+    parser.add_argument("--bench", action="store_true", help="compare sequential vs. fan-out and exit")
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--read-timeout", type=float, default=3.0)
+    parser.add_argument("--max-workers", type=int, default=32)
+    parser.add_argument("--json", help="write bench results to this file")
+    args = parser.parse_args()
+
+    servers, registry = start_pool(args.doors, args.latency_ms / 1000, args.jitter_ms / 1000,
+                                   args.slow, args.slow_ms / 1000, args.dead)
+    if args.config:
+        with open(args.config, "w") as f:
+            json.dump(registry, f, indent=2)
+        print(f"[INFO] {args.doors} fake doors up; registry written to {args.config}")
+    if args.bench:
+        results = bench(registry, args.rounds, 1.0, args.read_timeout, args.max_workers)
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump({"bench": "fleet", "args": vars(args), "results": results}, f, indent=2)
+        return
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        for srv in servers:
+            srv.shutdown()
+
+
+if __name__ == "__main__":
+    main()
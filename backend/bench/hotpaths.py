@@ -0,0 +1,439 @@
+"""Latency, throughput and accuracy benchmarks for the unlock hot paths.
+
+Runs the real app in-process (Flask test client) with SMTP, camera and
+lock device replaced by stubs, so results depend only on this code, the
+installed DeepFace/TF and the FACE_* / DETECTOR_* settings. Sections:
+
+  http      /auth, /control, /status and /face-login through the test client
+  embed     FaceEngine.analyze() per frame
+  match     FaceGallery.identify() at 10 .. 100k synthetic identities
+  load      legacy embeddings.json parse vs. the binary store load
+  accuracy  FAR/FRR over a labelled image set (<dir>/<user>/*.jpg;
+            folders starting with "_" are impostors that are never enrolled),
+            probing through the full detector and the cascade fast path
+
+Results go to --json; --compare prints the relative change of every
+timing and error-rate metric against an earlier run, e.g. before and
+after a DeepFace upgrade:
+
+    python bench/hotpaths.py --dataset faces_eval --json before.json
+    FACE_MODEL=ArcFace python bench/hotpaths.py --dataset faces_eval --json after.json --compare before.json
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import threading
+import time
+
+import cv2
+import numpy as np
+import requests
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+BACKEND_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BACKEND_DIR)
+from ann_bench import synthetic  # noqa: E402
+from face_load import drive, load_frames, summarize  # noqa: E402
+from gallery import FaceGallery, reduce_embeddings  # noqa: E402
+
+SECTIONS = ("http", "embed", "match", "load", "accuracy")
+
+
+# ---- stubs -------------------------------------------------------------
+class StubSMTP:
+    """Stands in for an smtplib connection; sendmail just sleeps."""
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.sent = 0
+
+    def sendmail(self, from_addr, to_addr, payload):
+        time.sleep(self.delay)
+        self.sent += 1
+
+    def quit(self):
+        pass
+
+    close = quit
+
+
+class StubCamera:
+    """No capture hardware: a fixed frame; every snapshot taken is counted."""
+
+    def __init__(self):
+        self.snapshots = 0
+        self.frame = np.zeros((480, 640, 3), dtype=np.uint8)
+
+    def latest(self, wait=1.5, max_age=None):
+        self.snapshots += 1
+        return self.frame.copy()
+
+    def clip(self, n=None):
+        return [(time.time(), self.frame.copy())] * (1 if n is None else n)
+
+    def frames(self, duration, wait=1.5):
+        return iter(())
+
+
+class StubDevice(requests.adapters.BaseAdapter):
+    """Transport adapter answering every device call with a canned JSON reply."""
+
+    def __init__(self, latency):
+        super().__init__()
+        self.latency = latency
+        self.calls = 0
+
+    def send(self, request, **kwargs):
+        time.sleep(self.latency)
+        self.calls += 1
+        res = requests.Response()
+        res.status_code = 200
+        res.headers["Content-Type"] = "application/json"
+        res._content = json.dumps({"ok": True, "state": "locked", "door": "closed"}).encode()
+        res.url = request.url
+        res.request = request
+        return res
+
+    def close(self):
+        pass
+
+
+def load_app(workdir, smtp_delay, device_latency):
+    """Import app.py inside workdir with limits opened up and external I/O stubbed."""
+    os.chdir(workdir)
+    for key, value in {
+        "FACE_WARMUP": "0", "ENROLL_WORKERS": "0", "CAMERA_PRESTART": "0", "STATE_BACKEND": "memory",
+        "EMAIL_USER": "bench@example.com", "EMAIL_PASS": "bench", "REGISTERED_EMAIL": "bench@example.com",
+        # The limiter would otherwise throttle the benchmark itself.
+        "AUTH_IP_RATE": "1e9", "AUTH_IP_BURST": "1000000000", "AUTH_METHOD_RATE": "1e9",
+        "AUTH_METHOD_BURST": "1000000000", "AUTH_MAX_FAILURES": "1000000000",
+    }.items():
+        os.environ.setdefault(key, value)
+    import app
+
+    smtp = StubSMTP(smtp_delay)
+    app.mail_dispatcher._connect = lambda: smtp
+    app.camera = StubCamera()
+    device = StubDevice(device_latency)
+    for client in {app.device_client, app.qr_device_client}:
+        client.session.mount("http://", device)
+        client.session.mount("https://", device)
+    return app, {"smtp": smtp, "device": device}
+
+
+# ---- sections ----------------------------------------------------------
+def bench_http(app, frames, clients, per_client):
+    local = threading.local()
+
+    def client():
+        if not hasattr(local, "client"):
+            local.client = app.app.test_client()
+        return local.client
+
+    def expect(res, *codes):
+        if res.status_code not in codes:
+            raise RuntimeError(f"HTTP {res.status_code}: {res.get_data(as_text=True)[:200]}")
+        return res
+
+    token = expect(client().post("/auth", json={"method": "pin", "value": app.AUTH_PIN}), 200).json["token"]
+    # Enroll the probe frames as one user so face-login runs a full match.
+    vec, _ = app.face_engine.analyze(frames[0], enforce_detection=False, fast=False)
+    app.save_embeddings("bench", [vec])
+    jpegs = [cv2.imencode(".jpg", f, [cv2.IMWRITE_JPEG_QUALITY, 85])[1].tobytes() for f in frames]
+    pins = [app.AUTH_PIN if i % 2 else "0000" for i in range(8)]
+
+    cases = [
+        ("auth_pin", pins, lambda pin: expect(client().post("/auth", json={"method": "pin", "value": pin}), 200, 401)),
+        ("control", ["unlock", "close"], lambda action: expect(client().post(
+            "/control", json={"action": action}, headers={"Authorization": "Bearer " + token}), 200)),
+        ("status", [None], lambda _: expect(client().get("/status"), 200)),
+        ("face_login", jpegs, lambda jpg: expect(client().post(
+            "/face-login", data=jpg, content_type="image/jpeg"), 200, 400, 401)),
+    ]
+    results = []
+    for name, items, call in cases:
+        call(items[0])  # first call pays lazy imports / model build
+        results.append(summarize(name, *drive(call, items, clients, per_client)))
+    return results
+
+
+def bench_embed(app, frames, requests_):
+    app.face_engine.load()
+    lat, err, wall = drive(lambda f: app.face_engine.analyze(f, enforce_detection=False), frames, 1, requests_)
+    out = summarize("embed", lat, err, wall)
+    out["detector_paths"] = dict(app.face_engine.path_counts)
+    return [out]
+
+
+def bench_match(sizes, per_user, dim, queries, k, seed=0):
+    results = []
+    for identities in sizes:
+        rng = np.random.default_rng(seed)
+        centers, rows = synthetic(identities, per_user, dim, 0.3, rng)
+        gallery = FaceGallery(dim=dim, capacity=identities * per_user)
+        for i in range(identities):
+            gallery.add(f"id{i}", rows[i])
+        probes = centers[rng.integers(0, identities, queries)]
+        gallery.identify(probes[0], k=k)
+        lat = []
+        start = time.perf_counter()
+        for p in probes:
+            t = time.perf_counter()
+            gallery.identify(p, k=k)
+            lat.append(time.perf_counter() - t)
+        out = summarize(f"match@{identities}", lat, 0, time.perf_counter() - start)
+        out.update(identities=identities, rows=identities * per_user)
+        results.append(out)
+    return results
+
+
+def bench_load(sizes, dim, workdir, seed=0):
+    from embedding_store import EmbeddingStore
+
+    results = []
+    for identities in sizes:
+        rng = np.random.default_rng(seed)
+        data = {f"id{i}": rng.standard_normal(dim).round(6).tolist() for i in range(identities)}
+        path = os.path.join(workdir, f"load_{identities}.json")
+        with open(path, "w") as f:
+            json.dump(data, f)
+
+        t = time.perf_counter()
+        with open(path) as f:
+            FaceGallery.from_dict({k: np.asarray(v, dtype=np.float32) for k, v in json.load(f).items()})
+        json_ms = (time.perf_counter() - t) * 1000
+
+        store = EmbeddingStore(os.path.join(workdir, f"load_{identities}"))
+        t = time.perf_counter()
+        store.migrate_from_json(path)
+        migrate_ms = (time.perf_counter() - t) * 1000
+
+        t = time.perf_counter()
+        FaceGallery.from_dict(EmbeddingStore(store.prefix).load())
+        store_ms = (time.perf_counter() - t) * 1000
+        out = {"mode": f"load@{identities}", "identities": identities, "json_bytes": os.path.getsize(path),
+               "json_load_ms": round(json_ms, 1), "migrate_ms": round(migrate_ms, 1),
+               "store_load_ms": round(store_ms, 1)}
+        print(f"{out['mode']:>12}: json={json_ms:8.1f}ms  store={store_ms:8.1f}ms  migrate={migrate_ms:8.1f}ms")
+        results.append(out)
+    return results
+
+
+def accuracy_engine(app):
+    """An in-process engine with the Haar cascade attached, whatever FACE_DETECT_MODE/FACE_INFERENCE say."""
+    from face_engine import FaceEngine
+
+    engine = app.face_engine
+    if not isinstance(engine, FaceEngine) or engine.cascade is None:
+        engine = FaceEngine(app.FACE_MODEL, app.DETECTOR_BACKEND, detect_mode="cascade",
+                            fast_min_weight=app.FAST_DETECT_MIN_WEIGHT, fast_min_size=app.FAST_DETECT_MIN_SIZE)
+    return engine
+
+
+def error_rates(gallery, enrolled, probes, threshold, margin, topk):
+    """Verification FAR/FRR over a threshold sweep, plus identification at threshold/margin."""
+    genuine, impostor_scores = [], []
+    ident = {"genuine": 0, "correct_accept": 0, "wrong_accept": 0, "impostor": 0, "impostor_accept": 0}
+    for person, vec in probes:
+        known = person in enrolled
+        ident["genuine" if known else "impostor"] += 1
+        if vec is None:
+            if known:
+                genuine.append(np.inf)  # failure to acquire counts as a false reject
+            continue
+        dists, labels = gallery.distances(vec)
+        best = {}
+        for d, label in zip(dists.tolist(), labels):
+            best[label] = min(d, best.get(label, np.inf))
+        for label, d in best.items():
+            (genuine if label == person else impostor_scores).append(d)
+        m = gallery.identify(vec, k=topk)
+        accepted = m["distance"] <= threshold and (m["margin"] is None or m["margin"] >= margin)
+        if accepted and m["user"] == person:
+            ident["correct_accept"] += 1
+        elif accepted and known:
+            ident["wrong_accept"] += 1
+        elif accepted:
+            ident["impostor_accept"] += 1
+
+    genuine, impostor_scores = np.array(genuine), np.array(impostor_scores)
+    sweep = []
+    for t in sorted(set(np.round(np.linspace(0.05, 0.9, 18), 3).tolist() + [threshold])):
+        far = float(np.mean(impostor_scores <= t)) if len(impostor_scores) else 0.0
+        frr = float(np.mean(genuine > t)) if len(genuine) else 0.0
+        sweep.append({"threshold": t, "far": round(far, 4), "frr": round(frr, 4)})
+    eer = min(sweep, key=lambda s: abs(s["far"] - s["frr"]))
+    at = next(s for s in sweep if s["threshold"] == threshold)
+    return {
+        "threshold": threshold, "far": at["far"], "frr": at["frr"],
+        "eer": round((eer["far"] + eer["frr"]) / 2, 4), "eer_threshold": eer["threshold"],
+        "identification": {
+            **ident, "margin": margin,
+            "frr": round(1 - ident["correct_accept"] / max(1, ident["genuine"]), 4),
+            "far": round((ident["wrong_accept"] + ident["impostor_accept"]) / max(1, len(probes)), 4),
+        },
+        "sweep": sweep,
+    }
+
+
+def bench_accuracy(app, root, enroll_per_user, threshold, margin):
+    """FAR/FRR with probes through the full detector and through the Haar fast path.
+
+    Enrollment always uses the full detector (as the app does). The
+    "accuracy_cascade" row probes with fast=True, i.e. cascade crops embedded
+    without re-detection, which is also what the streaming unlock matches.
+    """
+    engine = accuracy_engine(app)
+    exts = (".jpg", ".jpeg", ".png")
+    people = sorted(d for d in os.listdir(root) if os.path.isdir(os.path.join(root, d)))
+
+    def embed(bgr, fast):
+        if bgr is None:
+            return None, None
+        try:
+            vec, info = engine.analyze(bgr, enforce_detection=True, fast=fast)
+        except Exception:
+            return None, None
+        return vec, info.get("path")
+
+    enrolled, probes = {}, {"single": [], "cascade": []}
+    failed, fast_hits = {"single": 0, "cascade": 0}, 0
+    for person in people:
+        paths = sorted(os.path.join(root, person, n) for n in os.listdir(os.path.join(root, person))
+                       if n.lower().endswith(exts))
+        images = [cv2.imread(path) for path in paths]
+        impostor = person.startswith("_")
+        if not impostor:
+            good = [v for v in (embed(bgr, False)[0] for bgr in images[:enroll_per_user]) if v is not None]
+            if good:
+                enrolled[person] = reduce_embeddings(good, app.FACE_MAX_EMBEDDINGS)
+        for bgr in images if impostor else images[enroll_per_user:]:
+            label = None if impostor else person
+            for mode, fast in (("single", False), ("cascade", True)):
+                vec, path = embed(bgr, fast)
+                failed[mode] += vec is None
+                fast_hits += path == "fast"
+                probes[mode].append((label, vec))
+    if not enrolled:
+        raise SystemExit(f"no enrollable faces under {root}")
+
+    gallery = FaceGallery.from_dict(enrolled)
+    rows = []
+    for mode, name in (("single", "accuracy"), ("cascade", "accuracy_cascade")):
+        out = {"mode": name, "identities": len(enrolled), "probes": len(probes[mode]),
+               "failed_to_acquire": failed[mode],
+               **error_rates(gallery, enrolled, probes[mode], threshold, margin, app.FACE_TOPK)}
+        if mode == "cascade":
+            # Probes the cascade was not sure about fell back to the full detector.
+            out["fast_path_share"] = round(fast_hits / max(1, len(probes[mode])), 4)
+        rows.append(out)
+        print(f"{name:>16}: FAR={out['far']:.4f} FRR={out['frr']:.4f} at {threshold} "
+              f"(EER~{out['eer']:.4f} at {out['eer_threshold']}); identification "
+              f"FAR={out['identification']['far']:.4f} FRR={out['identification']['frr']:.4f}"
+              + (f"; fast path {out['fast_path_share']:.0%}" if "fast_path_share" in out else ""))
+    return rows
+
+
+# ---- comparing runs ----------------------------------------------------
+def flatten(results):
+    """{"section/mode/metric": value} for every numeric timing or error-rate metric."""
+    flat = {}
+    for section, rows in results.items():
+        for row in rows:
+            for key, value in row.items():
+                if isinstance(value, (int, float)) and key.endswith(("_ms", "_rps", "far", "frr", "eer")):
+                    flat[f"{section}/{row['mode']}/{key}"] = value
+    return flat
+
+
+def compare(current, baseline_path):
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    old, new = flatten(baseline["results"]), flatten(current["results"])
+    print(f"\nvs. {baseline_path} ({baseline['config'].get('FACE_MODEL')}/{baseline['config'].get('DETECTOR_BACKEND')}):")
+    for key in sorted(old.keys() & new.keys()):
+        a, b = old[key], new[key]
+        change = "n/a" if not a else f"{(b - a) / a * 100:+.1f}%"
+        print(f"  {key:<40} {a:>12} -> {b:<12} {change}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--only", nargs="+", choices=SECTIONS, default=list(SECTIONS))
+    parser.add_argument("--images", default="", help="folder of probe frames (default: random frames)")
+    parser.add_argument("--dataset", help="labelled image set for the accuracy section")
+    parser.add_argument("--enroll-per-user", type=int, default=3)
+    parser.add_argument("--clients", type=int, default=4)
+    parser.add_argument("--requests", type=int, default=25, help="per client")
+    parser.add_argument("--match-sizes", type=int, nargs="+", default=[10, 100, 1000, 10000, 100000])
+    parser.add_argument("--load-sizes", type=int, nargs="+", default=[100, 1000, 10000])
+    parser.add_argument("--per-user", type=int, default=2, help="embeddings per synthetic identity")
+    parser.add_argument("--dim", type=int, default=128)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--smtp-delay-ms", type=float, default=50)
+    parser.add_argument("--device-latency-ms", type=float, default=20)
+    parser.add_argument("--json", help="write results to this file")
+    parser.add_argument("--compare", help="earlier --json output to diff against")
+    args = parser.parse_args()
+    if args.json:
+        args.json = os.path.abspath(args.json)
+    if args.compare:
+        args.compare = os.path.abspath(args.compare)
+    for name in ("images", "dataset"):
+        if getattr(args, name):
+            setattr(args, name, os.path.abspath(getattr(args, name)))
+
+    workdir = tempfile.mkdtemp(prefix="smartlock-bench-")
+    results = {}
+    app = None
+    if {"http", "embed", "accuracy"} & set(args.only):
+        app, stubs = load_app(workdir, args.smtp_delay_ms / 1000, args.device_latency_ms / 1000)
+    frames = load_frames(args.images)
+    if "http" in args.only:
+        results["http"] = bench_http(app, frames, args.clients, args.requests)
+    if "embed" in args.only:
+        results["embed"] = bench_embed(app, frames, args.requests)
+    if "match" in args.only:
+        results["match"] = bench_match(args.match_sizes, args.per_user, args.dim, args.queries,
+                                       int(os.getenv("FACE_TOPK", "5")))
+    if "load" in args.only:
+        results["load"] = bench_load(args.load_sizes, args.dim, workdir)
+    if "accuracy" in args.only and args.dataset:
+        results["accuracy"] = bench_accuracy(app, args.dataset, args.enroll_per_user,
+                                             app.FACE_MATCH_THRESHOLD, app.FACE_MATCH_MARGIN)
+
+    if app is not None:
+        app.mail_dispatcher.stop(timeout=2.0)
+        app.event_log.stop()
+        app.evidence.stop()
+
+    config = {key: os.getenv(key) for key in ("FACE_MODEL", "DETECTOR_BACKEND", "FACE_DETECT_MODE",
+                                               "FACE_MATCH_THRESHOLD", "FACE_MATCH_MARGIN", "FACE_BATCHING")}
+    if app is not None:
+        config.update(FACE_MODEL=app.FACE_MODEL, DETECTOR_BACKEND=app.DETECTOR_BACKEND,
+                      FACE_DETECT_MODE=app.FACE_DETECT_MODE, FACE_MATCH_THRESHOLD=app.FACE_MATCH_THRESHOLD,
+                      FACE_MATCH_MARGIN=app.FACE_MATCH_MARGIN)
+        results.setdefault("stubs", [{"mode": "stubs", "smtp_sent": stubs["smtp"].sent,
+                                      "device_calls": stubs["device"].calls,
+                                      "snapshots": app.camera.snapshots,
+                                      "evidence_incidents": app.evidence.stats()["incidents"]}])
+    versions = {"python": platform.python_version(), "numpy": np.__version__, "opencv": cv2.__version__}
+    try:
+        import deepface
+        versions["deepface"] = getattr(deepface, "__version__", "unknown")
+    except ImportError:
+        pass
+    report = {"bench": "hotpaths", "ts": time.time(), "host": platform.node(), "config": config,
+              "versions": versions, "args": vars(args), "results": results}
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        compare(report, args.compare)
+
+
+if __name__ == "__main__":
+    main()
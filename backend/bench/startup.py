@@ -0,0 +1,104 @@
+"""Cold start and memory of a web worker, with and without the inference server.
+
+Each run imports app.py in a fresh interpreter (what a new gunicorn worker
+does), times the import and the first face-login, and reads the worker's
+RSS before and after. In server mode the RSS of the shared inference
+server is reported once, so the per-deployment total for --workers web
+workers can be compared:
+
+    python bench/startup.py --workers 4 --json startup.json
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+BACKEND_DIR = os.path.dirname(BENCH_DIR)
+
+CHILD = r"""
+import json, os, sys, time
+t0 = time.perf_counter()
+sys.path.insert(0, {backend!r})
+import app
+import_s = time.perf_counter() - t0
+
+def rss_mb(pid="self"):
+    with open(f"/proc/{{pid}}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024.0
+
+rss_boot = rss_mb()
+import numpy as np
+frame = np.random.default_rng(0).integers(0, 255, (480, 640, 3), dtype=np.uint8)
+t1 = time.perf_counter()
+try:
+    app.face_engine.analyze(frame, enforce_detection=False)
+except Exception as e:
+    print("[WARN] first analyze failed:", e, file=sys.stderr)
+first_s = time.perf_counter() - t1
+out = {{"import_s": import_s, "first_face_s": first_s, "rss_boot_mb": rss_boot, "rss_after_mb": rss_mb(),
+        "tensorflow_loaded": "tensorflow" in sys.modules, "deepface_loaded": "deepface" in sys.modules}}
+if app.REMOTE_INFERENCE:
+    server_pid = app.face_engine.stats()["pid"]
+    out["server_pid"] = server_pid
+    out["server_rss_mb"] = rss_mb(server_pid)
+print("RESULT " + json.dumps(out))
+app.event_log.stop()
+"""
+
+
+def run_worker(mode, workdir, socket_path):
+    env = dict(os.environ, FACE_INFERENCE=mode, INFERENCE_SOCKET=socket_path, FACE_WARMUP="0",
+               ENROLL_WORKERS="0", STATE_BACKEND="memory", EVENT_LOG_DIR=os.path.join(workdir, "events"))
+    start = time.perf_counter()
+    proc = subprocess.run([sys.executable, "-c", CHILD.format(backend=BACKEND_DIR)], cwd=workdir, env=env,
+                          capture_output=True, text=True, timeout=600)
+    wall = time.perf_counter() - start
+    line = next((l for l in proc.stdout.splitlines() if l.startswith("RESULT ")), None)
+    if line is None:
+        raise SystemExit(f"{mode} worker failed:\n{proc.stdout}\n{proc.stderr}")
+    result = json.loads(line[len("RESULT "):])
+    result["process_s"] = wall
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, default=4, help="web workers to project memory for")
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="smartlock-startup-")
+    socket_path = os.path.join(workdir, "inference.sock")
+    results = {}
+    for mode, label in (("inprocess", "inprocess"), ("server", "server_cold"), ("server", "server_warm")):
+        # server_cold also pays for starting the server; server_warm is
+        # every later worker, which finds it running.
+        r = results[label] = run_worker(mode, workdir, socket_path)
+        print(f"{label:>12}: import={r['import_s']:.2f}s first_face={r['first_face_s']:.2f}s "
+              f"rss boot={r['rss_boot_mb']:.0f}MB after={r['rss_after_mb']:.0f}MB tf={r['tensorflow_loaded']}")
+    server_pid = results["server_warm"].get("server_pid")
+    if server_pid:
+        try:
+            os.kill(server_pid, 15)
+        except OSError:
+            pass
+
+    n = args.workers
+    total_inprocess = n * results["inprocess"]["rss_after_mb"]
+    total_server = n * results["server_warm"]["rss_after_mb"] + results["server_warm"]["server_rss_mb"]
+    summary = {"workers": n, "total_rss_inprocess_mb": round(total_inprocess), "total_rss_server_mb": round(total_server)}
+    print(f"{n} workers: {summary['total_rss_inprocess_mb']}MB in-process vs. "
+          f"{summary['total_rss_server_mb']}MB with the inference server")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"bench": "startup", "args": vars(args), "results": results, "summary": summary}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
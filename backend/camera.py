@@ -0,0 +1,282 @@
+"""Persistent camera capture service.
+
+A background thread keeps the capture device open and holds a ring buffer of
+the most recent frames, so taking an intruder snapshot costs nothing more
+than a copy; storing snapshots is up to the caller (see evidence.py).
+``source`` may be a device index or a video file/stream URL, which is
+how the service is exercised without camera hardware.
+
+With several worker processes only one may hold the device. Given a
+``lock_path``, the process that wins the lock captures and publishes each
+frame into a shared-memory ring at ``ring_path``; the others follow that ring
+into their own buffer (and take over the camera if the owner exits).
+"""
+import mmap
+import os
+import threading
+import time
+from collections import deque
+
+import cv2
+import numpy as np
+
+from file_lock import try_lock
+
+
+class FrameRing:
+    """Fixed-size frame ring in a memory-mapped file: one writer, many readers.
+
+    Each slot carries the sequence number of the frame in it, cleared while the
+    writer copies; a reader keeps a frame only if the number is the same before
+    and after its copy.
+    """
+    MAGIC = 0x43414D52
+    _HEAD = 8  # int64 header: magic, slots, h, w, c, head seq, pid, spare
+
+    def __init__(self, path, mm, ino):
+        self.path = path
+        self._mm = mm
+        self.ino = ino
+        header = np.ndarray((self._HEAD,), np.int64, mm)
+        self.slots, h, w, c = (int(v) for v in header[1:5])
+        self.shape = (h, w, c) if c > 1 else (h, w)
+        self._header = header
+        nbytes = h * w * c
+        self._stride = 16 + nbytes
+        self._meta = [np.ndarray((2,), np.float64, mm, self._HEAD * 8 + i * self._stride)
+                      for i in range(self.slots)]
+        self._data = [np.ndarray(self.shape, np.uint8, mm, self._HEAD * 8 + i * self._stride + 16)
+                      for i in range(self.slots)]
+
+    @classmethod
+    def create(cls, path, slots, shape):
+        h, w = shape[:2]
+        c = shape[2] if len(shape) > 2 else 1
+        size = cls._HEAD * 8 + slots * (16 + h * w * c)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w+b") as fh:
+            fh.truncate(size)
+            mm = mmap.mmap(fh.fileno(), size)
+        np.ndarray((cls._HEAD,), np.int64, mm)[:] = [cls.MAGIC, slots, h, w, c, -1, os.getpid(), 0]
+        for i in range(slots):
+            np.ndarray((2,), np.float64, mm, cls._HEAD * 8 + i * (16 + h * w * c))[0] = -1
+        os.replace(tmp, path)
+        return cls(path, mm, os.stat(path).st_ino)
+
+    @classmethod
+    def attach(cls, path):
+        """Map an existing ring, or None if there is none (yet)."""
+        try:
+            with open(path, "rb") as fh:
+                ino = os.fstat(fh.fileno()).st_ino
+                mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+        if len(mm) < cls._HEAD * 8 or int(np.ndarray((1,), np.int64, mm)[0]) != cls.MAGIC:
+            return None
+        return cls(path, mm, ino)
+
+    def replaced(self):
+        try:
+            return os.stat(self.path).st_ino != self.ino
+        except OSError:
+            return True
+
+    def write(self, ts, frame):
+        seq = int(self._header[5]) + 1
+        slot = seq % self.slots
+        meta = self._meta[slot]
+        meta[0] = -1
+        self._data[slot][...] = frame
+        meta[1] = ts
+        meta[0] = seq
+        self._header[5] = seq
+
+    def read_since(self, last_seq):
+        """[(seq, ts, frame)] newer than last_seq that are still intact in the ring."""
+        head = int(self._header[5])
+        out = []
+        for seq in range(max(last_seq + 1, head - self.slots + 1), head + 1):
+            slot = seq % self.slots
+            meta = self._meta[slot]
+            if meta[0] != seq:
+                continue
+            ts = float(meta[1])
+            frame = self._data[slot].copy()
+            if meta[0] == seq:
+                out.append((seq, ts, frame))
+        return out
+
+
+class CaptureService:
+    def __init__(self, source=0, api_preference=None, buffer_size=8, warmup_frames=5,
+                 reopen_delay=2.0, lock_path=None, ring_path=None, poll_interval=0.01):
+        self.source = source
+        self.api_preference = api_preference
+        self.warmup_frames = warmup_frames
+        self.reopen_delay = reopen_delay
+        self.lock_path = lock_path
+        self.ring_path = ring_path or (lock_path and lock_path + ".ring")
+        self.poll_interval = poll_interval
+        self.role = None  # "owner" or "follower" once started
+        self._owner_fh = None
+        self._frames = deque(maxlen=buffer_size)  # (timestamp, frame)
+        self._cond = threading.Condition()
+        self._running = False
+        self._thread = None
+        self.frames_read = 0
+        self.opened = False
+
+    # ---- capture thread ------------------------------------------------
+    def start(self):
+        with self._cond:
+            if self._running:
+                return
+            self._running = True
+        self._thread = threading.Thread(target=self._capture_loop, name="camera-capture", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout=2.0)
+            self._thread = None
+
+    def _open(self):
+        if self.api_preference is None:
+            cam = cv2.VideoCapture(self.source)
+        else:
+            cam = cv2.VideoCapture(self.source, self.api_preference)
+        if not cam.isOpened():
+            cam.release()
+            return None
+        return cam
+
+    def _push(self, ts, frame):
+        with self._cond:
+            self._frames.append((ts, frame))
+            self.frames_read += 1
+            self._cond.notify_all()
+
+    def _capture_loop(self):
+        try:
+            while self._running:
+                if self.lock_path is not None and self._owner_fh is None:
+                    self._owner_fh = try_lock(self.lock_path)
+                    if self._owner_fh is None:
+                        self._follow()
+                        continue
+                self.role = "owner"
+                self._own()
+        finally:
+            if self._owner_fh is not None:
+                self._owner_fh.close()
+                self._owner_fh = None
+
+    def _follow(self):
+        """Mirror the owner's ring until this process can take the camera itself."""
+        self.role = "follower"
+        ring, last_seq, next_try = None, -1, time.time() + self.reopen_delay
+        while self._running:
+            if ring is None or ring.replaced():
+                ring, last_seq = FrameRing.attach(self.ring_path), -1
+            new = ring.read_since(last_seq) if ring is not None else []
+            for seq, ts, frame in new:
+                self._push(ts, frame)
+                last_seq = seq
+            if not new:
+                if time.time() >= next_try:
+                    # The lock goes with the owner process; if it exited, take over.
+                    self._owner_fh = try_lock(self.lock_path)
+                    if self._owner_fh is not None:
+                        return
+                    next_try = time.time() + self.reopen_delay
+                time.sleep(self.poll_interval)
+
+    def _own(self):
+        is_file = isinstance(self.source, str) and os.path.isfile(self.source)
+        ring, failing = None, False
+        while self._running:
+            cam = self._open()
+            if cam is None:
+                self.opened = False
+                if not failing:  # once per outage, not every retry
+                    print("[WARN] Camera not accessible; retrying every", self.reopen_delay, "s")
+                    failing = True
+                time.sleep(self.reopen_delay)
+                continue
+            if failing:
+                print("[INFO] Camera reopened")
+                failing = False
+            self.opened = True
+            # Auto-exposure needs a few frames to settle; never serve those.
+            for _ in range(self.warmup_frames):
+                cam.read()
+            fps = cam.get(cv2.CAP_PROP_FPS) if is_file else 0
+            while self._running:
+                ret, frame = cam.read()
+                if not ret:
+                    if is_file:
+                        cam.set(cv2.CAP_PROP_POS_FRAMES, 0)  # loop test videos
+                        continue
+                    print("[WARN] Camera read failed; reopening")
+                    break
+                ts = time.time()
+                self._push(ts, frame)
+                if self.ring_path is not None:
+                    if ring is None or ring.shape != frame.shape:
+                        ring = FrameRing.create(self.ring_path, self._frames.maxlen, frame.shape)
+                    ring.write(ts, frame)
+                if fps:
+                    time.sleep(1.0 / fps)
+            cam.release()
+            self.opened = False
+
+    # ---- readers -------------------------------------------------------
+    def latest(self, wait=1.5, max_age=None):
+        """Freshest frame, waiting up to `wait` seconds for the first one."""
+        self.start()
+        deadline = time.time() + wait
+        with self._cond:
+            while self._running:
+                if self._frames:
+                    ts, frame = self._frames[-1]
+                    if max_age is None or time.time() - ts <= max_age:
+                        return frame.copy()
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+                self._cond.wait(remaining)
+        return None
+
+    def frames(self, duration, wait=1.5):
+        """Yield each newly captured frame once, for up to duration seconds.
+
+        Stops early if no new frame arrives within `wait` seconds. A slow
+        consumer skips frames rather than falling behind the camera.
+        """
+        self.start()
+        end = time.time() + duration
+        last_ts = 0.0
+        while True:
+            with self._cond:
+                while self._running and (not self._frames or self._frames[-1][0] <= last_ts):
+                    remaining = min(wait, end - time.time())
+                    if remaining <= 0 or not self._cond.wait(remaining):
+                        return
+                if not self._running:
+                    return
+                last_ts, frame = self._frames[-1]
+            yield frame.copy()
+            if time.time() >= end:
+                return
+
+    def clip(self, n=None):
+        """The last n buffered frames (oldest first) as (timestamp, frame) pairs."""
+        with self._cond:
+            frames = list(self._frames)
+        if n is not None:
+            frames = frames[-n:]
+        return [(ts, f.copy()) for ts, f in frames]
@@ -0,0 +1,142 @@
+"""Pooled HTTP client for the ESP lock controller.
+
+One keep-alive ``requests.Session`` per device, tight connect/read timeouts,
+a circuit breaker that fails fast while the device is unreachable, and
+per-endpoint latency histograms.
+"""
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+LATENCY_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+
+class DeviceUnavailable(requests.exceptions.ConnectionError):
+    """Raised without touching the network while the circuit is open."""
+
+
+class CircuitBreaker:
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, failure_threshold=3, reset_timeout=10.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.time() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+            if self.state == self.HALF_OPEN and not self._probe_in_flight:
+                # Let exactly one request through to see if the device is back.
+                self._probe_in_flight = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self._probe_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._probe_in_flight = False
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self.opened_at = time.time()
+
+
+class LatencyHistogram:
+    def __init__(self, buckets=LATENCY_BUCKETS_MS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # last slot is +Inf
+        self.total = 0
+        self.sum_ms = 0.0
+        self.errors = 0
+
+    def observe(self, ms, error=False):
+        for i, bound in enumerate(self.buckets):
+            if ms <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.total += 1
+        self.sum_ms += ms
+        if error:
+            self.errors += 1
+
+    def to_dict(self):
+        labels = [str(b) for b in self.buckets] + ["+Inf"]
+        return {
+            "count": self.total,
+            "errors": self.errors,
+            "avg_ms": round(self.sum_ms / self.total, 1) if self.total else None,
+            "buckets_ms": dict(zip(labels, self.counts)),
+        }
+
+
+class DeviceClient:
+    def __init__(self, base_url, connect_timeout=1.0, read_timeout=3.0, pool_size=4,
+                 failure_threshold=3, reset_timeout=10.0):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = (connect_timeout, read_timeout)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self.histograms = {}
+        self.on_timing = None  # on_timing(endpoint, seconds, error), e.g. a metrics histogram
+        self._lock = threading.Lock()
+
+    def _observe(self, endpoint, ms, error):
+        if self.on_timing is not None:
+            self.on_timing(endpoint, ms / 1000.0, error)
+        with self._lock:
+            hist = self.histograms.get(endpoint)
+            if hist is None:
+                hist = self.histograms[endpoint] = LatencyHistogram()
+            hist.observe(ms, error)
+
+    def request(self, method, path, **kwargs):
+        if not self.breaker.allow():
+            raise DeviceUnavailable(f"device at {self.base_url} unreachable (circuit open)")
+        kwargs.setdefault("timeout", self.timeout)
+        start = time.perf_counter()
+        try:
+            res = self.session.request(method, self.base_url + path, **kwargs)
+        except requests.exceptions.RequestException:
+            self._observe(path, (time.perf_counter() - start) * 1000, True)
+            self.breaker.record_failure()
+            raise
+        self._observe(path, (time.perf_counter() - start) * 1000, res.status_code >= 400)
+        # A 4xx (e.g. wrong API key) still proves the device is up.
+        if res.status_code >= 500:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+        res.raise_for_status()
+        return res
+
+    def get(self, path, **kwargs):
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request("POST", path, **kwargs)
+
+    def stats(self):
+        with self._lock:
+            endpoints = {k: v.to_dict() for k, v in self.histograms.items()}
+        return {"base_url": self.base_url, "breaker": self.breaker.state,
+                "consecutive_failures": self.breaker.failures, "endpoints": endpoints}
@@ -0,0 +1,265 @@
+"""Binary, memory-mapped embeddings store.
+
+Layout for a store prefix such as ``embeddings``:
+
+* ``embeddings.<gen>.f32`` - raw little-endian float32 rows, memory-mapped on load.
+* ``embeddings.journal`` - JSON lines: a ``meta`` header (dim + data file name)
+  followed by ``put``/``del`` records that say which rows belong to which label.
+
+Registrations append rows to the data file and one line to the journal, so
+their cost does not depend on the size of the database. The journal line is
+the commit point; a torn trailing line or rows that were written without a
+journal line are ignored on load. Compaction writes a new data file and a new
+journal and swaps the journal in with ``os.replace``, so it is atomic too.
+"""
+import json
+import os
+import threading
+
+import numpy as np
+
+from file_lock import FileLock
+
+DTYPE = np.dtype("<f4")
+
+
+def _fsync_write(path, data, mode):
+    with open(path, mode) as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+class EmbeddingStore:
+    def __init__(self, prefix: str, compact_ratio=0.5, compact_min_rows=256):
+        self.prefix = prefix
+        self.journal_path = prefix + ".journal"
+        self.lock_path = prefix + ".lock"
+        self.compact_ratio = compact_ratio
+        self.compact_min_rows = compact_min_rows
+        self.dim = None
+        self.data_name = None
+        self.entries = {}  # label -> (start_row, count)
+        self._committed_rows = 0
+        self._journal_offset = 0
+        self._journal_ino = None
+        self._lock = threading.Lock()
+
+    # ---- paths / state -------------------------------------------------
+    def exists(self):
+        return os.path.exists(self.journal_path)
+
+    @property
+    def data_path(self):
+        return os.path.join(os.path.dirname(self.prefix) or ".", self.data_name)
+
+    def _data_rows(self):
+        try:
+            size = os.path.getsize(self.data_path)
+        except OSError:
+            return 0
+        return size // (DTYPE.itemsize * self.dim)
+
+    def live_rows(self):
+        return sum(count for _, count in self.entries.values())
+
+    def _apply(self, rec):
+        op = rec.get("op")
+        if op == "meta":
+            self.dim = int(rec["dim"])
+            self.data_name = rec["data"]
+            self.entries = {}
+            self._committed_rows = 0
+        elif op == "put":
+            start, count = int(rec["start"]), int(rec["count"])
+            self.entries[rec["label"]] = (start, count)
+            self._committed_rows = max(self._committed_rows, start + count)
+        elif op == "del":
+            self.entries.pop(rec["label"], None)
+
+    def _replay(self, from_offset=0):
+        """Apply journal records after from_offset; return the labels they touched."""
+        touched = set()
+        with open(self.journal_path, "rb") as f:
+            self._journal_ino = os.fstat(f.fileno()).st_ino
+            f.seek(from_offset)
+            offset = from_offset
+            for raw in f:
+                if not raw.endswith(b"\n"):
+                    break  # torn write from a crashed writer; not committed
+                offset += len(raw)
+                try:
+                    rec = json.loads(raw)
+                except ValueError:
+                    continue
+                self._apply(rec)
+                if "label" in rec:
+                    touched.add(rec["label"])
+        self._journal_offset = offset
+        return touched
+
+    def _journal_was_replaced(self):
+        # Compaction swaps in a new journal whose meta header names a new data
+        # file; inodes alone are not enough since the filesystem may reuse them.
+        try:
+            with open(self.journal_path, "rb") as f:
+                st = os.fstat(f.fileno())
+                head = json.loads(f.readline() or b"{}")
+        except (OSError, ValueError):
+            return True
+        return (st.st_ino != self._journal_ino or st.st_size < self._journal_offset
+                or head.get("data") != self.data_name)
+
+    def _catch_up(self):
+        if self._journal_ino is None or self._journal_was_replaced():
+            self._replay(0)
+        else:
+            self._replay(self._journal_offset)
+
+    # ---- reading -------------------------------------------------------
+    def _matrix(self):
+        rows = self._data_rows()
+        if rows == 0:
+            return np.zeros((0, self.dim or 0), dtype=DTYPE)
+        return np.memmap(self.data_path, dtype=DTYPE, mode="r", shape=(rows, self.dim))
+
+    def load(self):
+        """Replay the journal and return {label: float32 matrix of that label's rows}."""
+        with self._lock:
+            if not self.exists():
+                return {}
+            self._replay(0)
+            if self.dim is None:
+                return {}
+            matrix = self._matrix()
+            return {label: np.array(matrix[start:start + count])
+                    for label, (start, count) in self.entries.items()}
+
+    def refresh(self):
+        """Pick up writes made by other processes since the last load/refresh.
+
+        Returns {label: rows or None (deleted)} for every label that changed,
+        or None when the journal was compacted and a full load() is needed.
+        """
+        with self._lock:
+            if not self.exists():
+                return {}
+            if self._journal_was_replaced():
+                return None
+            if os.path.getsize(self.journal_path) == self._journal_offset:
+                return {}
+            touched = self._replay(self._journal_offset)
+            matrix = self._matrix()
+            changed = {}
+            for label in touched:
+                entry = self.entries.get(label)
+                changed[label] = None if entry is None else np.array(matrix[entry[0]:entry[0] + entry[1]])
+            return changed
+
+    # ---- writing -------------------------------------------------------
+    def _init_store(self, dim):
+        self.dim = dim
+        self.data_name = os.path.basename(self.prefix) + ".0.f32"
+        _fsync_write(self.data_path, b"", "wb")
+        meta = {"op": "meta", "version": 1, "dim": dim, "dtype": "float32", "data": self.data_name}
+        _fsync_write(self.journal_path, json.dumps(meta) + "\n", "w")
+        self._journal_offset = os.path.getsize(self.journal_path)
+        self._journal_ino = os.stat(self.journal_path).st_ino
+
+    def _append_record(self, rec):
+        line = json.dumps(rec) + "\n"
+        _fsync_write(self.journal_path, line, "a")
+        self._journal_offset = os.path.getsize(self.journal_path)
+        self._apply(rec)
+
+    def put(self, label, vectors):
+        """Replace all rows stored for label with vectors (1-D or 2-D)."""
+        vectors = np.atleast_2d(np.asarray(vectors, dtype=DTYPE))
+        with self._lock, FileLock(self.lock_path):
+            if self.exists():
+                self._catch_up()
+            else:
+                self._init_store(vectors.shape[1])
+            if vectors.shape[1] != self.dim:
+                raise ValueError(f"embedding dim {vectors.shape[1]} does not match store dim {self.dim}")
+            start = self._committed_rows
+            # Drop rows a crashed writer left without a journal line so the
+            # offsets recorded below stay exact.
+            with open(self.data_path, "r+b") as f:
+                f.truncate(start * DTYPE.itemsize * self.dim)
+            _fsync_write(self.data_path, vectors.tobytes(), "ab")
+            self._append_record({"op": "put", "label": label, "start": start, "count": int(vectors.shape[0])})
+            self._maybe_compact()
+
+    def delete(self, label):
+        with self._lock, FileLock(self.lock_path):
+            if not self.exists():
+                return False
+            self._catch_up()
+            if label not in self.entries:
+                return False
+            self._append_record({"op": "del", "label": label})
+            self._maybe_compact()
+            return True
+
+    def _maybe_compact(self):
+        total = self._data_rows()
+        dead = total - self.live_rows()
+        if total >= self.compact_min_rows and dead > total * self.compact_ratio:
+            self._compact()
+
+    def _compact(self):
+        old_data = self.data_path
+        gen = int(self.data_name.rsplit(".", 2)[-2]) + 1
+        new_name = f"{os.path.basename(self.prefix)}.{gen}.f32"
+        new_path = os.path.join(os.path.dirname(self.prefix) or ".", new_name)
+        matrix = self._matrix()
+        records = []
+        row = 0
+        with open(new_path, "wb") as f:
+            for label, (start, count) in self.entries.items():
+                f.write(np.ascontiguousarray(matrix[start:start + count]).tobytes())
+                records.append({"op": "put", "label": label, "start": row, "count": count})
+                row += count
+            f.flush()
+            os.fsync(f.fileno())
+        del matrix
+        meta = {"op": "meta", "version": 1, "dim": self.dim, "dtype": "float32", "data": new_name}
+        tmp = self.journal_path + ".tmp"
+        _fsync_write(tmp, "".join(json.dumps(r) + "\n" for r in [meta] + records), "w")
+        os.replace(tmp, self.journal_path)
+        self._replay(0)
+        try:
+            os.remove(old_data)
+        except OSError:
+            pass
+        print(f"[INFO] Compacted embeddings store to {row} rows ({new_name})")
+
+    # ---- migration -----------------------------------------------------
+    def migrate_from_json(self, json_path, labels_path=None):
+        """Import a legacy embeddings.json (optionally keyed via labels.json)."""
+        with open(json_path, "r") as f:
+            data = json.load(f)
+        labels = {}
+        if labels_path and os.path.exists(labels_path):
+            with open(labels_path, "r") as f:
+                labels = json.load(f)
+        count = 0
+        for key, vec in data.items():
+            # Older exports keyed rows by class index with names in labels.json.
+            label = labels.get(key, key) if key.isdigit() else key
+            self.put(label, np.asarray(vec, dtype=DTYPE))
+            count += 1
+        print(f"[INFO] Migrated {count} embeddings from {json_path} to {self.journal_path}")
+        return count
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Migrate embeddings.json into the binary store")
+    parser.add_argument("json_path", nargs="?", default="embeddings.json")
+    parser.add_argument("--labels", default="labels.json")
+    parser.add_argument("--store", default="embeddings")
+    args = parser.parse_args()
+    EmbeddingStore(args.store).migrate_from_json(args.json_path, args.labels)
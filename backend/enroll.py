@@ -0,0 +1,214 @@
+"""Batch face enrollment.
+
+Walks a folder of ``<user_id>/<image>`` photos and runs decode, detect and
+embed as batches across a process pool (each worker builds the model once).
+Every image is scored for face size, sharpness and detector confidence;
+low-quality images and embeddings far from the rest of the user's set are
+dropped before the user's embeddings are stored.
+
+    python enroll.py --dir registered_faces --workers 4
+"""
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import cv2
+import numpy as np
+
+from face_engine import FaceEngine
+from gallery import normalize, reduce_embeddings
+
+IMAGE_EXTS = (".jpg", ".jpeg", ".png", ".bmp", ".webp")
+
+MIN_FACE_SIZE = int(os.getenv("ENROLL_MIN_FACE_SIZE", "80"))  # px, shorter side of the face box
+MIN_SHARPNESS = float(os.getenv("ENROLL_MIN_SHARPNESS", "40"))  # variance of Laplacian
+MIN_CONFIDENCE = float(os.getenv("ENROLL_MIN_CONFIDENCE", "0.90"))
+OUTLIER_DISTANCE = float(os.getenv("ENROLL_OUTLIER_DISTANCE", "0.30"))  # cosine distance to the user's mean
+
+
+def sharpness(gray):
+    return float(cv2.Laplacian(gray, cv2.CV_64F).var())
+
+
+def score_face(bgr, info):
+    """Quality metrics for one detected face plus the reasons it was rejected, if any."""
+    area = info.get("area") or {}
+    x, y = int(area.get("x", 0)), int(area.get("y", 0))
+    w, h = int(area.get("w", bgr.shape[1])), int(area.get("h", bgr.shape[0]))
+    crop = bgr[max(0, y):y + h, max(0, x):x + w]
+    if crop.size == 0:
+        crop = bgr
+    gray = cv2.cvtColor(crop, cv2.COLOR_BGR2GRAY)
+    quality = {
+        "face_size": min(w, h),
+        "sharpness": round(sharpness(gray), 1),
+        "confidence": None if info.get("confidence") is None else round(float(info["confidence"]), 3),
+    }
+    reasons = []
+    if quality["face_size"] < MIN_FACE_SIZE:
+        reasons.append("face too small")
+    if quality["sharpness"] < MIN_SHARPNESS:
+        reasons.append("blurry")
+    if quality["confidence"] is not None and quality["confidence"] < MIN_CONFIDENCE:
+        reasons.append("low detection confidence")
+    quality["rejected"] = reasons
+    return quality
+
+
+def embed_image(engine, bgr):
+    # Always the full detector: stored embeddings should not depend on
+    # whether the Haar fast path happened to fire.
+    vec, info = engine.analyze(bgr, enforce_detection=True, fast=False)
+    return vec, score_face(bgr, info)
+
+
+def drop_outliers(vectors):
+    """Indices of vectors close enough to the set's mean direction to keep."""
+    if len(vectors) < 3:
+        return list(range(len(vectors)))
+    unit = np.stack([normalize(v) for v in vectors])
+    centre = normalize(unit.mean(axis=0))
+    dists = 1.0 - unit @ centre
+    keep = [i for i, d in enumerate(dists) if d <= OUTLIER_DISTANCE]
+    # If the whole set disagrees, trust the closest half rather than nothing.
+    return keep or list(np.argsort(dists)[:max(1, len(vectors) // 2)])
+
+
+def list_user_images(root, users=None):
+    if not os.path.isdir(root):
+        return {}
+    found = {}
+    for user_id in sorted(os.listdir(root)):
+        folder = os.path.join(root, user_id)
+        if not os.path.isdir(folder) or (users and user_id not in users):
+            continue
+        paths = [os.path.join(folder, f) for f in sorted(os.listdir(folder))
+                 if f.lower().endswith(IMAGE_EXTS)]
+        if paths:
+            found[user_id] = paths
+    return found
+
+
+# ---- process pool side ----------------------------------------------------
+_engine = None
+
+
+def _init_worker(model_name, detector_backend):
+    global _engine
+    _engine = FaceEngine(model_name, detector_backend)
+    _engine.load()
+
+
+def _process_batch(items):
+    results = []
+    for user_id, path in items:
+        result = {"user": user_id, "path": path, "vec": None, "quality": None, "error": None}
+        try:
+            bgr = cv2.imread(path, cv2.IMREAD_COLOR)
+            if bgr is None:
+                raise ValueError("could not decode image")
+            vec, quality = embed_image(_engine, bgr)
+            result["vec"], result["quality"] = vec, quality
+        except Exception as e:
+            result["error"] = str(e)
+        results.append(result)
+    return results
+
+
+# ---- driver ---------------------------------------------------------------
+def run_enrollment(root, model_name, detector_backend, users=None, workers=None,
+                   batch_size=8, on_progress=None, on_user_done=None, engine=None):
+    """Enroll every user folder under root.
+
+    on_progress(progress) is called after each batch with the job's progress
+    dict; on_user_done(user_id, vectors) once all of a user's images are in.
+    workers=0 runs in this process with `engine` instead of a process pool.
+    """
+    images = list_user_images(root, users)
+    progress = {
+        "state": "running",
+        "started_at": time.time(),
+        "users": {u: {"total": len(p), "done": 0, "accepted": 0, "rejected": 0, "errors": 0, "state": "pending"}
+                  for u, p in images.items()},
+    }
+    collected = {u: [] for u in images}
+    items = [(u, p) for u, paths in images.items() for p in paths]
+    batches = [items[i:i + batch_size] for i in range(0, len(items), batch_size)]
+
+    def handle(results):
+        for r in results:
+            user = progress["users"][r["user"]]
+            user["done"] += 1
+            if r["error"]:
+                user["errors"] += 1
+            elif r["quality"]["rejected"]:
+                user["rejected"] += 1
+            else:
+                user["accepted"] += 1
+                collected[r["user"]].append(r["vec"])
+            if user["done"] == user["total"]:
+                vectors = [collected[r["user"]][i] for i in drop_outliers(collected[r["user"]])]
+                user["outliers"] = len(collected[r["user"]]) - len(vectors)
+                user["state"] = "enrolled" if vectors else "failed"
+                if vectors and on_user_done:
+                    on_user_done(r["user"], vectors)
+        if on_progress:
+            on_progress(progress)
+
+    if workers == 0:
+        if engine is None:
+            engine = FaceEngine(model_name, detector_backend)
+        global _engine
+        _engine = engine
+        for batch in batches:
+            handle(_process_batch(batch))
+    else:
+        workers = workers or min(4, os.cpu_count() or 1)
+        # spawn, not fork: TensorFlow state does not survive a fork.
+        ctx = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=workers, mp_context=ctx, initializer=_init_worker,
+                                 initargs=(model_name, detector_backend)) as pool:
+            futures = [pool.submit(_process_batch, b) for b in batches]
+            for fut in as_completed(futures):
+                handle(fut.result())
+
+    progress["state"] = "done"
+    progress["finished_at"] = time.time()
+    if on_progress:
+        on_progress(progress)
+    return progress
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from embedding_store import EmbeddingStore
+
+    parser = argparse.ArgumentParser(description="Bulk-enroll faces from <dir>/<user_id>/*.jpg")
+    parser.add_argument("--dir", default=os.getenv("REGISTERED_FACE_DIR", "registered_faces"))
+    parser.add_argument("--store", default=os.getenv("EMBEDDINGS_STORE", "embeddings"))
+    parser.add_argument("--model", default=os.getenv("FACE_MODEL", "Facenet"))
+    parser.add_argument("--detector", default=os.getenv("DETECTOR_BACKEND", "mtcnn"))
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("users", nargs="*", help="only these user ids (default: all folders)")
+    args = parser.parse_args()
+
+    store = EmbeddingStore(args.store)
+
+    def report(progress):
+        done = sum(u["done"] for u in progress["users"].values())
+        total = sum(u["total"] for u in progress["users"].values())
+        print(f"\r[INFO] {done}/{total} images", end="", flush=True)
+
+    def save(user_id, vectors):
+        store.put(user_id, reduce_embeddings(vectors, int(os.getenv("FACE_MAX_EMBEDDINGS", "8"))))
+
+    result = run_enrollment(args.dir, args.model, args.detector, users=args.users or None,
+                            workers=args.workers, batch_size=args.batch_size,
+                            on_progress=report, on_user_done=save)
+    print()
+    for user_id, u in result["users"].items():
+        print(f"{user_id}: {u['state']} accepted={u['accepted']} rejected={u['rejected']} "
+              f"errors={u['errors']} outliers={u.get('outliers', 0)}")
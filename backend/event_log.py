@@ -0,0 +1,362 @@
+"""Append-only audit log of auth attempts, QR approvals and device calls.
+
+Events are JSON lines in segment files under one directory. Each process
+writes its own segment (``<start_ms>-<pid>.jsonl``), so gunicorn workers
+never interleave writes, and a background thread appends queued events in
+batches. A segment is sealed once it reaches ``segment_bytes`` or
+``segment_seconds``; sealing writes a small ``.idx`` sidecar with its time
+range, per-type counts and a sparse (timestamp, byte offset) table.
+
+Queries use the sidecars to skip whole segments that are outside the time
+range or hold none of the requested types, then seek close to ``since``
+inside the rest, so a range scan reads roughly the matching events rather
+than the whole history. Segments without a sidecar (the live ones, or one
+left by a crash) are indexed on first read and cached by size; retention
+seals a crashed or recycled worker's segment itself so it expires too.
+
+    python event_log.py --dir events --type auth --since 2025-01-01
+"""
+import bisect
+import heapq
+import itertools
+import json
+import os
+import queue
+import threading
+import time
+from collections import Counter
+
+SPARSE_EVERY = 256  # one (ts, offset) index entry per this many events
+# Events are stamped on the request thread and written later by the batch
+# thread, so timestamps within a segment are only ordered up to this much.
+ORDER_SLACK = 5.0
+
+
+def _segment_start(name):
+    return int(name.split("-", 1)[0]) / 1000.0
+
+
+def _segment_pid(name):
+    return int(name[:-len(".jsonl")].split("-", 1)[1])
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        return True  # exists, owned by someone else
+    return True
+
+
+class EventLog:
+    def __init__(self, directory, segment_bytes=8 * 1024 * 1024, segment_seconds=86400,
+                 retention_days=0, flush_interval=0.5, maxsize=10000):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.segment_seconds = segment_seconds
+        self.retention_days = retention_days
+        self.flush_interval = flush_interval
+        os.makedirs(directory, exist_ok=True)
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+        self._fh = None
+        self._path = None
+        self._index = None  # in-memory index of the segment being written
+        self._sealed = {}  # path -> sidecar index; sealed segments never change
+        self._cache = {}  # path -> index of an unsealed segment, up to its "bytes"
+        self.counters = Counter()
+
+    # ---- writing -------------------------------------------------------
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stop.clear()
+                self._thread = threading.Thread(target=self._run, name="event-log", daemon=True)
+                self._thread.start()
+
+    def stop(self, timeout=5.0):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self._write_batch(self._drain())
+        self._seal()
+
+    def record(self, type_, **fields):
+        """Queue one event; never blocks the request that reports it."""
+        self.start()
+        event = {"ts": round(time.time(), 3), "type": type_}
+        event.update((k, v) for k, v in fields.items() if v is not None)
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            with self._lock:
+                self.counters["dropped"] += 1
+
+    def _drain(self):
+        batch = []
+        while True:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                return batch
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._stop.wait(self.flush_interval)
+            batch = self._drain()
+            if batch:
+                try:
+                    self._write_batch(batch)
+                except Exception as e:
+                    print("[ERROR] Event log write failed:", e)
+
+    def _open_segment(self, ts):
+        name = f"{int(ts * 1000)}-{os.getpid()}.jsonl"
+        self._path = os.path.join(self.directory, name)
+        self._fh = open(self._path, "ab")
+        self._index = {"start": ts, "end": ts, "count": 0, "types": {}, "sparse": []}
+
+    def _write_batch(self, batch):
+        if not batch:
+            return
+        with self._lock:
+            for event in batch:
+                if self._fh is not None and self._should_rotate(event["ts"]):
+                    self._seal_locked()
+                if self._fh is None:
+                    self._open_segment(event["ts"])
+                    self._apply_retention()
+                line = (json.dumps(event, separators=(",", ":")) + "\n").encode()
+                idx = self._index
+                if idx["count"] % SPARSE_EVERY == 0:
+                    idx["sparse"].append([event["ts"], self._fh.tell()])
+                self._fh.write(line)
+                idx["count"] += 1
+                idx["end"] = max(idx["end"], event["ts"])
+                idx["types"][event["type"]] = idx["types"].get(event["type"], 0) + 1
+            self._fh.flush()
+            self.counters["written"] += len(batch)
+            self.counters["batches"] += 1
+
+    def _should_rotate(self, ts):
+        return (self._fh.tell() >= self.segment_bytes
+                or ts - self._index["start"] >= self.segment_seconds)
+
+    def _seal(self):
+        with self._lock:
+            self._seal_locked()
+
+    def _seal_locked(self):
+        if self._fh is None:
+            return
+        self._fh.close()
+        self._write_sidecar(self._path, self._index)
+        self._fh, self._path, self._index = None, None, None
+        self.counters["segments_sealed"] += 1
+
+    @staticmethod
+    def _write_sidecar(path, idx):
+        tmp = path + ".idx.tmp"
+        with open(tmp, "w") as f:
+            json.dump(idx, f)
+        os.replace(tmp, path[:-len(".jsonl")] + ".idx")
+
+    def _orphaned(self, path):
+        # An unsealed segment whose writer is gone (killed or recycled
+        # worker), or that nobody has written to for a whole segment period.
+        name = os.path.basename(path)
+        try:
+            if not _pid_alive(_segment_pid(name)):
+                return True
+        except (ValueError, IndexError):
+            return True
+        try:
+            return time.time() - os.path.getmtime(path) >= self.segment_seconds
+        except FileNotFoundError:
+            return False
+
+    def _apply_retention(self):
+        if not self.retention_days:
+            return
+        cutoff = time.time() - self.retention_days * 86400
+        for name in os.listdir(self.directory):
+            if not name.endswith(".jsonl"):
+                continue
+            path = os.path.join(self.directory, name)
+            if path == self._path:
+                continue
+            idx = self._read_sidecar(path)
+            if idx is None and self._orphaned(path):
+                # Seal it on the dead writer's behalf so it can expire too.
+                idx = self._index_unsealed(path)
+                idx.pop("bytes", None)
+                self._write_sidecar(path, idx)
+                self._cache.pop(path, None)
+                self.counters["segments_adopted"] += 1
+            # Only sealed segments are removed; a live one belongs to a worker.
+            if idx is not None and idx["end"] < cutoff:
+                self._sealed.pop(path, None)
+                for p in (path, path[:-len(".jsonl")] + ".idx"):
+                    try:
+                        os.remove(p)
+                    except FileNotFoundError:
+                        pass
+                self.counters["segments_expired"] += 1
+
+    # ---- reading -------------------------------------------------------
+    @staticmethod
+    def _read_sidecar(path):
+        try:
+            with open(path[:-len(".jsonl")] + ".idx") as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _segment_index(self, path):
+        idx = self._sealed.get(path)
+        if idx is None:
+            idx = self._read_sidecar(path)
+            if idx is not None:
+                self._sealed[path] = idx
+                self._cache.pop(path, None)
+        if idx is not None:
+            return idx
+        with self._lock:
+            if path == self._path:
+                return json.loads(json.dumps(self._index))
+        return self._index_unsealed(path)
+
+    def _index_unsealed(self, path):
+        size = os.path.getsize(path)
+        cached = self._cache.get(path)
+        if cached is not None and cached["bytes"] == size:
+            return cached
+        # Another worker's live segment: index only what was appended since
+        # the last look.
+        idx = cached or {"start": _segment_start(os.path.basename(path)), "end": 0, "count": 0,
+                         "types": {}, "sparse": [], "bytes": 0}
+        idx = json.loads(json.dumps(idx))
+        with open(path, "rb") as f:
+            f.seek(idx["bytes"])
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break  # partly written line; pick it up next time
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    break
+                if idx["count"] % SPARSE_EVERY == 0:
+                    idx["sparse"].append([event["ts"], idx["bytes"]])
+                idx["count"] += 1
+                idx["end"] = max(idx["end"], event["ts"])
+                idx["types"][event["type"]] = idx["types"].get(event["type"], 0) + 1
+                idx["bytes"] += len(line)
+        self._cache[path] = idx
+        return idx
+
+    def _scan(self, path, idx, since, until, types, match):
+        offset = 0
+        if since is not None and idx["sparse"]:
+            times = [ts for ts, _ in idx["sparse"]]
+            i = bisect.bisect_left(times, since - ORDER_SLACK) - 1
+            offset = idx["sparse"][max(0, i)][1]
+        with open(path, "rb") as f:
+            f.seek(offset)
+            for line in f:
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    return
+                ts = event["ts"]
+                if since is not None and ts < since:
+                    continue
+                if until is not None and ts > until:
+                    if ts > until + ORDER_SLACK:
+                        return
+                    continue
+                if types and event["type"] not in types:
+                    continue
+                if all(event.get(k) == v for k, v in match.items()):
+                    yield event
+
+    def query(self, since=None, until=None, types=None, limit=100, newest_first=True, **match):
+        """Events in [since, until] of the given types whose fields equal match."""
+        types = set(types) if types else None
+        segments = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".jsonl"):
+                continue
+            path = os.path.join(self.directory, name)
+            if until is not None and _segment_start(name) > until:
+                continue
+            idx = self._segment_index(path)
+            if since is not None and idx["end"] < since:
+                continue
+            if types and not types.intersection(idx["types"]):
+                continue
+            segments.append((path, idx))
+        with self._lock:
+            self.counters["queries"] += 1
+            self.counters["segments_scanned"] += len(segments)
+        if not newest_first:
+            # Segments of different workers overlap in time, so merge them;
+            # the merge is lazy and stops reading once limit is reached.
+            streams = [self._scan(p, idx, since, until, types, match) for p, idx in segments]
+            return list(itertools.islice(heapq.merge(*streams, key=lambda e: e["ts"]), limit))
+        # Newest first: visit segments by end time and stop once the next
+        # one ends before the oldest event we would keep.
+        segments.sort(key=lambda s: s[1]["end"], reverse=True)
+        heap, seq = [], itertools.count()
+        for path, idx in segments:
+            if len(heap) >= limit and idx["end"] < heap[0][0]:
+                break
+            for event in self._scan(path, idx, since, until, types, match):
+                item = (event["ts"], next(seq), event)
+                if len(heap) < limit:
+                    heapq.heappush(heap, item)
+                elif item[0] > heap[0][0]:
+                    heapq.heapreplace(heap, item)
+        return [event for _, _, event in sorted(heap, key=lambda i: (i[0], i[1]), reverse=True)]
+
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def stats(self):
+        with self._lock:
+            out = dict(self.counters)
+        out["queue_depth"] = self._queue.qsize()
+        out["segments"] = sum(1 for n in os.listdir(self.directory) if n.endswith(".jsonl"))
+        return out
+
+
+if __name__ == "__main__":
+    import argparse
+    from datetime import datetime
+
+    def when(value):
+        try:
+            return float(value)
+        except ValueError:
+            return datetime.fromisoformat(value).timestamp()
+
+    parser = argparse.ArgumentParser(description="Query the audit event log")
+    parser.add_argument("--dir", default=os.getenv("EVENT_LOG_DIR", "events"))
+    parser.add_argument("--type", action="append", help="event type (repeatable)")
+    parser.add_argument("--since", type=when, help="epoch seconds or ISO date")
+    parser.add_argument("--until", type=when)
+    parser.add_argument("--limit", type=int, default=50)
+    parser.add_argument("--oldest-first", action="store_true")
+    parser.add_argument("where", nargs="*", help="field=value filters, e.g. method=pin ok=false")
+    args = parser.parse_args()
+
+    match = {}
+    for item in args.where:
+        key, _, value = item.partition("=")
+        match[key] = json.loads(value) if value in ("true", "false", "null") or value.lstrip("-").isdigit() else value
+    log = EventLog(args.dir)
+    for event in log.query(args.since, args.until, args.type, args.limit, not args.oldest_first, **match):
+        print(json.dumps(event))
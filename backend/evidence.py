@@ -0,0 +1,422 @@
+"""Intruder evidence store: deduplicated snapshots, thumbnails and retention.
+
+An alert saves an *incident*: one or a few frames (e.g. the camera's last
+buffered frames) plus who/why metadata. Each frame gets a 64-bit difference
+hash (dHash); a frame within ``dedup_distance`` bits of one stored in the
+last ``dedup_window`` seconds is recorded as a reference to that image
+instead of being written again, so a static scene or a burst of alerts does
+not fill the disk with copies. Exact repeats further apart are caught by the
+SHA-256 of the encoded JPEG.
+
+Encoding and writing happen on a background thread. Every image is written
+with a small thumbnail (what alert emails attach) under a per-day folder, and
+every image, incident and deletion is appended to ``index.jsonl``, so the
+images of an incident are found from the index rather than by listing
+directories. Workers share the index: each one reads what the others
+appended since its last look.
+
+Retention runs on the writer thread: images older than ``retention_days``
+go first, then the oldest ones until the store is under ``max_bytes``.
+Flat ``<kind>_<ts>.jpg`` snapshots left in the directory by older versions
+are indexed once, on first start, so retention covers them too.
+"""
+import hashlib
+import itertools
+import json
+import os
+import queue
+import threading
+import time
+from collections import Counter, deque
+
+import cv2
+
+from file_lock import FileLock, try_lock
+
+
+def dhash(bgr, size=8):
+    """64-bit difference hash: which neighbouring pixels get brighter in a tiny grayscale copy."""
+    gray = cv2.cvtColor(bgr, cv2.COLOR_BGR2GRAY) if bgr.ndim == 3 else bgr
+    small = cv2.resize(gray, (size + 1, size), interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    return int("".join("1" if b else "0" for b in bits), 2)
+
+
+def hamming(a, b):
+    return bin(a ^ b).count("1")
+
+
+class EvidenceStore:
+    def __init__(self, directory, max_bytes=500 * 1024 * 1024, retention_days=90, thumb_side=320,
+                 jpeg_quality=90, thumb_quality=70, dedup_distance=6, dedup_window=300, sweep_interval=60):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.retention_days = retention_days
+        self.thumb_side = thumb_side
+        self.jpeg_quality = jpeg_quality
+        self.thumb_quality = thumb_quality
+        self.dedup_distance = dedup_distance
+        self.dedup_window = dedup_window
+        self.sweep_interval = sweep_interval
+        os.makedirs(directory, exist_ok=True)
+        self.index_path = os.path.join(directory, "index.jsonl")
+        # Held by every append and by compaction, across workers.
+        self.index_lock = self.index_path + ".lock"
+        self._queue = queue.Queue(maxsize=256)
+        self._lock = threading.Lock()
+        self._pending = {}  # path -> Event set once the file is on disk
+        self._recent = deque(maxlen=256)  # (ts, dhash, image_id, thumb) of this process's recent images
+        self._seq = itertools.count()
+        self._writer = None
+        self._last_sweep = 0.0
+        # Index as read so far; refreshed incrementally from _offset.
+        self._images, self._incidents, self._by_sha = {}, {}, {}
+        self._offset, self._inode = 0, None
+        self.counters = Counter()
+        self.migrate_legacy()
+
+    # ---- saving ----------------------------------------------------------
+    def _start(self):
+        if self._writer is None or not self._writer.is_alive():
+            self._writer = threading.Thread(target=self._write_loop, name="evidence-writer", daemon=True)
+            self._writer.start()
+
+    def _near_duplicate(self, h, now):
+        for ts, other, image_id, thumb in reversed(self._recent):
+            if now - ts > self.dedup_window:
+                break
+            if hamming(h, other) <= self.dedup_distance:
+                return image_id, thumb
+        return None
+
+    def save_incident(self, frames, kind, **meta):
+        """Queue frames as one incident; returns {"id", "images", "thumb"} without waiting for disk."""
+        now = time.time()
+        incident_id = f"{int(now * 1000)}-{os.getpid()}-{next(self._seq)}"
+        day = time.strftime("%Y%m%d", time.localtime(now))
+        images, thumb, jobs = [], None, []
+        with self._lock:
+            for i, frame in enumerate(f for f in frames if f is not None):
+                h = dhash(frame)
+                dup = self._near_duplicate(h, now)
+                if dup is not None:
+                    self.counters["near_duplicates"] += 1
+                    image_id, image_thumb = dup
+                else:
+                    image_id = f"{incident_id}-{i}"
+                    rel = os.path.join(day, image_id + ".jpg")
+                    image_thumb = os.path.join(self.directory, day, image_id + ".thumb.jpg")
+                    for path in (os.path.join(self.directory, rel), image_thumb):
+                        self._pending[path] = threading.Event()
+                    self._recent.append((now, h, image_id, image_thumb))
+                    jobs.append((frame, {"type": "image", "id": image_id, "incident": incident_id, "ts": now,
+                                         "path": rel, "dhash": f"{h:016x}"}))
+                if image_id not in images:
+                    images.append(image_id)
+                thumb = thumb or image_thumb
+        if not images:
+            return None
+        record = {"type": "incident", "id": incident_id, "ts": now, "kind": kind, "images": images,
+                  **{k: v for k, v in meta.items() if v is not None}}
+        self._start()
+        try:
+            # One queue item per incident: it is saved whole or not at all.
+            self._queue.put_nowait(("incident", (jobs, record)))
+        except queue.Full:
+            with self._lock:
+                self.counters["dropped"] += 1
+                new_ids = {rec["id"] for _, rec in jobs}
+                # Nothing will be written: release waiters and stop later
+                # frames from deduplicating against these images.
+                for _, rec in jobs:
+                    path = os.path.join(self.directory, rec["path"])
+                    for p in (path, path[:-len(".jpg")] + ".thumb.jpg"):
+                        done = self._pending.pop(p, None)
+                        if done is not None:
+                            done.set()
+                self._recent = deque((r for r in self._recent if r[2] not in new_ids), maxlen=self._recent.maxlen)
+            print("[WARN] Evidence queue full; incident", incident_id, "not saved")
+            return None
+        return {"id": incident_id, "images": images, "thumb": thumb}
+
+    def wait_written(self, path, timeout=5.0):
+        with self._lock:
+            done = self._pending.get(path)
+        return True if done is None else done.wait(timeout)
+
+    def thumbnail(self, saved, timeout=5.0):
+        """Path of the first thumbnail of a save_incident() result once it is on disk, or None."""
+        self.wait_written(saved["thumb"], timeout)
+        rec = self.image(saved["images"][0])
+        if rec is None or not rec.get("thumb"):
+            return None
+        return os.path.join(self.directory, rec["thumb"])
+
+    # ---- writer thread ---------------------------------------------------
+    def _append(self, records):
+        data = "".join(json.dumps(r, separators=(",", ":")) + "\n" for r in records).encode()
+        with FileLock(self.index_lock):
+            fd = os.open(self.index_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, data)
+            finally:
+                os.close(fd)
+
+    @staticmethod
+    def _write_file(path, data):
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    def _store_image(self, frame, rec):
+        path = os.path.join(self.directory, rec["path"])
+        thumb = path[:-len(".jpg")] + ".thumb.jpg"
+        try:
+            ok, buf = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, self.jpeg_quality])
+            if not ok:
+                raise ValueError("JPEG encode failed")
+            data = buf.tobytes()
+            rec["sha256"] = hashlib.sha256(data).hexdigest()
+            self._refresh()
+            with self._lock:
+                same = self._by_sha.get(rec["sha256"])
+            if same is not None and same in self._images:
+                # Byte-identical to an image already on disk: point at it.
+                rec["dup_of"] = same
+                rec["path"], rec["thumb"], rec["bytes"] = (self._images[same]["path"], self._images[same]["thumb"], 0)
+                with self._lock:
+                    self.counters["exact_duplicates"] += 1
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                self._write_file(path, data)
+                h, w = frame.shape[:2]
+                scale = min(1.0, self.thumb_side / float(max(h, w)))
+                small = cv2.resize(frame, (max(1, int(w * scale)), max(1, int(h * scale))),
+                                   interpolation=cv2.INTER_AREA)
+                tdata = cv2.imencode(".jpg", small, [cv2.IMWRITE_JPEG_QUALITY, self.thumb_quality])[1].tobytes()
+                self._write_file(thumb, tdata)
+                rec["thumb"] = os.path.relpath(thumb, self.directory)
+                rec["bytes"] = len(data) + len(tdata)
+                with self._lock:
+                    self.counters["written"] += 1
+                    self.counters["bytes_written"] += rec["bytes"]
+            self._append([rec])
+        except Exception as e:
+            print("[WARN] Failed to save evidence image:", path, e)
+        finally:
+            with self._lock:
+                for p in (path, thumb):
+                    done = self._pending.pop(p, None)
+                    if done is not None:
+                        done.set()
+
+    def _write_loop(self):
+        while True:
+            try:
+                kind, job = self._queue.get(timeout=self.sweep_interval)
+            except queue.Empty:
+                kind, job = None, None
+            if kind == "stop":
+                return
+            if kind == "incident":
+                images, record = job
+                for image in images:
+                    self._store_image(*image)
+                try:
+                    self._append([record])
+                except OSError as e:
+                    print("[WARN] Failed to index evidence incident:", e)
+            if time.time() - self._last_sweep >= self.sweep_interval:
+                self._last_sweep = time.time()
+                try:
+                    self.sweep()
+                except Exception as e:
+                    print("[WARN] Evidence retention sweep failed:", e)
+
+    def stop(self, timeout=5.0):
+        """Write out whatever is queued, then stop the writer."""
+        writer = self._writer
+        if writer is None or not writer.is_alive():
+            return
+        self._queue.put(("stop", None))
+        writer.join(timeout)
+
+    # ---- index -----------------------------------------------------------
+    def _apply(self, rec):
+        if rec["type"] == "image":
+            self._images[rec["id"]] = rec
+            if "dup_of" not in rec and "sha256" in rec:
+                self._by_sha[rec["sha256"]] = rec["id"]
+        elif rec["type"] == "incident":
+            self._incidents[rec["id"]] = rec
+        elif rec["type"] == "deleted":
+            for image_id in rec["ids"]:
+                img = self._images.pop(image_id, None)
+                if img is not None and self._by_sha.get(img.get("sha256")) == image_id:
+                    del self._by_sha[img["sha256"]]
+
+    def _refresh(self):
+        """Apply index lines appended (by any worker) since the last read."""
+        try:
+            st = os.stat(self.index_path)
+        except FileNotFoundError:
+            return
+        with self._lock:
+            if st.st_ino != self._inode or st.st_size < self._offset:
+                # Compacted by a sweep: start over.
+                self._images, self._incidents, self._by_sha = {}, {}, {}
+                self._offset, self._inode = 0, st.st_ino
+            if st.st_size == self._offset:
+                return
+            with open(self.index_path, "rb") as f:
+                f.seek(self._offset)
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        break  # partly written; picked up next time
+                    self._offset += len(line)
+                    try:
+                        self._apply(json.loads(line))
+                    except (ValueError, KeyError):
+                        continue
+
+    def incident(self, incident_id):
+        """The incident record with its image records (None for pruned images), or None."""
+        self._refresh()
+        with self._lock:
+            rec = self._incidents.get(incident_id)
+            if rec is None:
+                return None
+            return {**rec, "images": [self._images.get(i, {"id": i, "deleted": True}) for i in rec["images"]]}
+
+    def image(self, image_id):
+        self._refresh()
+        with self._lock:
+            return self._images.get(image_id)
+
+    def find(self, since=None, until=None, kind=None, limit=50, **match):
+        """Incidents newest first, filtered by time range, kind and metadata fields."""
+        self._refresh()
+        with self._lock:
+            found = [r for r in self._incidents.values()
+                     if (since is None or r["ts"] >= since) and (until is None or r["ts"] <= until)
+                     and (kind is None or r["kind"] == kind) and all(r.get(k) == v for k, v in match.items())]
+        found.sort(key=lambda r: r["ts"], reverse=True)
+        return found[:limit]
+
+    # ---- retention -------------------------------------------------------
+    def migrate_legacy(self):
+        """Index the flat snapshots older versions wrote here; runs once per directory."""
+        marker = os.path.join(self.directory, ".legacy-indexed")
+        if os.path.exists(marker):
+            return 0
+        lock = try_lock(os.path.join(self.directory, ".sweep.lock"))
+        if lock is None:
+            return 0  # another worker is at it (or sweeping); it will be done next start
+        try:
+            if os.path.exists(marker):
+                return 0
+            self._refresh()
+            records = []
+            for entry in os.scandir(self.directory):
+                if not entry.is_file() or not entry.name.lower().endswith(".jpg"):
+                    continue
+                image_id = "legacy-" + entry.name[:-len(".jpg")]
+                with self._lock:
+                    if image_id in self._images:
+                        continue
+                st = entry.stat()
+                kind = "face_fail" if entry.name.startswith("face_fail_") else "intruder"
+                records.append({"type": "image", "id": image_id, "incident": image_id, "ts": st.st_mtime,
+                                "path": entry.name, "bytes": st.st_size})
+                records.append({"type": "incident", "id": image_id, "ts": st.st_mtime, "kind": kind,
+                                "images": [image_id], "legacy": True})
+            if records:
+                self._append(records)
+                print(f"[INFO] Indexed {len(records) // 2} legacy evidence image(s) in {self.directory}")
+            with open(marker, "w"):
+                pass
+            return len(records) // 2
+        finally:
+            lock.close()
+
+    def sweep(self):
+        lock = try_lock(os.path.join(self.directory, ".sweep.lock"))
+        if lock is None:
+            return 0  # another worker is sweeping
+        try:
+            self._refresh()
+            with self._lock:
+                live = sorted((r for r in self._images.values() if "dup_of" not in r), key=lambda r: r["ts"])
+                refs = {}
+                for r in self._images.values():
+                    if "dup_of" in r:
+                        refs.setdefault(r["dup_of"], []).append(r["id"])
+            cutoff = time.time() - self.retention_days * 86400 if self.retention_days else None
+            total = sum(r.get("bytes", 0) for r in live)
+            doomed = []
+            for r in live:
+                if (cutoff is not None and r["ts"] < cutoff) or total > self.max_bytes:
+                    doomed.append(r)
+                    total -= r.get("bytes", 0)
+            if not doomed:
+                return 0
+            ids = []
+            for r in doomed:
+                for rel in (r["path"], r.get("thumb")):
+                    if rel:
+                        try:
+                            os.remove(os.path.join(self.directory, rel))
+                        except FileNotFoundError:
+                            pass
+                folder = os.path.dirname(r["path"])
+                if folder:  # day folders only; legacy images sit at the top
+                    try:
+                        os.rmdir(os.path.join(self.directory, folder))
+                    except OSError:
+                        pass  # folder still has other images
+                ids.append(r["id"])
+                ids.extend(refs.get(r["id"], []))
+            self._append([{"type": "deleted", "ts": time.time(), "ids": ids}])
+            self._refresh()
+            self._compact()
+            with self._lock:
+                self.counters["deleted"] += len(doomed)
+            print(f"[INFO] Evidence retention removed {len(doomed)} image(s)")
+            return len(doomed)
+        finally:
+            lock.close()
+
+    def _compact(self):
+        # Rewrite the index without deleted images and incidents whose
+        # images are all gone, once it is mostly dead lines. Appends wait on
+        # the index lock, so nothing lands between the read and the replace.
+        with FileLock(self.index_lock):
+            self._refresh()
+            with self._lock:
+                live_images = list(self._images.values())
+                live_incidents = [r for r in self._incidents.values()
+                                  if any(i in self._images for i in r["images"])]
+                index_bytes = self._offset
+            if index_bytes < 1024 * 1024 or (len(live_images) + len(live_incidents)) * 400 > index_bytes // 2:
+                return
+            tmp = self.index_path + ".tmp"
+            with open(tmp, "w") as f:
+                for r in sorted(live_images + live_incidents, key=lambda r: r["ts"]):
+                    f.write(json.dumps(r, separators=(",", ":")) + "\n")
+            os.replace(tmp, self.index_path)
+            self._refresh()
+
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def stats(self):
+        self._refresh()
+        with self._lock:
+            out = dict(self.counters)
+            out["images"] = sum(1 for r in self._images.values() if "dup_of" not in r)
+            out["incidents"] = len(self._incidents)
+            out["bytes"] = sum(r.get("bytes", 0) for r in self._images.values())
+        out["queue_depth"] = self.queue_depth()
+        out["max_bytes"] = self.max_bytes
+        return out
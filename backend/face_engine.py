@@ -0,0 +1,268 @@
+"""In-memory face embedding engine.
+
+Builds the recognition model and face detector once per process and embeds
+decoded BGR frames (numpy arrays) directly, so the request path never has to
+round-trip the image through a temp file on disk.
+
+In ``cascade`` mode a cheap OpenCV Haar detector runs first; when it finds
+exactly one confident, large enough frontal face the crop is eye-aligned and
+embedded directly, and only unclear frames pay for the full detector.
+"""
+import math
+import os
+import threading
+import time
+from collections import Counter
+
+import cv2
+import numpy as np
+
+
+def to_vector(embed):
+    """Normalise the different shapes DeepFace.represent returns into one float32 vector."""
+    if isinstance(embed, dict) and "embedding" in embed:
+        return np.asarray(embed["embedding"], dtype=np.float32)
+    if isinstance(embed, list) and len(embed) > 0:
+        first = embed[0]
+        if isinstance(first, dict) and "embedding" in first:
+            return np.asarray(first["embedding"], dtype=np.float32)
+        if isinstance(first, (list, np.ndarray)):
+            return np.asarray(first, dtype=np.float32)
+    return np.asarray(embed, dtype=np.float32).reshape(-1)
+
+
+class CascadeDetector:
+    """Haar frontal-face detector with a confidence score and eye alignment."""
+
+    def __init__(self, min_weight=4.0, min_size=80, margin=0.05):
+        self.min_weight = min_weight
+        self.min_size = min_size
+        self.margin = margin
+        self._local = threading.local()  # CascadeClassifier is not thread-safe
+        if self._classifiers()[0].empty():
+            raise RuntimeError("OpenCV Haar cascade files not found")
+
+    def _classifiers(self):
+        if not hasattr(self._local, "face"):
+            root = cv2.data.haarcascades
+            self._local.face = cv2.CascadeClassifier(os.path.join(root, "haarcascade_frontalface_default.xml"))
+            self._local.eyes = cv2.CascadeClassifier(os.path.join(root, "haarcascade_eye.xml"))
+        return self._local.face, self._local.eyes
+
+    def detect(self, bgr):
+        """Return (aligned_crop, info) when confident about a single face, else None."""
+        gray = cv2.cvtColor(bgr, cv2.COLOR_BGR2GRAY)
+        hit = self.locate(gray)
+        if hit is None:
+            return None
+        box, weight = hit
+        x, y, w, h = box
+        return self.crop(bgr, gray, box), {"area": {"x": x, "y": y, "w": w, "h": h}, "confidence": weight}
+
+    def locate(self, gray):
+        """(box, weight) of the single confident face in a grayscale frame, else None."""
+        boxes, _, weights = self._classifiers()[0].detectMultiScale3(
+            gray, scaleFactor=1.1, minNeighbors=5, minSize=(self.min_size, self.min_size),
+            outputRejectLevels=True)
+        if len(boxes) != 1:
+            return None  # none, or several faces: let the full detector decide
+        weight = float(np.ravel(weights)[0])
+        if weight < self.min_weight:
+            return None
+        return tuple(int(v) for v in boxes[0]), weight
+
+    def crop(self, bgr, gray, box):
+        """Face box plus margin, rotated so the eyes are level when both are found."""
+        x, y, w, h = box
+        mx, my = int(w * self.margin), int(h * self.margin)
+        x0, y0 = max(0, x - mx), max(0, y - my)
+        x1, y1 = min(bgr.shape[1], x + w + mx), min(bgr.shape[0], y + h + my)
+        return self._align(bgr[y0:y1, x0:x1], gray[y0:y1, x0:x1], self._classifiers()[1])
+
+    @staticmethod
+    def _align(crop, gray, eye_cc):
+        h, w = gray.shape
+        eyes = eye_cc.detectMultiScale(gray[:h // 2], scaleFactor=1.1, minNeighbors=5,
+                                       minSize=(max(1, w // 10), max(1, h // 10)))
+        if len(eyes) < 2:
+            return crop
+        eyes = sorted(eyes, key=lambda e: e[2] * e[3], reverse=True)[:2]
+        (lx, ly), (rx, ry) = sorted((ex + ew / 2.0, ey + eh / 2.0) for ex, ey, ew, eh in eyes)
+        angle = math.degrees(math.atan2(ry - ly, rx - lx))
+        if abs(angle) > 20:
+            return crop  # implausible tilt; probably an eyebrow or nostril hit
+        rot = cv2.getRotationMatrix2D(((lx + rx) / 2.0, (ly + ry) / 2.0), angle, 1.0)
+        return cv2.warpAffine(crop, rot, (w, h), flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+
+
+class FaceEngine:
+    def __init__(self, model_name: str, detector_backend: str, detect_mode="single",
+                 fast_min_weight=4.0, fast_min_size=80):
+        self.model_name = model_name
+        self.detector_backend = detector_backend
+        self.detect_mode = detect_mode  # "single" or "cascade"
+        self.cascade = None
+        if detect_mode == "cascade":
+            try:
+                self.cascade = CascadeDetector(fast_min_weight, fast_min_size)
+            except (AttributeError, RuntimeError, cv2.error) as e:
+                # Builds without the objdetect Haar module: keep working on
+                # the full detector rather than failing to start.
+                print(f"[WARN] Cascade face detector unavailable, using {detector_backend} only: {e}")
+        self.path_counts = Counter()
+        self.on_timing = None  # on_timing(stage, seconds), e.g. a metrics histogram
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self.load_seconds = None
+
+    @property
+    def ready(self):
+        return self._ready.is_set()
+
+    def load(self):
+        if self._ready.is_set():
+            return
+        with self._lock:
+            if self._ready.is_set():
+                return
+            from deepface import DeepFace
+
+            start = time.perf_counter()
+            # DeepFace keeps built models in a module level cache, so building
+            # them here means every later represent() call reuses them.
+            DeepFace.build_model(self.model_name)
+            if self.detector_backend not in ("skip", "opencv"):
+                try:
+                    DeepFace.build_model(self.detector_backend, task="face_detector")
+                except TypeError:
+                    # Older DeepFace releases have no task argument; the
+                    # detector is then built and cached on first use instead.
+                    pass
+                except Exception as e:
+                    print(f"[WARN] Could not preload detector {self.detector_backend}: {e}")
+            self.load_seconds = time.perf_counter() - start
+            self._ready.set()
+            print(f"[INFO] Face engine loaded {self.model_name}/{self.detector_backend} in {self.load_seconds:.2f}s")
+
+    def warmup(self):
+        # A blank frame is enough to push one pass through detector and model
+        # so TF finishes graph tracing before the first real unlock.
+        self.load()
+        dummy = np.full((160, 160, 3), 127, dtype=np.uint8)
+        try:
+            self.represent(dummy, enforce_detection=False)
+            print("[INFO] Face engine warm-up done")
+        except Exception as e:
+            print("[WARN] Face engine warm-up failed:", e)
+
+    def warmup_async(self):
+        t = threading.Thread(target=self.warmup, name="face-engine-warmup", daemon=True)
+        t.start()
+        return t
+
+    def analyze(self, bgr: np.ndarray, enforce_detection=True, fast=None):
+        """Embed the largest face in bgr; returns (vector, {"area", "confidence", "path"}).
+
+        fast=None follows the engine's detect mode; enrollment passes
+        fast=False so stored embeddings always come from the full detector.
+        """
+        result = self.analyze_batch([bgr], enforce_detection, fast)[0]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def analyze_batch(self, frames, enforce_detection=True, fast=None):
+        """analyze() for several frames, with one model forward pass per detector path.
+
+        Returns one entry per frame: a (vector, info) tuple, or the exception
+        that frame raised, so one faceless frame does not fail the others.
+        """
+        self.load()
+        if fast is None:
+            fast = self.cascade is not None
+        results = [None] * len(frames)
+        crops, crop_idx, full, full_idx = [], [], [], []
+        for i, bgr in enumerate(frames):
+            start = time.perf_counter()
+            hit = self.cascade.detect(bgr) if fast and self.cascade is not None else None
+            if fast and self.cascade is not None:
+                self._timing("detect", start)
+            if hit is not None:
+                crops.append(hit)
+                crop_idx.append(i)
+            else:
+                full.append(bgr)
+                full_idx.append(i)
+
+        if crops:
+            start = time.perf_counter()
+            embeds = self._represent_many([c for c, _ in crops], "skip", False)
+            self._timing("embed", start)
+            for i, (_, info), embed in zip(crop_idx, crops, embeds):
+                results[i] = embed if isinstance(embed, Exception) else (to_vector(embed), {**info, "path": "fast"})
+            self.path_counts["fast"] += len(crops)
+        if full:
+            path = "full" if self.cascade is None else "fallback"
+            start = time.perf_counter()
+            embeds = self._represent_many(full, self.detector_backend, enforce_detection)
+            # The full detector runs inside DeepFace, so it is not separable
+            # from the embedding here.
+            self._timing("detect_embed", start)
+            for i, embed in zip(full_idx, embeds):
+                results[i] = embed if isinstance(embed, Exception) else _largest_face(embed, path)
+            self.path_counts[path] += len(full)
+        return results
+
+    def embed_face(self, crop, path="stream"):
+        """Embed an already cropped face, skipping detection."""
+        self.load()
+        start = time.perf_counter()
+        result = self._represent_many([crop], "skip", False)[0]
+        self._timing("embed", start)
+        if isinstance(result, Exception):
+            raise result
+        self.path_counts[path] += 1
+        return to_vector(result)
+
+    def _timing(self, stage, start):
+        if self.on_timing is not None:
+            self.on_timing(stage, time.perf_counter() - start)
+
+    def _represent_many(self, images, detector_backend, enforce_detection):
+        from deepface import DeepFace
+
+        kwargs = dict(model_name=self.model_name, detector_backend=detector_backend,
+                      enforce_detection=enforce_detection)
+        if len(images) > 1:
+            # DeepFace >= 0.0.94 takes a list: detection still runs per image,
+            # but all faces go through the model in one forward pass.
+            try:
+                out = DeepFace.represent(img_path=list(images), **kwargs)
+                if len(out) == len(images) and all(isinstance(o, list) for o in out):
+                    return out
+            except Exception:
+                pass  # older DeepFace, or one frame without a face: redo one by one
+        out = []
+        for img in images:
+            try:
+                out.append(DeepFace.represent(img_path=img, **kwargs))
+            except Exception as e:
+                out.append(e)
+        return out
+
+    def represent(self, bgr: np.ndarray, enforce_detection=True):
+        return self.analyze(bgr, enforce_detection)[0]
+
+
+def _largest_face(embed, path):
+    faces = embed if isinstance(embed, list) else [embed]
+    if faces and all(isinstance(f, dict) for f in faces):
+        face = max(faces, key=lambda f: _area_size(f.get("facial_area")))
+        return to_vector(face), {"area": face.get("facial_area"), "confidence": face.get("face_confidence"), "path": path}
+    return to_vector(embed), {"area": None, "confidence": None, "path": path}
+
+
+def _area_size(area):
+    if not area:
+        return 0
+    return int(area.get("w", 0)) * int(area.get("h", 0))
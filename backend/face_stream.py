@@ -0,0 +1,137 @@
+"""Hands-free face unlock over a stream of frames.
+
+Instead of embedding every frame, the Haar detector runs only every
+``detect_every`` frames (whether or not a face is present) and a
+template-matching tracker follows the face in between. A frame is embedded
+only while a frontal face is being tracked, its crop is sharp enough and at
+least ``embed_interval`` seconds have passed since the last embedding, so
+the model runs a few times per second at most regardless of the camera's
+frame rate. Embeddings of one track are averaged before matching, and a
+decision needs ``min_frames`` of them with the per-frame matches agreeing,
+so one lucky or blurry frame cannot decide on its own.
+"""
+import time
+
+import cv2
+import numpy as np
+
+from enroll import sharpness
+from gallery import normalize
+
+
+class TemplateTracker:
+    """Follows one face box between detections by normalised template matching."""
+
+    def __init__(self, search=0.5, min_score=0.55):
+        self.search = search
+        self.min_score = min_score
+        self.box = None
+        self.template = None
+        self.score = None
+
+    def init(self, gray, box):
+        x, y, w, h = box
+        self.box = box
+        self.template = gray[y:y + h, x:x + w].copy()
+        self.score = 1.0
+
+    def update(self, gray):
+        """New box for the face in gray, or None once it is lost."""
+        if self.box is None:
+            return None
+        x, y, w, h = self.box
+        pad = int(self.search * max(w, h))
+        x0, y0 = max(0, x - pad), max(0, y - pad)
+        x1, y1 = min(gray.shape[1], x + w + pad), min(gray.shape[0], y + h + pad)
+        region = gray[y0:y1, x0:x1]
+        if region.shape[0] < h or region.shape[1] < w:
+            self.box = None
+            return None
+        res = cv2.matchTemplate(region, self.template, cv2.TM_CCOEFF_NORMED)
+        _, score, _, (lx, ly) = cv2.minMaxLoc(res)
+        self.score = float(score)
+        if score < self.min_score:
+            self.box = None
+            return None
+        self.init(gray, (x0 + lx, y0 + ly, w, h))
+        return self.box
+
+
+class StreamUnlock:
+    def __init__(self, engine, identify, detector, threshold, margin, detect_every=5,
+                 min_frames=3, max_frames=12, min_sharpness=60.0, embed_interval=0.15):
+        """identify(probe) is the gallery lookup (FaceGallery.identify)."""
+        self.engine = engine
+        self.identify = identify
+        self.detector = detector
+        self.threshold = threshold
+        self.margin = margin
+        self.detect_every = max(1, detect_every)
+        self.min_frames = min_frames
+        self.max_frames = max_frames
+        self.min_sharpness = min_sharpness
+        self.embed_interval = embed_interval
+        self.tracker = TemplateTracker()
+        self.counts = {"frames": 0, "detections": 0, "tracked": 0, "embedded": 0, "blurry": 0, "lost": 0}
+        self._last_detect = None
+        self._last_embed = 0.0
+        self._track = []  # (unit embedding, per-frame best user) for the current track
+        self.best = None  # closest result so far, reported on reject
+
+    def _lose(self):
+        if self.tracker.box is not None or self._track:
+            self.counts["lost"] += 1
+        self.tracker.box = None
+        self._track = []
+
+    def feed(self, bgr):
+        """Process one frame; returns a state dict ("searching", "tracking", "match" or "reject")."""
+        n = self.counts["frames"] = self.counts["frames"] + 1
+        gray = cv2.cvtColor(bgr, cv2.COLOR_BGR2GRAY)
+        due = self._last_detect is None or n - self._last_detect >= self.detect_every
+        if not due and self.tracker.box is None:
+            return {"state": "searching"}  # nobody there: detect on every Nth frame only
+        if due:
+            self._last_detect = n
+            self.counts["detections"] += 1
+            hit = self.detector.locate(gray)
+            if hit is None:
+                self._lose()
+                return {"state": "searching"}
+            self.tracker.init(gray, hit[0])
+            box = hit[0]
+        else:
+            box = self.tracker.update(gray)
+            if box is None:
+                self._lose()
+                return {"state": "searching"}
+            self.counts["tracked"] += 1
+
+        now = time.monotonic()
+        if now - self._last_embed < self.embed_interval:
+            return {"state": "tracking", "collected": len(self._track)}
+        crop = self.detector.crop(bgr, gray, box)
+        if sharpness(cv2.cvtColor(crop, cv2.COLOR_BGR2GRAY)) < self.min_sharpness:
+            self.counts["blurry"] += 1
+            return {"state": "tracking", "collected": len(self._track)}
+
+        self._last_embed = now
+        vec = normalize(self.engine.embed_face(crop))
+        self.counts["embedded"] += 1
+        single = self.identify(vec)
+        if single is None:
+            return {"state": "reject", "reason": "no enrolled users"}
+        self._track.append((vec, single["user"]))
+        if len(self._track) >= self.min_frames:
+            match = self.identify(normalize(np.mean([v for v, _ in self._track], axis=0)))
+            agree = sum(1 for _, user in self._track if user == match["user"])
+            if self.best is None or match["distance"] < self.best["distance"]:
+                self.best = match
+            if (match["distance"] <= self.threshold and agree * 2 > len(self._track)
+                    and (match["margin"] is None or match["margin"] >= self.margin)):
+                return {"state": "match", "user": match["user"], "distance": match["distance"],
+                        "frames": len(self._track), "agree": agree}
+        if self.counts["embedded"] >= self.max_frames:
+            return {"state": "reject", "reason": "face not recognized",
+                    "best_distance": None if self.best is None else self.best["distance"]}
+        return {"state": "tracking", "collected": len(self._track)}
@@ -0,0 +1,42 @@
+"""Lock files shared by the worker processes.
+
+``FileLock`` is a blocking exclusive lock for short critical sections
+(journal appends, compaction); ``try_lock`` takes one without waiting, for
+jobs only one worker should run (start-up rebuilds, the inference server,
+retention sweeps). Both are no-ops on Windows, where there is one process.
+"""
+try:
+    import fcntl
+except ImportError:  # Windows dev boxes; single process there anyway
+    fcntl = None
+
+
+class FileLock:
+    def __init__(self, path):
+        self.path = path
+        self._fh = None
+
+    def __enter__(self):
+        self._fh = open(self.path, "a+")
+        if fcntl is not None:
+            fcntl.flock(self._fh.fileno(), fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        if fcntl is not None:
+            fcntl.flock(self._fh.fileno(), fcntl.LOCK_UN)
+        self._fh.close()
+        self._fh = None
+
+
+def try_lock(path):
+    """Non-blocking exclusive lock; returns the open file (close it to release) or None if held."""
+    fh = open(path, "a+")
+    if fcntl is None:
+        return fh
+    try:
+        fcntl.flock(fh.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        fh.close()
+        return None
+    return fh
@@ -0,0 +1,146 @@
+"""Registry of lock controllers and concurrent fan-out across them.
+
+Each door has an ID, a base URL and its own API key. Doors come from a JSON
+file (``DOORS_CONFIG``) or inline JSON (``DOORS``); without either, the
+single ``DEVICE_IP``/``DEVICE_API_KEY`` controller is door ``main``, so a
+one-door install keeps working unchanged:
+
+    {"front": {"ip": "10.0.0.21", "key": "...", "name": "Front door"},
+     "garage": {"url": "http://10.0.0.22:8080", "key": "..."}}
+
+Every door gets its own pooled ``DeviceClient`` (and so its own circuit
+breaker) and its own ``StatusCache``. ``DeviceFleet.fan_out`` runs one
+call per door on a shared thread pool and waits at most ``timeout``, so
+"lock all doors" or a fleet-wide status costs about as long as the slowest
+door instead of the sum of all of them; doors still pending at the
+deadline are reported as timed out.
+"""
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from status_cache import StatusCache
+
+
+class UnknownDoor(KeyError):
+    pass
+
+
+class Door:
+    def __init__(self, door_id, url, key, name=None):
+        self.id = door_id
+        self.url = url.rstrip("/")
+        self.key = key
+        self.name = name or door_id
+
+    def to_dict(self):
+        # Never expose the key.
+        return {"id": self.id, "name": self.name, "url": self.url}
+
+
+def load_doors(config=None, default_ip=None, default_key=None):
+    """Doors from a JSON file path or JSON text; falls back to one "main" door."""
+    if config:
+        if os.path.exists(config):
+            with open(config) as f:
+                data = json.load(f)
+        else:
+            data = json.loads(config)
+        if isinstance(data, list):
+            data = {d["id"]: d for d in data}
+        doors = {}
+        for door_id, d in data.items():
+            url = d.get("url") or f"http://{d['ip']}"
+            doors[door_id] = Door(door_id, url, d.get("key", default_key), d.get("name"))
+        if not doors:
+            raise ValueError("door registry is empty")
+        return doors
+    return {"main": Door("main", f"http://{default_ip}", default_key, "Main door")}
+
+
+class DeviceFleet:
+    def __init__(self, doors, make_client, fetch_status, status_max_age=1.0, max_workers=32):
+        """make_client(door) -> DeviceClient; fetch_status(door, client) -> status dict."""
+        self.doors = doors
+        self.default = next(iter(doors))
+        self.clients = {door_id: make_client(door) for door_id, door in doors.items()}
+        self.caches = {door_id: StatusCache(lambda d=door: fetch_status(d, self.clients[d.id]), max_age=status_max_age)
+                       for door_id, door in doors.items()}
+        self.max_workers = max(1, min(max_workers, len(doors)))
+        self._pool = None
+        self._lock = threading.Lock()
+        self.fan_outs = 0
+        self.timeouts = 0
+
+    def door(self, door_id=None):
+        door_id = door_id or self.default
+        try:
+            return self.doors[door_id]
+        except KeyError:
+            raise UnknownDoor(door_id) from None
+
+    def client(self, door_id=None):
+        return self.clients[self.door(door_id).id]
+
+    def cache(self, door_id=None):
+        return self.caches[self.door(door_id).id]
+
+    def resolve(self, selector):
+        """Door IDs for "all", one ID, or a list of IDs; raises UnknownDoor, or ValueError for anything else."""
+        if selector == "all":
+            return list(self.doors)
+        if isinstance(selector, str):
+            ids = [selector]
+        elif isinstance(selector, list) and selector and all(isinstance(d, str) for d in selector):
+            ids = selector
+        else:
+            raise ValueError('door must be a door ID, a non-empty list of door IDs, or "all"')
+        for door_id in ids:
+            self.door(door_id)
+        return ids
+
+    def _executor(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="fleet")
+            return self._pool
+
+    def fan_out(self, door_ids, fn, timeout):
+        """Run fn(door) for every door concurrently; returns ({door_id: result}, elapsed_s).
+
+        A door whose call raises maps to {"ok": False, "error": ...}; one
+        still running after timeout maps to a timeout error (its call keeps
+        running in the background and is not cancelled).
+        """
+        start = time.perf_counter()
+        pool = self._executor()
+        futures = {pool.submit(fn, self.doors[d]): d for d in door_ids}
+        done, pending = wait(futures, timeout=timeout)
+        results = {}
+        for fut, door_id in futures.items():
+            if fut in pending:
+                results[door_id] = {"ok": False, "error": f"timed out after {timeout:.1f}s"}
+                continue
+            try:
+                results[door_id] = fut.result()
+            except Exception as e:
+                results[door_id] = {"ok": False, "error": str(e)}
+        with self._lock:
+            self.fan_outs += 1
+            self.timeouts += len(pending)
+        return results, time.perf_counter() - start
+
+    def shutdown(self):
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=False)
+
+    def stats(self):
+        with self._lock:
+            out = {"doors": len(self.doors), "max_workers": self.max_workers,
+                   "fan_outs": self.fan_outs, "timeouts": self.timeouts}
+        out["breakers"] = {door_id: c.breaker.state for door_id, c in self.clients.items()}
+        return out
@@ -0,0 +1,237 @@
+"""Matrix-backed face gallery.
+
+All enrolled embeddings are kept L2-normalised in one contiguous float32
+matrix with a parallel label list, so matching a probe is a single
+matrix-vector product followed by argmin/top-k instead of a Python loop.
+A user may own several rows (one per enrollment image, or a few cluster
+centroids), which keeps lighting/glasses/pose variation instead of
+averaging it away.
+"""
+import threading
+
+import numpy as np
+
+
+def normalize(vec):
+    vec = np.asarray(vec, dtype=np.float32).reshape(-1)
+    norm = float(np.linalg.norm(vec))
+    return vec / (norm + 1e-10)
+
+
+def normalize_rows(mat):
+    mat = np.atleast_2d(np.asarray(mat, dtype=np.float32))
+    return mat / (np.linalg.norm(mat, axis=1, keepdims=True) + 1e-10)
+
+
+def reduce_embeddings(vectors, max_k, iterations=10):
+    """At most max_k representative rows: all of them, or k spherical k-means centroids."""
+    unit = normalize_rows(np.stack(vectors) if isinstance(vectors, list) else vectors)
+    if len(unit) <= max_k:
+        return unit
+    # Farthest-point seeding keeps distinct looks (e.g. with/without glasses)
+    # in separate clusters.
+    centroids = [unit[0]]
+    for _ in range(1, max_k):
+        sims = np.max(unit @ np.stack(centroids).T, axis=1)
+        centroids.append(unit[int(np.argmin(sims))])
+    centroids = np.stack(centroids)
+    for _ in range(iterations):
+        assign = np.argmax(unit @ centroids.T, axis=1)
+        for c in range(max_k):
+            members = unit[assign == c]
+            if len(members):
+                centroids[c] = members.mean(axis=0)
+        centroids = normalize_rows(centroids)
+    return centroids
+
+
+class FaceGallery:
+    def __init__(self, dim=None, capacity=64):
+        self.dim = dim
+        self._capacity = capacity
+        self._matrix = None if dim is None else np.zeros((capacity, dim), dtype=np.float32)
+        self._labels = []  # label of each row
+        self._codes = np.zeros(capacity, dtype=np.int32)  # integer id of each row's label
+        self._rows = {}  # label -> list of row indices
+        self._label_codes = {}
+        self._lock = threading.Lock()
+        self.index = None  # optional ANN index (see ann_index.py)
+        self.ann_min_rows = 0
+
+    @classmethod
+    def from_dict(cls, embeddings):
+        gallery = cls()
+        for label, vecs in embeddings.items():
+            gallery.add(label, vecs)
+        return gallery
+
+    def __len__(self):
+        """Number of enrolled identities."""
+        return len(self._rows)
+
+    def __contains__(self, label):
+        return label in self._rows
+
+    def row_count(self):
+        return len(self._labels)
+
+    def attach_index(self, index, min_rows=0):
+        """Mirror every add/remove into index and use it once there are min_rows rows."""
+        with self._lock:
+            index.add_many({label: self._matrix[rows] for label, rows in self._rows.items()})
+            self.index = index
+            self.ann_min_rows = min_rows
+
+    def use_ann(self):
+        return self.index is not None and len(self._labels) >= self.ann_min_rows
+
+    def labels(self):
+        return list(self._rows)
+
+    def get(self, label):
+        with self._lock:
+            rows = self._rows.get(label)
+            return None if rows is None else self._matrix[rows].copy()
+
+    def to_dict(self):
+        with self._lock:
+            return {label: self._matrix[rows].copy() for label, rows in self._rows.items()}
+
+    def _ensure_capacity(self, n):
+        if self._matrix.shape[0] >= n:
+            return
+        size = max(n, self._matrix.shape[0] * 2)
+        grown = np.zeros((size, self.dim), dtype=np.float32)
+        grown[:len(self._labels)] = self._matrix[:len(self._labels)]
+        self._matrix = grown
+        codes = np.zeros(size, dtype=np.int32)
+        codes[:len(self._labels)] = self._codes[:len(self._labels)]
+        self._codes = codes
+
+    def add(self, label, vecs):
+        """Insert label's embeddings (1-D or 2-D), replacing any it already had."""
+        vecs = normalize_rows(vecs)
+        with self._lock:
+            if self.dim is None:
+                self.dim = vecs.shape[1]
+                self._matrix = np.zeros((self._capacity, self.dim), dtype=np.float32)
+            if vecs.shape[1] != self.dim:
+                raise ValueError(f"embedding dim {vecs.shape[1]} does not match gallery dim {self.dim}")
+            self._remove_locked(label)
+            code = self._label_codes.setdefault(label, len(self._label_codes))
+            start = len(self._labels)
+            self._ensure_capacity(start + len(vecs))
+            self._matrix[start:start + len(vecs)] = vecs
+            self._codes[start:start + len(vecs)] = code
+            self._labels.extend([label] * len(vecs))
+            self._rows[label] = list(range(start, start + len(vecs)))
+            if self.index is not None:
+                self.index.add(label, vecs)
+
+    def remove(self, label):
+        with self._lock:
+            if self.index is not None:
+                self.index.remove(label)
+            return self._remove_locked(label)
+
+    def _remove_locked(self, label):
+        rows = self._rows.pop(label, None)
+        if rows is None:
+            return False
+        # Fill each hole with the current last row so the matrix stays
+        # contiguous. Going from the highest row down guarantees the last row
+        # is either the hole itself or a row we are keeping.
+        for row in sorted(rows, reverse=True):
+            last = len(self._labels) - 1
+            if row != last:
+                moved = self._labels[last]
+                self._matrix[row] = self._matrix[last]
+                self._codes[row] = self._codes[last]
+                self._labels[row] = moved
+                moved_rows = self._rows[moved]
+                moved_rows[moved_rows.index(last)] = row
+            self._labels.pop()
+        return True
+
+    def distances(self, probe):
+        """Cosine distance from probe to every enrolled row, plus the row labels."""
+        p = normalize(probe)
+        with self._lock:
+            n = len(self._labels)
+            if n == 0:
+                return np.zeros(0, dtype=np.float32), []
+            return 1.0 - self._matrix[:n] @ p, list(self._labels)
+
+    def match(self, probe, k=1):
+        """Return up to k (label, distance) rows, nearest first."""
+        dists, labels = self.distances(probe)
+        n = len(labels)
+        if n == 0:
+            return []
+        k = min(k, n)
+        if k == 1:
+            idx = np.array([int(np.argmin(dists))])
+        else:
+            idx = np.argpartition(dists, k - 1)[:k]
+            idx = idx[np.argsort(dists[idx])]
+        return [(labels[i], float(dists[i])) for i in idx]
+
+    def identify(self, probe, k=5):
+        """Top-k neighbours aggregated per identity, with the margin to the runner-up.
+
+        Returns None for an empty gallery, otherwise a dict with the best user,
+        its nearest distance, how many of the k neighbours voted for it, and
+        the nearest distance of the best *other* identity.
+        """
+        p = normalize(probe)
+        if self.use_ann():
+            return self._identify_ann(p, k)
+        with self._lock:
+            n = len(self._labels)
+            if n == 0:
+                return None
+            dists = 1.0 - self._matrix[:n] @ p
+            codes = self._codes[:n]
+            k = min(k, n)
+            idx = np.argpartition(dists, k - 1)[:k] if k < n else np.arange(n)
+            idx = idx[np.argsort(dists[idx])]
+            labels = [self._labels[i] for i in idx]
+            best = labels[0]
+            best_code = codes[idx[0]]
+            # Runner-up is computed over the whole gallery, not just the
+            # top-k, so the margin is meaningful even if best owns every vote.
+            others = np.where(codes == best_code, np.inf, dists)
+            j = int(np.argmin(others))
+            second = None if not np.isfinite(others[j]) else self._labels[j]
+            second_distance = float(others[j]) if second is not None else None
+        best_distance = float(dists[idx[0]])
+        return {
+            "user": best,
+            "distance": best_distance,
+            "votes": labels.count(best),
+            "k": k,
+            "second_user": second,
+            "second_distance": second_distance,
+            "margin": None if second is None else second_distance - best_distance,
+        }
+
+    def _identify_ann(self, p, k):
+        # Pull a few more candidates than k so the runner-up identity is
+        # usually among them; if it is not, the margin is left open (None).
+        with self._lock:
+            candidates = self.index.search(p, k=max(4 * k, 32))
+        if not candidates:
+            return None
+        best, best_distance = candidates[0]
+        top = [label for label, _ in candidates[:k]]
+        second = next(((label, d) for label, d in candidates if label != best), None)
+        return {
+            "user": best,
+            "distance": best_distance,
+            "votes": top.count(best),
+            "k": len(top),
+            "second_user": None if second is None else second[0],
+            "second_distance": None if second is None else second[1],
+            "margin": None if second is None else second[1] - best_distance,
+            "ann": True,
+        }
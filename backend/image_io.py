@@ -0,0 +1,125 @@
+"""Bounded decoding of uploaded face images.
+
+Face uploads arrive as multipart files, a raw ``image/jpeg`` body, or the
+older base64 data-URLs in JSON. Each image is size-checked before it is
+decoded, and JPEGs are decoded straight at 1/2, 1/4 or 1/8 scale
+(``IMREAD_REDUCED_COLOR_*``) so a 12 MP phone frame never becomes a full
+resolution array when the detector only needs a few hundred pixels.
+"""
+import base64
+import binascii
+import struct
+
+import cv2
+import numpy as np
+
+_REDUCED = ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4),
+            (2, cv2.IMREAD_REDUCED_COLOR_2))
+# JPEG start-of-frame markers (C4, C8 and CC are tables, not frames).
+_SOF = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+
+class ImageError(ValueError):
+    pass
+
+
+class ImageTooLarge(ImageError):
+    pass
+
+
+def image_size(data):
+    """(width, height) read from a JPEG or PNG header without decoding, or None."""
+    if data[:8] == b"\x89PNG\r\n\x1a\n" and len(data) >= 24:
+        return struct.unpack(">II", data[16:24])
+    if data[:2] != b"\xff\xd8":
+        return None
+    i, n = 2, len(data)
+    while i + 4 <= n:
+        if data[i] != 0xFF:
+            return None
+        marker = data[i + 1]
+        if marker == 0xFF:  # fill byte
+            i += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD8:  # standalone markers
+            i += 2
+            continue
+        length = struct.unpack(">H", data[i + 2:i + 4])[0]
+        if marker in _SOF and i + 9 <= n:
+            h, w = struct.unpack(">HH", data[i + 5:i + 9])
+            return w, h
+        i += 2 + length
+    return None
+
+
+def decode_image(data, max_side=640, max_pixels=40_000_000):
+    """Decode JPEG/PNG bytes to BGR with the long side at most max_side.
+
+    Raises ImageTooLarge for images with more than max_pixels pixels and
+    ImageError for anything OpenCV cannot decode.
+    """
+    if not data:
+        raise ImageError("empty image")
+    size = image_size(data)
+    flag = cv2.IMREAD_COLOR
+    if size is not None:
+        w, h = size
+        if w * h > max_pixels:
+            raise ImageTooLarge(f"image is {w}x{h}, over the {max_pixels} pixel limit")
+        if data[:2] == b"\xff\xd8":
+            # Largest libjpeg scale that still leaves at least max_side.
+            flag = next((f for s, f in _REDUCED if max(w, h) // s >= max_side), cv2.IMREAD_COLOR)
+    bgr = cv2.imdecode(np.frombuffer(data, np.uint8), flag)
+    if bgr is None:
+        raise ImageError("could not decode image")
+    long_side = max(bgr.shape[:2])
+    if long_side > max_side:
+        scale = max_side / float(long_side)
+        bgr = cv2.resize(bgr, (round(bgr.shape[1] * scale), round(bgr.shape[0] * scale)),
+                         interpolation=cv2.INTER_AREA)
+    return bgr
+
+
+def from_data_url(value, max_bytes):
+    """Bytes of a base64 image (optionally a data: URL); None if it is not valid base64."""
+    b64 = value.split(",", 1)[1] if "," in value else value
+    if len(b64) * 3 // 4 > max_bytes:
+        raise ImageTooLarge(f"image is over the {max_bytes} byte limit")
+    try:
+        return base64.b64decode(b64)
+    except (binascii.Error, ValueError):
+        return None
+
+
+def request_images(req, json_field, max_bytes):
+    """Raw bytes of every image in a Flask request, plus its non-image fields.
+
+    Accepts multipart/form-data (any file field), a raw ``image/*`` body
+    (fields then come from the query string) or JSON with a base64 data-URL,
+    or a list of them, under json_field. Entries that are not valid base64
+    come back as None so the caller can skip or reject them.
+    """
+    content_type = (req.mimetype or "").lower()
+    if content_type == "multipart/form-data":
+        blobs = []
+        for key in req.files:
+            for f in req.files.getlist(key):
+                data = f.read(max_bytes + 1)
+                if len(data) > max_bytes:
+                    raise ImageTooLarge(f"image is over the {max_bytes} byte limit")
+                blobs.append(data)
+        return blobs, req.form.to_dict()
+    if content_type.startswith("image/"):
+        data = req.get_data(cache=False)
+        if len(data) > max_bytes:
+            raise ImageTooLarge(f"image is over the {max_bytes} byte limit")
+        return [data], req.args.to_dict()
+    data = req.get_json(silent=True) or {}
+    value = data.get(json_field) or []
+    if isinstance(value, str):
+        value = [value]
+    if not isinstance(value, list):
+        raise ImageError(f"{json_field} must be a base64 image or a list of them")
+    blobs = [from_data_url(v, max_bytes) if isinstance(v, str) else None for v in value]
+    fields = {k: v for k, v in data.items() if k != json_field}
+    return blobs, fields
@@ -0,0 +1,491 @@
+"""Face inference in one long-lived process, shared by all web workers.
+
+DeepFace pulls in TensorFlow, which costs every process that loads it
+seconds of start-up and hundreds of MB of RSS. With ``FACE_INFERENCE=server``
+the web workers never import it: ``RemoteFaceEngine`` has the FaceEngine
+interface the app uses and forwards frames over a Unix socket to this
+server, which holds the only copy of the model. Requests from all workers
+meet in one MicroBatcher here, so batching works across workers too.
+
+Messages are a fixed header (JSON length, payload length), a JSON header
+and the raw bytes of any numpy arrays it describes, so frames and
+embeddings cross the socket without an encode/decode step.
+
+The first web worker to need the server starts it; the server holds a lock
+file for its lifetime so racing workers cannot start two, and writes its pid
+and configuration (model, detector, batching, a hash of its code) into it.
+A worker that finds a server started with anything else restarts it if a
+worker started it, and refuses to use it otherwise. It can also run on its
+own, e.g. under a process supervisor:
+
+    python inference_server.py --socket inference.sock
+"""
+import json
+import os
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+import zlib
+from collections import Counter
+
+import numpy as np
+
+from file_lock import try_lock
+
+HEADER = struct.Struct("!II")  # JSON header length, payload length
+# Code the server runs: a deploy that changes any of it changes the config hash.
+SERVER_SOURCES = ("inference_server.py", "face_engine.py", "batcher.py")
+
+
+class InferenceError(RuntimeError):
+    """The server failed the request, or could not be reached."""
+
+
+# ---- wire format ------------------------------------------------------------
+def _recv_exact(sock, n):
+    buf = bytearray(n)
+    view = memoryview(buf)
+    got = 0
+    while got < n:
+        k = sock.recv_into(view[got:], n - got)
+        if not k:
+            raise ConnectionError("inference socket closed")
+        got += k
+    return buf
+
+
+def _json_default(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def send_msg(sock, header, arrays=()):
+    specs, chunks, offset = [], [], 0
+    for arr in arrays:
+        arr = np.ascontiguousarray(arr)
+        specs.append({"shape": arr.shape, "dtype": arr.dtype.str, "offset": offset})
+        chunks.append(arr.data)
+        offset += arr.nbytes
+    data = json.dumps({**header, "arrays": specs}, default=_json_default).encode()
+    sock.sendall(HEADER.pack(len(data), offset) + data)
+    for chunk in chunks:
+        sock.sendall(chunk)
+
+
+def recv_msg(sock):
+    json_len, payload_len = HEADER.unpack(_recv_exact(sock, HEADER.size))
+    header = json.loads(_recv_exact(sock, json_len))
+    payload = _recv_exact(sock, payload_len) if payload_len else b""
+    arrays = []
+    for spec in header.pop("arrays", []):
+        dtype = np.dtype(spec["dtype"])
+        count = int(np.prod(spec["shape"])) if spec["shape"] else 1
+        arrays.append(np.frombuffer(payload, dtype, count, spec["offset"]).reshape(spec["shape"]))
+    return header, arrays
+
+
+# ---- configuration ----------------------------------------------------------
+def server_config(model, detector, detect_mode="single", batching=True, batch_max=8, batch_wait_ms=5.0,
+                  fast_min_weight=4.0, fast_min_size=80):
+    """Everything a worker expects of the server it talks to, as stored in the lock file."""
+    here = os.path.dirname(os.path.abspath(__file__))
+    code = 0
+    for name in SERVER_SOURCES:
+        with open(os.path.join(here, name), "rb") as fh:
+            code = zlib.crc32(fh.read(), code)
+    return {"model": str(model), "detector": str(detector), "detect_mode": str(detect_mode),
+            "batching": bool(batching), "batch_max": int(batch_max), "batch_wait_ms": float(batch_wait_ms),
+            "fast_min_weight": float(fast_min_weight), "fast_min_size": int(fast_min_size),
+            "code": f"{code:08x}"}
+
+
+def read_server_info(socket_path):
+    """{"pid", "spawned", "config"} as written by the running server, or None."""
+    try:
+        with open(socket_path + ".lock") as fh:
+            return json.loads(fh.read() or "null")
+    except (OSError, ValueError):
+        return None
+
+
+def _peer_pid(sock):
+    try:
+        creds = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i"))
+    except (AttributeError, OSError):  # not Linux
+        return None
+    return struct.unpack("3i", creds)[0]
+
+
+# ---- server -----------------------------------------------------------------
+class InferenceServer:
+    def __init__(self, socket_path, engine, batching=True, max_batch=8, max_wait_ms=5.0, config=None,
+                 spawned=False):
+        from batcher import MicroBatcher
+
+        self.socket_path = socket_path
+        self.engine = engine
+        self.config = config
+        self.spawned = spawned  # started by a web worker, which may restart it
+        self.batcher = MicroBatcher(self._run_batch, max_batch=max_batch, max_wait_ms=max_wait_ms,
+                                    name="inference-batcher") if batching else None
+        self.counters = Counter()
+        self._lock = threading.Lock()
+        self._timings = threading.local()
+        engine.on_timing = self._on_timing
+        self._sock = None
+
+    def _on_timing(self, stage, seconds):
+        timings = getattr(self._timings, "items", None)
+        if timings is not None:
+            timings.append((stage, seconds))
+
+    def _timed(self, fn, *args):
+        self._timings.items = []
+        try:
+            return fn(*args), self._timings.items
+        finally:
+            self._timings.items = None
+
+    def _run_batch(self, items):
+        # Frames of one batch share a detector setting unless callers differ.
+        results = [None] * len(items)
+        groups = {}
+        for i, (frame, enforce, fast) in enumerate(items):
+            groups.setdefault((enforce, fast), []).append(i)
+        for (enforce, fast), idx in groups.items():
+            out, timings = self._timed(self.engine.analyze_batch, [items[i][0] for i in idx], enforce, fast)
+            for i, r in zip(idx, out):
+                results[i] = (r, timings)
+        return results
+
+    def _analyze(self, frames, enforce, fast):
+        if self.batcher is None:
+            out, timings = self._timed(self.engine.analyze_batch, frames, enforce, fast)
+            return [(r, timings) for r in out]
+        futures = [self.batcher.submit_async((f, enforce, fast)) for f in frames]
+        out = []
+        for fut in futures:
+            try:
+                out.append(fut.result())
+            except Exception as e:  # the whole batch failed
+                out.append((e, []))
+        return out
+
+    def _count(self, name, n=1):
+        with self._lock:
+            self.counters[name] += n
+
+    def handle(self, header, arrays):
+        op = header.get("op")
+        if op == "ping":
+            return {"ok": True, "ready": self.engine.ready, "pid": os.getpid()}, []
+        if op == "load":
+            self.engine.load()
+            return {"ok": True, "ready": True}, []
+        if op == "stats":
+            return {"ok": True, "stats": self.stats()}, []
+        if op == "analyze":
+            self._count("frames", len(arrays))
+            out = self._analyze(arrays, header.get("enforce_detection", True), header.get("fast"))
+        elif op == "embed":
+            self.engine.load()
+            self._count("crops", len(arrays))
+            out = []
+            for crop in arrays:
+                try:
+                    vec, timings = self._timed(self.engine.embed_face, crop, header.get("path", "stream"))
+                    out.append(((vec, {}), timings))
+                except Exception as e:
+                    out.append((e, []))
+        else:
+            return {"ok": False, "error": f"unknown op {op!r}"}, []
+        results, vectors = [], []
+        for result, timings in out:
+            if isinstance(result, Exception):
+                self._count("errors")
+                results.append({"ok": False, "error": str(result), "type": type(result).__name__})
+            else:
+                vec, info = result
+                results.append({"ok": True, "info": info, "timings": timings})
+                vectors.append(np.asarray(vec, dtype=np.float32))
+        return {"ok": True, "results": results}, vectors
+
+    def _serve_conn(self, conn):
+        with conn:
+            while True:
+                try:
+                    header, arrays = recv_msg(conn)
+                except (ConnectionError, OSError):
+                    return
+                try:
+                    reply, out = self.handle(header, arrays)
+                except Exception as e:
+                    reply, out = {"ok": False, "error": f"{type(e).__name__}: {e}"}, []
+                try:
+                    send_msg(conn, reply, out)
+                except OSError:
+                    return
+
+    def serve_forever(self):
+        lock = try_lock(self.socket_path + ".lock")
+        if lock is None:
+            print(f"[INFO] Inference server already running on {self.socket_path}")
+            return False
+        lock.seek(0)
+        lock.truncate()
+        lock.write(json.dumps({"pid": os.getpid(), "spawned": self.spawned, "config": self.config}))
+        lock.flush()
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)  # stale: its server would hold the lock
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # Owner-only from the moment it exists, not after a chmod.
+        old_umask = os.umask(0o177)
+        try:
+            self._sock.bind(self.socket_path)
+        finally:
+            os.umask(old_umask)
+        self._sock.listen(64)
+        print(f"[INFO] Inference server {os.getpid()} listening on {self.socket_path}")
+        try:
+            while True:
+                conn, _ = self._sock.accept()
+                self._count("connections")
+                threading.Thread(target=self._serve_conn, args=(conn,), name="inference-conn", daemon=True).start()
+        finally:
+            self._sock.close()
+            lock.close()
+
+    def stats(self):
+        with self._lock:
+            out = dict(self.counters)
+        out["pid"] = os.getpid()
+        out["ready"] = self.engine.ready
+        out["load_seconds"] = self.engine.load_seconds
+        out["path_counts"] = dict(self.engine.path_counts)
+        out["batching"] = self.batcher.stats() if self.batcher is not None else None
+        return out
+
+
+# ---- client -----------------------------------------------------------------
+def spawn_server(socket_path, config=None):
+    """Start a detached server; a duplicate exits at once if one already holds the lock."""
+    args = [sys.executable, "-u", os.path.abspath(__file__), "--socket", socket_path, "--spawned"]
+    if config is not None:
+        args += ["--model", config["model"], "--detector", config["detector"],
+                 "--detect-mode", config["detect_mode"], "--batch-max", str(config["batch_max"]),
+                 "--batch-wait-ms", str(config["batch_wait_ms"]),
+                 "--fast-min-weight", str(config["fast_min_weight"]),
+                 "--fast-min-size", str(config["fast_min_size"])]
+        if not config["batching"]:
+            args.append("--no-batching")
+    log = open(os.path.splitext(socket_path)[0] + ".log", "ab")
+    return subprocess.Popen(args, stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT,
+                            start_new_session=True)
+
+
+class RemoteFaceEngine:
+    """FaceEngine stand-in that runs detection and embedding in the inference server."""
+
+    def __init__(self, socket_path, timeout=30.0, connect_timeout=60.0, spawn=True, config=None):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout  # covers spawning the server
+        self.spawn = spawn
+        self.config = config  # see server_config(); None accepts any server
+        self.cascade = None  # the Haar fast path runs in the server
+        self.on_timing = None
+        self._local = threading.local()
+        self._spawn_lock = threading.Lock()
+        self._last_spawn = 0.0
+
+    def _connect(self, wait=True):
+        deadline = time.monotonic() + (self.connect_timeout if wait else 0)
+        while True:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(self.socket_path)
+            except OSError as e:
+                sock.close()
+                if not (self.spawn and wait) or time.monotonic() >= deadline:
+                    raise InferenceError(f"inference server unavailable at {self.socket_path}: {e}") from e
+            else:
+                if self._check_server(sock):
+                    sock.settimeout(self.timeout)
+                    return sock
+                continue  # stopped a stale server; start ours
+            with self._spawn_lock:
+                if time.monotonic() - self._last_spawn > 10.0:
+                    self._last_spawn = time.monotonic()
+                    print(f"[INFO] Starting inference server on {self.socket_path}")
+                    spawn_server(self.socket_path, self.config)
+            time.sleep(0.1)
+
+    def _check_server(self, sock):
+        """True if the server behind sock runs our config; otherwise stop it (False) or refuse it."""
+        if self.config is None:
+            return True
+        info = read_server_info(self.socket_path) or {}
+        if info.get("config") == self.config:
+            return True
+        pid = _peer_pid(sock) or info.get("pid")
+        sock.close()
+        # Servers from before the lock recorded anything were all worker-started.
+        if not self.spawn or not info.get("spawned", True) or pid is None:
+            raise InferenceError(f"inference server {pid or ''} on {self.socket_path} runs a different "
+                                 f"configuration; restart it")
+        print(f"[WARN] Inference server {pid} runs a different configuration; restarting it")
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+        # Wait for its lock to go so the replacement does not exit as a duplicate.
+        deadline = time.monotonic() + 10.0
+        while time.monotonic() < deadline:
+            fh = try_lock(self.socket_path + ".lock")
+            if fh is not None:
+                fh.close()
+                break
+            time.sleep(0.05)
+        with self._spawn_lock:
+            self._last_spawn = 0.0
+        return False
+
+    def _drop(self, sock):
+        sock.close()
+        self._local.sock = None
+
+    def _call(self, header, arrays=(), wait=True):
+        """wait=False fails at once instead of starting and waiting for a server (stats, health)."""
+        # One connection per thread. A cached one the server has dropped
+        # (restart) fails while sending; only then is the request resent on
+        # a fresh connection. Once it is sent, a timeout or a lost reply is
+        # final: resending would run the whole batch again.
+        for attempt in (0, 1):
+            sock = getattr(self._local, "sock", None)
+            if sock is None:
+                sock = self._local.sock = self._connect(wait)
+            try:
+                send_msg(sock, header, arrays)
+            except OSError as e:
+                self._drop(sock)
+                if attempt or not isinstance(e, ConnectionError):
+                    raise InferenceError(f"inference server connection lost: {e}") from e
+                continue
+            try:
+                reply, out = recv_msg(sock)
+            except socket.timeout as e:
+                self._drop(sock)
+                raise InferenceError(f"inference timed out after {self.timeout:g}s") from e
+            except OSError as e:
+                self._drop(sock)
+                raise InferenceError(f"inference server connection lost: {e}") from e
+            break
+        if not reply.get("ok"):
+            raise InferenceError(reply.get("error", "inference failed"))
+        return reply, out
+
+    @property
+    def ready(self):
+        try:
+            return bool(self._call({"op": "ping"}, wait=False)[0]["ready"])
+        except InferenceError:
+            return False
+
+    @property
+    def path_counts(self):
+        try:
+            return self.stats()["path_counts"]
+        except InferenceError:
+            return {}
+
+    def stats(self):
+        return self._call({"op": "stats"}, wait=False)[0]["stats"]
+
+    def load(self):
+        self._call({"op": "load"})
+
+    def warmup(self):
+        try:
+            self.load()
+        except InferenceError as e:
+            print("[WARN] Inference server warm-up failed:", e)
+
+    def warmup_async(self):
+        t = threading.Thread(target=self.warmup, name="inference-warmup", daemon=True)
+        t.start()
+        return t
+
+    def _results(self, reply, vectors, start):
+        if self.on_timing is not None:
+            self.on_timing("inference_rpc", time.perf_counter() - start)
+        out, vecs = [], iter(vectors)
+        for r in reply["results"]:
+            if not r["ok"]:
+                # The server's exception type is lost; a message is enough
+                # for the callers, which only log and count failures.
+                out.append(InferenceError(f"{r['type']}: {r['error']}"))
+                continue
+            if self.on_timing is not None:
+                for stage, seconds in r["timings"]:
+                    self.on_timing(stage, seconds)
+            out.append((next(vecs).copy(), r["info"]))
+        return out
+
+    def analyze(self, bgr, enforce_detection=True, fast=None):
+        result = self.analyze_batch([bgr], enforce_detection, fast)[0]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def analyze_batch(self, frames, enforce_detection=True, fast=None):
+        start = time.perf_counter()
+        reply, vectors = self._call({"op": "analyze", "enforce_detection": enforce_detection, "fast": fast}, frames)
+        return self._results(reply, vectors, start)
+
+    def embed_face(self, crop, path="stream"):
+        start = time.perf_counter()
+        reply, vectors = self._call({"op": "embed", "path": path}, [crop])
+        result = self._results(reply, vectors, start)[0]
+        if isinstance(result, Exception):
+            raise result
+        return result[0]
+
+
+if __name__ == "__main__":
+    import argparse
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    try:
+        from dotenv import load_dotenv
+        load_dotenv()
+    except ImportError:
+        pass
+    from face_engine import FaceEngine
+
+    parser = argparse.ArgumentParser(description="Shared face inference server")
+    parser.add_argument("--socket", default=os.getenv("INFERENCE_SOCKET", "inference.sock"))
+    parser.add_argument("--model", default=os.getenv("FACE_MODEL", "Facenet"))
+    parser.add_argument("--detector", default=os.getenv("DETECTOR_BACKEND", "mtcnn"))
+    parser.add_argument("--detect-mode", default=os.getenv("FACE_DETECT_MODE", "single"))
+    parser.add_argument("--no-batching", action="store_true", default=os.getenv("FACE_BATCHING", "1") != "1")
+    parser.add_argument("--batch-max", type=int, default=int(os.getenv("FACE_BATCH_MAX", "8")))
+    parser.add_argument("--batch-wait-ms", type=float, default=float(os.getenv("FACE_BATCH_WAIT_MS", "5")))
+    parser.add_argument("--fast-min-weight", type=float, default=float(os.getenv("FAST_DETECT_MIN_WEIGHT", "4.0")))
+    parser.add_argument("--fast-min-size", type=int, default=int(os.getenv("FAST_DETECT_MIN_SIZE", "80")))
+    parser.add_argument("--spawned", action="store_true", help=argparse.SUPPRESS)  # started by a web worker
+    args = parser.parse_args()
+
+    config = server_config(args.model, args.detector, args.detect_mode, not args.no_batching, args.batch_max,
+                           args.batch_wait_ms, args.fast_min_weight, args.fast_min_size)
+    engine = FaceEngine(args.model, args.detector, detect_mode=args.detect_mode,
+                        fast_min_weight=args.fast_min_weight, fast_min_size=args.fast_min_size)
+    server = InferenceServer(args.socket, engine, batching=not args.no_batching, max_batch=args.batch_max,
+                             max_wait_ms=args.batch_wait_ms, config=config, spawned=args.spawned)
+    if os.getenv("FACE_WARMUP", "1") == "1":
+        engine.warmup_async()
+    server.serve_forever()
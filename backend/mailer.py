@@ -0,0 +1,197 @@
+"""Background mail dispatcher.
+
+HTTP handlers enqueue a ready-built message and return immediately. Worker
+threads own one SMTP connection each, keep it open between messages,
+reconnect when the server drops it and retry with exponential backoff.
+"""
+import queue
+import smtplib
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+_STOP = object()
+
+
+class MailDispatcher:
+    def __init__(self, host, port, user=None, password=None, security="ssl",
+                 workers=1, maxsize=100, max_retries=3, backoff=1.0,
+                 idle_timeout=120, timeout=15):
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+        self.security = security  # "ssl", "starttls" or "none" (local test servers)
+        self.workers = workers
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._threads = []
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=512)
+        self.counters = {"enqueued": 0, "sent": 0, "failed": 0, "dropped": 0,
+                         "retries": 0, "connects": 0}
+        self.last_error = None
+        self.on_timing = None  # on_timing("smtp", seconds) per delivery attempt
+
+    # ---- lifecycle -----------------------------------------------------
+    def start(self):
+        with self._lock:
+            self._threads = [t for t in self._threads if t.is_alive()]
+            for i in range(len(self._threads), self.workers):
+                t = threading.Thread(target=self._run, name=f"mail-worker-{i}", daemon=True)
+                t.start()
+                self._threads.append(t)
+
+    def stop(self, timeout=5.0):
+        """Let queued mail drain for up to timeout seconds, then stop the workers."""
+        with self._lock:
+            threads, self._threads = self._threads, []
+        for _ in threads:
+            try:
+                self._queue.put(_STOP, timeout=timeout)
+            except queue.Full:
+                break
+        deadline = time.time() + timeout
+        for t in threads:
+            t.join(max(0.0, deadline - time.time()))
+
+    def submit(self, from_addr, to_addr, msg):
+        """Queue msg for delivery; returns False if the queue is full and it was dropped.
+
+        msg may also be a zero-argument callable returning the message, in
+        which case it is built on the worker thread.
+        """
+        if not self._threads or not all(t.is_alive() for t in self._threads):
+            self.start()
+        try:
+            self._queue.put_nowait((from_addr, to_addr, msg, time.time()))
+        except queue.Full:
+            self._count("dropped")
+            print("[WARN] Mail queue full — dropping message")
+            return False
+        self._count("enqueued")
+        return True
+
+    # ---- metrics -------------------------------------------------------
+    def _count(self, name, n=1):
+        with self._lock:
+            self.counters[name] += n
+
+    def _timing(self, start):
+        if self.on_timing is not None:
+            self.on_timing("smtp", time.perf_counter() - start)
+
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def stats(self):
+        with self._lock:
+            lat = np.array(self._latencies, dtype=np.float64)
+            out = dict(self.counters)
+        out["queue_depth"] = self.queue_depth()
+        out["last_error"] = self.last_error
+        if lat.size:
+            out["send_latency_ms"] = {
+                "avg": round(float(lat.mean()) * 1000, 1),
+                "p50": round(float(np.percentile(lat, 50)) * 1000, 1),
+                "p95": round(float(np.percentile(lat, 95)) * 1000, 1),
+                "max": round(float(lat.max()) * 1000, 1),
+            }
+        return out
+
+    # ---- worker --------------------------------------------------------
+    def _connect(self):
+        if self.security == "ssl":
+            server = smtplib.SMTP_SSL(self.host, self.port, timeout=self.timeout)
+        else:
+            server = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+            if self.security == "starttls":
+                server.starttls()
+        if self.user and self.password:
+            server.login(self.user, self.password)
+        self._count("connects")
+        return server
+
+    @staticmethod
+    def _close(server):
+        if server is None:
+            return
+        try:
+            server.quit()
+        except Exception:
+            try:
+                server.close()
+            except Exception:
+                pass
+
+    def _run(self):
+        server = None
+        last_used = 0.0
+        while True:
+            try:
+                item = self._queue.get(timeout=self.idle_timeout)
+            except queue.Empty:
+                # Nothing to send for a while; don't hold a dead-ish session open.
+                self._close(server)
+                server = None
+                continue
+            if item is _STOP:
+                self._close(server)
+                return
+            from_addr, to_addr, msg, enqueued_at = item
+            try:
+                if callable(msg):
+                    msg = msg()
+                payload = msg.as_string()
+            except Exception as e:
+                self.last_error = f"{type(e).__name__}: {e}"
+                self._count("failed")
+                print("[ERROR] Failed to build email:", e)
+                self._queue.task_done()
+                continue
+            for attempt in range(self.max_retries + 1):
+                attempt_start = time.perf_counter()
+                try:
+                    if server is not None and time.time() - last_used > self.idle_timeout:
+                        self._close(server)
+                        server = None
+                    if server is None:
+                        server = self._connect()
+                    server.sendmail(from_addr, to_addr, payload)
+                    self._timing(attempt_start)
+                    last_used = time.time()
+                    with self._lock:
+                        self.counters["sent"] += 1
+                        self._latencies.append(last_used - enqueued_at)
+                    print("[INFO] Email sent:", msg.get("Subject"))
+                    break
+                except (smtplib.SMTPException, OSError) as e:
+                    self._timing(attempt_start)
+                    self.last_error = f"{type(e).__name__}: {e}"
+                    self._close(server)
+                    server = None
+                    # 5xx replies (bad recipient, auth rejected) will not fix themselves.
+                    permanent = isinstance(e, smtplib.SMTPResponseException) and e.smtp_code >= 500
+                    if permanent or attempt == self.max_retries:
+                        self._count("failed")
+                        print("[ERROR] Failed to send email:", msg.get("Subject"), e)
+                        break
+                    self._count("retries")
+                    time.sleep(self.backoff * (2 ** attempt))
+                except Exception as e:
+                    # Not a delivery problem (e.g. a payload smtplib cannot
+                    # encode): retrying will not help, and it must not take
+                    # the worker down with it.
+                    self._timing(attempt_start)
+                    self.last_error = f"{type(e).__name__}: {e}"
+                    self._close(server)
+                    server = None
+                    self._count("failed")
+                    print("[ERROR] Failed to send email:", msg.get("Subject"), e)
+                    break
+            self._queue.task_done()
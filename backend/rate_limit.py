@@ -0,0 +1,227 @@
+"""Rate limiting and alert roll-up for authentication attempts.
+
+``AuthLimiter`` keeps a token bucket per client IP and per (IP, method),
+and locks a key out after repeated failures, doubling the lockout on every
+further strike. ``AlertRollup`` bounds the side effects of failures: per
+client IP, the first failure in a window sends one alert with one snapshot,
+everything after it is folded into a single digest sent when the window
+closes, by whichever worker notices first.
+
+Both keep their state in a ``state_backend.Namespace`` and update it with
+compare-and-set, so limits hold across gunicorn workers.
+"""
+import threading
+import time
+from collections import Counter
+
+
+def _update(store, key, fn, ttl, attempts=5):
+    """Optimistically apply fn(old) -> new to one record; returns new, or None if it never committed."""
+    for _ in range(attempts):
+        old = store.get(key)
+        new = fn(old)
+        if store.cas(key, old, new, ttl=ttl):
+            return new
+    # Heavy contention on one key: callers fail closed rather than act on
+    # a state nobody stored.
+    return None
+
+
+class AuthLimiter:
+    def __init__(self, store, ip_rate=1.0, ip_burst=20, method_rate=0.2, method_burst=5,
+                 max_failures=5, lockout=30.0, lockout_max=3600.0):
+        """Rates are tokens per second; a key locks after max_failures failures in a row."""
+        self.store = store
+        self.limits = {"ip": (ip_rate, ip_burst), "method": (method_rate, method_burst)}
+        self.max_failures = max_failures
+        self.lockout = lockout
+        self.lockout_max = lockout_max
+        # Long enough that a record outlives its lockout and a full refill.
+        self.ttl = lockout_max + max(burst / rate for rate, burst in self.limits.values())
+        self.counters = Counter()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _keys(client, method):
+        return (("ip", f"ip:{client}"), ("method", f"m:{client}|{method}"))
+
+    def _refill(self, old, scope, now):
+        rate, burst = self.limits[scope]
+        state = dict(old or {"tokens": burst, "ts": now, "fails": 0, "strikes": 0, "locked_until": 0})
+        state["tokens"] = min(burst, state["tokens"] + max(0.0, now - state["ts"]) * rate)
+        state["ts"] = now
+        return state
+
+    def _count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    def check(self, client, method):
+        """Take a token from each of the client's buckets; returns (allowed, retry_after_seconds)."""
+        now = time.time()
+        locked = [s["locked_until"] - now for s in (self.store.get(k) for _, k in self._keys(client, method))
+                  if s and s.get("locked_until", 0) > now]
+        if locked:
+            self._count("locked")
+            return False, max(locked)
+        retry_after = 0.0
+        for scope, key in self._keys(client, method):
+            rate = self.limits[scope][0]
+            result = {}
+
+            def take(old, scope=scope, result=result):
+                state = self._refill(old, scope, now)
+                result["ok"] = state["tokens"] >= 1
+                if result["ok"]:
+                    state["tokens"] -= 1
+                return state
+
+            state = _update(self.store, key, take, self.ttl)
+            if state is None:
+                # Lost every race for this key: it is being hammered, so throttle.
+                self._count("contended")
+                retry_after = max(retry_after, 1.0 / rate)
+            elif not result["ok"]:
+                retry_after = max(retry_after, (1 - state["tokens"]) / rate)
+        if retry_after:
+            self._count("throttled")
+            return False, retry_after
+        return True, 0.0
+
+    def record(self, client, method, ok):
+        """Count a failure towards lockout, or clear the failure streak on success."""
+        now = time.time()
+        lockouts = []
+        for scope, key in self._keys(client, method):
+            def apply(old, scope=scope):
+                state = self._refill(old, scope, now)
+                if ok:
+                    state["fails"], state["strikes"] = 0, 0
+                    return state
+                state["fails"] += 1
+                if state["fails"] >= self.max_failures:
+                    state["strikes"] += 1
+                    state["fails"] = 0
+                    state["locked_until"] = now + min(self.lockout_max, self.lockout * 2 ** (state["strikes"] - 1))
+                return state
+
+            state = _update(self.store, key, apply, self.ttl)
+            if state is None:
+                self._count("contended")
+                continue
+            if state["locked_until"] > now:
+                lockouts.append(state["locked_until"] - now)
+        if not ok and lockouts:
+            self._count("lockouts")
+        return max(lockouts, default=0.0)
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters)
+
+
+class AlertRollup:
+    def __init__(self, store, send_first, send_digest, window=300.0, recent=20, sweep_interval=30.0):
+        """send_first(event, snapshot) alerts right away (snapshot is what snapshot() returned); send_digest(digest) at window end."""
+        self.store = store
+        self.send_first = send_first
+        self.send_digest = send_digest
+        self.window = window
+        self.recent = recent
+        self.sweep_interval = min(sweep_interval, window)
+        # Records outlive their window so whichever worker sweeps next can
+        # still flush them.
+        self.ttl = 2 * window + 60
+        self.counters = Counter()
+        self._lock = threading.Lock()
+        self._sweeper = None
+
+    def _count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    def start(self):
+        """Flush due digests periodically from this process too (every worker runs one)."""
+        with self._lock:
+            if self._sweeper is not None and self._sweeper.is_alive():
+                return
+            self._sweeper = threading.Thread(target=self._sweep_loop, name="alert-rollup", daemon=True)
+            self._sweeper.start()
+
+    def _sweep_loop(self):
+        while True:
+            time.sleep(self.sweep_interval)
+            try:
+                self.flush_due()
+            except Exception as e:
+                print("[WARN] Alert digest flush failed:", e)
+
+    def report(self, reason, client, method, snapshot=None):
+        """Record one failed attempt. snapshot() is only called for the first alert of the client's window."""
+        now = time.time()
+        self.flush_due(now)
+        event = {"ts": now, "ip": client, "method": method, "reason": reason}
+        opened = {"new": False}
+
+        def add(old):
+            opened["new"] = old is None
+            digest = dict(old or {"ip": client, "opened": now, "count": 0, "by_method": {}, "by_reason": {},
+                                  "recent": []})
+            if opened["new"]:
+                return digest  # the opening attempt is alerted on its own
+            digest["count"] += 1
+            digest["by_method"] = {**digest["by_method"], method: digest["by_method"].get(method, 0) + 1}
+            digest["by_reason"] = {**digest["by_reason"], reason: digest["by_reason"].get(reason, 0) + 1}
+            digest["recent"] = (digest["recent"] + [event])[-self.recent:]
+            return digest
+
+        # One window per client IP, so a second intruder gets an alert (and
+        # a snapshot) of their own instead of a line in someone's digest.
+        if _update(self.store, f"w:{client}", add, self.ttl) is None:
+            # Other attempts from this client are landing right now; one of
+            # them opened (or is counting into) the window.
+            self._count("contended")
+            return False
+        if not opened["new"]:
+            self._count("rolled_up")
+            return False
+        # Open windows are listed under one key so any worker can find the
+        # ones that are due.
+        if _update(self.store, "open", lambda old: {**(old or {}), client: now}, self.ttl) is None:
+            self._count("contended")
+            print("[WARN] Could not list alert window for", client, "- its digest may be lost")
+        self._count("alerts")
+        path = None
+        if snapshot is not None:
+            try:
+                path = snapshot()
+            except Exception as e:
+                print("[WARN] Alert snapshot failed:", e)
+        self.send_first(event, path)
+        return True
+
+    def flush_due(self, now=None):
+        """Send the digest of every window that has closed; safe to call from any worker."""
+        now = now or time.time()
+        windows = self.store.get("open") or {}
+        sent = 0
+        for client, opened in windows.items():
+            if now - opened < self.window:
+                continue
+            # consume() hands the record to exactly one worker.
+            digest = self.store.consume(f"w:{client}")
+            _update(self.store, "open",
+                    lambda old: {k: v for k, v in (old or {}).items() if (k, v) != (client, opened)}, self.ttl)
+            if digest and digest["count"]:
+                self._count("digests")
+                self.send_digest(digest)
+                sent += 1
+        return sent
+
+    def stats(self):
+        with self._lock:
+            out = dict(self.counters)
+        windows = self.store.get("open") or {}
+        out["windows_open"] = len(windows)
+        out["pending"] = sum((self.store.get(f"w:{client}") or {}).get("count", 0) for client in windows)
+        return out
@@ -0,0 +1,296 @@
+"""Pluggable storage for auth state (sessions, OTPs, QR approvals).
+
+Every backend exposes the same namespaced, expiring key/value interface with
+atomic ``consume`` (check-and-delete) and ``cas`` (compare-and-set), so the
+same handler code works in one process or across several gunicorn workers:
+
+* ``memory`` - per-process TTLStores; only correct with a single worker.
+* ``sqlite`` - one SQLite file in WAL mode shared by all local workers.
+* ``redis`` - any Redis-compatible server (needs the ``redis`` package).
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from ttl_store import TTLStore
+
+
+def _dump(value):
+    return json.dumps(value, sort_keys=True, separators=(",", ":"))
+
+
+class MemoryBackend:
+    name = "memory"
+
+    def __init__(self, max_per_ns=10000):
+        self.max_per_ns = max_per_ns
+        self._stores = {}
+        self._lock = threading.Lock()
+
+    def _store(self, ns):
+        store = self._stores.get(ns)
+        if store is None:
+            with self._lock:
+                store = self._stores.setdefault(ns, TTLStore(3600, max_size=self.max_per_ns))
+        return store
+
+    def set(self, ns, key, value, ttl):
+        self._store(ns).set(key, _dump(value), ttl=ttl)
+
+    def get(self, ns, key):
+        raw = self._store(ns).get(key)
+        return None if raw is None else json.loads(raw)
+
+    def consume(self, ns, key, expected=None):
+        store = self._store(ns)
+        with self._lock:
+            raw = store.get(key)
+            if raw is None or (expected is not None and raw != _dump(expected)):
+                return None
+            store.pop(key)
+        return json.loads(raw)
+
+    def cas(self, ns, key, expected, new, ttl=None):
+        store = self._store(ns)
+        with self._lock:
+            raw = store.get(key)
+            if expected is None:
+                if raw is not None:
+                    return False
+                store.set(key, _dump(new), ttl=ttl)
+                return True
+            if raw is None or raw != _dump(expected):
+                return False
+            store.set(key, _dump(new), ttl=store.expires_at(key) - time.time() if ttl is None else ttl)
+            return True
+
+    def stats(self, ns):
+        return self._store(ns).stats()
+
+
+class SQLiteBackend:
+    name = "sqlite"
+
+    def __init__(self, path, max_per_ns=10000, sweep_interval=30.0):
+        self.path = path
+        self.max_per_ns = max_per_ns
+        self.sweep_interval = sweep_interval
+        self._local = threading.local()
+        self._last_sweep = 0.0
+        self.expired_total = 0
+        self.evicted_total = 0
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS kv ("
+            " ns TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, expires_at REAL NOT NULL,"
+            " PRIMARY KEY (ns, key))")
+        conn.execute("CREATE INDEX IF NOT EXISTS kv_expiry ON kv (ns, expires_at)")
+
+    def _conn(self):
+        # sqlite3 connections must not be shared between threads.
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=5000")
+            self._local.conn = conn
+        return conn
+
+    def _maybe_sweep(self, conn, ns):
+        now = time.time()
+        if now - self._last_sweep < self.sweep_interval:
+            return
+        self._last_sweep = now
+        cur = conn.execute("DELETE FROM kv WHERE expires_at <= ?", (now,))
+        self.expired_total += cur.rowcount
+
+    def _enforce_cap(self, conn, ns, key, now):
+        # Inside the writer's transaction, like TTLStore.set: expired rows
+        # go first, then the ones closest to expiry, never the one just written.
+        (count,) = conn.execute("SELECT COUNT(*) FROM kv WHERE ns = ?", (ns,)).fetchone()
+        if count <= self.max_per_ns:
+            return
+        cur = conn.execute("DELETE FROM kv WHERE ns = ? AND expires_at <= ?", (ns, now))
+        self.expired_total += cur.rowcount
+        count -= cur.rowcount
+        if count > self.max_per_ns:
+            cur = conn.execute(
+                "DELETE FROM kv WHERE rowid IN"
+                " (SELECT rowid FROM kv WHERE ns = ? AND key != ? ORDER BY expires_at LIMIT ?)",
+                (ns, key, count - self.max_per_ns))
+            self.evicted_total += cur.rowcount
+
+    def set(self, ns, key, value, ttl):
+        conn = self._conn()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("INSERT OR REPLACE INTO kv (ns, key, value, expires_at) VALUES (?, ?, ?, ?)",
+                         (ns, key, _dump(value), now + ttl))
+            self._enforce_cap(conn, ns, key, now)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        self._maybe_sweep(conn, ns)
+
+    def get(self, ns, key):
+        row = self._conn().execute(
+            "SELECT value FROM kv WHERE ns = ? AND key = ? AND expires_at > ?",
+            (ns, key, time.time())).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def consume(self, ns, key, expected=None):
+        conn = self._conn()
+        # BEGIN IMMEDIATE takes the write lock up front, so two workers can
+        # never both read the same value before one of them deletes it.
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT value FROM kv WHERE ns = ? AND key = ? AND expires_at > ?",
+                (ns, key, time.time())).fetchone()
+            if row is None or (expected is not None and row[0] != _dump(expected)):
+                conn.execute("COMMIT")
+                return None
+            conn.execute("DELETE FROM kv WHERE ns = ? AND key = ?", (ns, key))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return json.loads(row[0])
+
+    def cas(self, ns, key, expected, new, ttl=None):
+        conn = self._conn()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if expected is None:
+                conn.execute("DELETE FROM kv WHERE ns = ? AND key = ? AND expires_at <= ?", (ns, key, now))
+                cur = conn.execute("INSERT OR IGNORE INTO kv (ns, key, value, expires_at) VALUES (?, ?, ?, ?)",
+                                   (ns, key, _dump(new), now + ttl))
+                if cur.rowcount == 1:
+                    self._enforce_cap(conn, ns, key, now)
+            else:
+                cur = conn.execute(
+                    "UPDATE kv SET value = ?, expires_at = CASE WHEN ? IS NULL THEN expires_at ELSE ? END"
+                    " WHERE ns = ? AND key = ? AND value = ? AND expires_at > ?",
+                    (_dump(new), ttl, None if ttl is None else now + ttl, ns, key, _dump(expected), now))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return cur.rowcount == 1
+
+    def stats(self, ns):
+        now = time.time()
+        conn = self._conn()
+        (live,) = conn.execute("SELECT COUNT(*) FROM kv WHERE ns = ? AND expires_at > ?", (ns, now)).fetchone()
+        (pending,) = conn.execute("SELECT COUNT(*) FROM kv WHERE ns = ? AND expires_at <= ?", (ns, now)).fetchone()
+        return {"live": live, "expired_pending": pending, "expired_total": self.expired_total,
+                "evicted_total": self.evicted_total, "max_size": self.max_per_ns}
+
+
+class RedisBackend:
+    name = "redis"
+
+    _CONSUME = """
+    local v = redis.call('GET', KEYS[1])
+    if not v then return false end
+    if ARGV[1] ~= '' and v ~= ARGV[1] then return false end
+    redis.call('DEL', KEYS[1])
+    return v
+    """
+    _CAS = """
+    local v = redis.call('GET', KEYS[1])
+    if ARGV[1] == '' then
+        if v then return 0 end
+    elseif v ~= ARGV[1] then
+        return 0
+    end
+    if ARGV[3] == '' then
+        redis.call('SET', KEYS[1], ARGV[2], 'KEEPTTL')
+    else
+        redis.call('SET', KEYS[1], ARGV[2], 'PX', ARGV[3])
+    end
+    return 1
+    """
+
+    def __init__(self, url, prefix="smartlock:"):
+        import redis  # optional dependency, only needed for this backend
+
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+        self._consume = self.client.register_script(self._CONSUME)
+        self._cas = self.client.register_script(self._CAS)
+
+    def _key(self, ns, key):
+        return f"{self.prefix}{ns}:{key}"
+
+    def set(self, ns, key, value, ttl):
+        self.client.set(self._key(ns, key), _dump(value), px=max(1, int(ttl * 1000)))
+
+    def get(self, ns, key):
+        raw = self.client.get(self._key(ns, key))
+        return None if raw is None else json.loads(raw)
+
+    def consume(self, ns, key, expected=None):
+        raw = self._consume(keys=[self._key(ns, key)], args=["" if expected is None else _dump(expected)])
+        return None if raw is None else json.loads(raw)
+
+    def cas(self, ns, key, expected, new, ttl=None):
+        args = ["" if expected is None else _dump(expected), _dump(new),
+                "" if ttl is None else str(max(1, int(ttl * 1000)))]
+        return bool(self._cas(keys=[self._key(ns, key)], args=args))
+
+    def stats(self, ns):
+        # Redis expires keys itself; SCAN is O(keys) but stats are not a hot path.
+        live = sum(1 for _ in self.client.scan_iter(match=f"{self.prefix}{ns}:*", count=500))
+        return {"live": live}
+
+
+def make_backend(kind, sqlite_path="state.db", redis_url=None, max_per_ns=10000):
+    kind = (kind or "memory").lower()
+    if kind == "memory":
+        return MemoryBackend(max_per_ns=max_per_ns)
+    if kind == "sqlite":
+        os.makedirs(os.path.dirname(os.path.abspath(sqlite_path)), exist_ok=True)
+        return SQLiteBackend(sqlite_path, max_per_ns=max_per_ns)
+    if kind == "redis":
+        if not redis_url:
+            raise ValueError("STATE_REDIS_URL is required for the redis state backend")
+        return RedisBackend(redis_url)
+    raise ValueError(f"unknown state backend: {kind}")
+
+
+class Namespace:
+    """A backend bound to one namespace and default TTL, used like a token store."""
+
+    def __init__(self, backend, ns, ttl):
+        self.backend = backend
+        self.ns = ns
+        self.ttl = ttl
+
+    def set(self, key, value=True, ttl=None):
+        self.backend.set(self.ns, key, value, self.ttl if ttl is None else ttl)
+
+    def get(self, key):
+        return self.backend.get(self.ns, key)
+
+    def consume(self, key, expected=None):
+        return self.backend.consume(self.ns, key, expected)
+
+    def cas(self, key, expected, new, ttl=None):
+        """Replace expected with new; expected=None inserts only if the key is absent.
+
+        The entry keeps its expiry unless ttl is given (inserts always use
+        ttl, defaulting to the namespace's).
+        """
+        if expected is None and ttl is None:
+            ttl = self.ttl
+        return self.backend.cas(self.ns, key, expected, new, ttl)
+
+    def stats(self):
+        return self.backend.stats(self.ns)
@@ -0,0 +1,64 @@
+"""Cached, coalesced device status.
+
+Every dashboard polls /status; without this each poll became a request to the
+ESP. StatusCache serves a result for ``max_age`` seconds and makes concurrent
+callers that find it stale wait for a single in-flight fetch (single-flight)
+instead of each starting their own.
+"""
+import threading
+import time
+
+
+class StatusCache:
+    def __init__(self, fetch, max_age=1.0):
+        self.fetch = fetch
+        self.max_age = max_age
+        self.value = None
+        self.error = None
+        self.fetched_at = 0.0
+        self.version = 0  # bumps whenever the value (or error) changes
+        self.upstream_fetches = 0
+        self.hits = 0
+        self._inflight = False
+        self._cond = threading.Condition()
+
+    def _fresh(self, now):
+        return self.fetched_at and now - self.fetched_at < self.max_age
+
+    def get(self):
+        """Return (value, error, age_seconds); at most one fetch per max_age window."""
+        with self._cond:
+            while True:
+                now = time.time()
+                if self._fresh(now):
+                    self.hits += 1
+                    return self.value, self.error, now - self.fetched_at
+                if not self._inflight:
+                    self._inflight = True
+                    break
+                # Someone else is already asking the device; share their answer.
+                self._cond.wait(timeout=self.max_age + 10)
+        value, error = None, None
+        try:
+            value = self.fetch()
+        except Exception as e:
+            error = str(e)
+        with self._cond:
+            if value != self.value or error != self.error:
+                self.version += 1
+            self.value, self.error = value, error
+            self.fetched_at = time.time()
+            self.upstream_fetches += 1
+            self._inflight = False
+            self._cond.notify_all()
+            return value, error, 0.0
+
+    def invalidate(self):
+        # After /control changes the lock, the next read should see it.
+        with self._cond:
+            self.fetched_at = 0.0
+
+    def stats(self):
+        with self._cond:
+            return {"max_age": self.max_age, "upstream_fetches": self.upstream_fetches,
+                    "hits": self.hits, "version": self.version}
@@ -0,0 +1,83 @@
+import time
+
+import cv2
+import numpy as np
+import pytest
+
+from camera import CaptureService, FrameRing
+
+
+@pytest.fixture
+def video(tmp_path):
+    path = str(tmp_path / "door.avi")
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"MJPG"), 30, (64, 48))
+    if not writer.isOpened():
+        pytest.skip("no MJPG writer in this OpenCV build")
+    for i in range(20):
+        frame = np.full((48, 64, 3), i * 10, np.uint8)
+        writer.write(frame)
+    writer.release()
+    return path
+
+
+def test_serves_frames_from_a_video_file(video):
+    cam = CaptureService(video, buffer_size=4, warmup_frames=2)
+    try:
+        frame = cam.latest(wait=5.0)
+        assert frame is not None and frame.shape == (48, 64, 3)
+        seen = list(cam.frames(0.3))
+        assert len(seen) >= 2
+        time.sleep(0.2)
+        clip = cam.clip(3)
+        assert len(clip) == 3
+        assert [ts for ts, _ in clip] == sorted(ts for ts, _ in clip)
+        assert cam.opened and cam.role == "owner"
+    finally:
+        cam.stop()
+
+
+def test_latest_does_not_block_without_wait(tmp_path):
+    cam = CaptureService(str(tmp_path / "missing.avi"), reopen_delay=0.05)
+    try:
+        start = time.time()
+        assert cam.latest(wait=0) is None
+        assert time.time() - start < 0.1
+    finally:
+        cam.stop()
+
+
+def test_only_the_lock_holder_opens_the_device(video, tmp_path):
+    lock = str(tmp_path / "camera.lock")
+    owner = CaptureService(video, lock_path=lock, reopen_delay=0.1)
+    follower = CaptureService(video, lock_path=lock, reopen_delay=0.1)
+    try:
+        assert owner.latest(wait=5.0) is not None
+        frame = follower.latest(wait=5.0)
+        assert frame is not None and frame.shape == (48, 64, 3)
+        assert (owner.role, follower.role) == ("owner", "follower")
+        assert not follower.opened
+
+        owner.stop()  # releases the lock; the follower takes the camera over
+        deadline = time.time() + 5.0
+        while follower.role != "owner" and time.time() < deadline:
+            time.sleep(0.05)
+        assert follower.role == "owner"
+        assert follower.latest(wait=5.0, max_age=1.0) is not None
+    finally:
+        owner.stop()
+        follower.stop()
+
+
+def test_ring_drops_torn_and_overwritten_slots(tmp_path):
+    path = str(tmp_path / "frames.ring")
+    ring = FrameRing.create(path, 3, (2, 2, 3))
+    reader = FrameRing.attach(path)
+    for i in range(5):
+        ring.write(float(i), np.full((2, 2, 3), i, np.uint8))
+    got = reader.read_since(-1)
+    assert [seq for seq, _, _ in got] == [2, 3, 4]
+    assert [int(f[0, 0, 0]) for _, _, f in got] == [2, 3, 4]
+    assert reader.read_since(4) == []
+
+    FrameRing.create(path, 3, (4, 4, 3))
+    assert reader.replaced()
@@ -0,0 +1,149 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+from device_client import CircuitBreaker, DeviceClient, DeviceUnavailable
+
+
+class FakeDevice(ThreadingHTTPServer):
+    """Local stand-in for the ESP controller; `mode` switches how it misbehaves."""
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), FakeDeviceHandler)
+        self.mode = "ok"  # ok | slow | error | forbidden
+        self.delay = 0.5
+        self.requests = 0
+        self.connections = set()
+        self.url = f"http://127.0.0.1:{self.server_address[1]}"
+
+
+class FakeDeviceHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive
+
+    def log_message(self, fmt, *args):
+        pass
+
+    def _reply(self, code, body):
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _handle(self):
+        srv = self.server
+        srv.requests += 1
+        srv.connections.add(self.client_address)
+        if srv.mode == "slow":
+            time.sleep(srv.delay)
+        if srv.mode == "error":
+            return self._reply(500, {"ok": False})
+        if srv.mode == "forbidden":
+            return self._reply(403, {"ok": False, "error": "bad key"})
+        self._reply(200, {"ok": True, "state": "locked"})
+
+    def do_GET(self):
+        self._handle()
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self._handle()
+
+
+@pytest.fixture
+def device():
+    srv = FakeDevice()
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    yield srv
+    srv.shutdown()
+    srv.server_close()
+
+
+def test_keeps_one_connection_alive_and_records_latency(device):
+    client = DeviceClient(device.url)
+    for _ in range(3):
+        assert client.get("/status").json()["ok"]
+    client.post("/control", json={"action": "unlock"})
+    assert len(device.connections) == 1
+    stats = client.stats()
+    assert stats["breaker"] == "closed"
+    assert stats["endpoints"]["/status"]["count"] == 3
+    assert stats["endpoints"]["/control"]["errors"] == 0
+
+
+def test_read_timeout_is_not_retried(device):
+    device.mode = "slow"
+    client = DeviceClient(device.url, read_timeout=0.1)
+    start = time.perf_counter()
+    with pytest.raises(requests.exceptions.Timeout):
+        client.post("/control", json={"action": "unlock"})
+    assert time.perf_counter() - start < device.delay
+    time.sleep(device.delay)
+    # One attempt only: an unlock must never be replayed behind the caller's back.
+    assert device.requests == 1
+    assert client.stats()["endpoints"]["/control"]["errors"] == 1
+    assert client.breaker.failures == 1
+
+
+def test_breaker_opens_fails_fast_then_half_opens(device):
+    device.mode = "error"
+    client = DeviceClient(device.url, failure_threshold=2, reset_timeout=0.2)
+    for _ in range(2):
+        with pytest.raises(requests.exceptions.HTTPError):
+            client.get("/status")
+    assert client.breaker.state == CircuitBreaker.OPEN
+
+    seen = device.requests
+    with pytest.raises(DeviceUnavailable):
+        client.get("/status")
+    assert device.requests == seen  # failed fast, device untouched
+
+    time.sleep(0.25)
+    device.mode = "ok"
+    assert client.get("/status").json()["ok"]  # the half-open probe
+    assert client.breaker.state == CircuitBreaker.CLOSED
+    assert client.breaker.failures == 0
+
+
+def test_failed_probe_reopens_the_breaker(device):
+    device.mode = "error"
+    client = DeviceClient(device.url, failure_threshold=1, reset_timeout=0.1)
+    with pytest.raises(requests.exceptions.HTTPError):
+        client.get("/status")
+    time.sleep(0.15)
+    with pytest.raises(requests.exceptions.HTTPError):
+        client.get("/status")  # probe goes out and fails
+    assert client.breaker.state == CircuitBreaker.OPEN
+    with pytest.raises(DeviceUnavailable):
+        client.get("/status")
+
+
+def test_half_open_lets_exactly_one_probe_through():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.0)
+    breaker.record_failure()
+    assert breaker.allow()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert not breaker.allow()  # second caller while the probe is in flight
+    breaker.record_success()
+    assert breaker.allow() and breaker.state == CircuitBreaker.CLOSED
+
+
+def test_unreachable_device_counts_as_failure():
+    client = DeviceClient("http://127.0.0.1:9", connect_timeout=0.2, failure_threshold=1)
+    with pytest.raises(requests.exceptions.ConnectionError):
+        client.get("/status")
+    assert client.breaker.state == CircuitBreaker.OPEN
+
+
+def test_client_error_proves_the_device_is_up(device):
+    device.mode = "forbidden"
+    client = DeviceClient(device.url, failure_threshold=1)
+    with pytest.raises(requests.exceptions.HTTPError):
+        client.get("/status")
+    assert client.breaker.state == CircuitBreaker.CLOSED
@@ -0,0 +1,55 @@
+import numpy as np
+
+from embedding_store import EmbeddingStore
+
+
+def vectors(n, value, dim=4):
+    return np.full((n, dim), value, dtype=np.float32)
+
+
+def test_refresh_picks_up_another_writers_puts_and_deletes(tmp_path):
+    prefix = str(tmp_path / "embeddings")
+    writer, reader = EmbeddingStore(prefix), EmbeddingStore(prefix)
+    writer.put("alice", vectors(2, 1.0))
+    assert set(reader.load()) == {"alice"}
+
+    writer.put("bob", vectors(3, 2.0))
+    writer.delete("alice")
+    changed = reader.refresh()
+    assert changed["alice"] is None
+    np.testing.assert_array_equal(changed["bob"], vectors(3, 2.0))
+    assert reader.refresh() == {}
+
+
+def test_refresh_after_compaction_asks_for_a_full_load(tmp_path):
+    prefix = str(tmp_path / "embeddings")
+    writer = EmbeddingStore(prefix, compact_ratio=0.3, compact_min_rows=4)
+    reader = EmbeddingStore(prefix)
+    writer.put("alice", vectors(4, 1.0))
+    writer.put("bob", vectors(1, 2.0))
+    reader.load()
+    data_name = writer.data_name
+
+    writer.put("alice", vectors(4, 3.0))  # old rows are dead: over the ratio, compacts
+    assert writer.data_name != data_name
+
+    assert reader.refresh() is None
+    loaded = reader.load()
+    np.testing.assert_array_equal(loaded["alice"], vectors(4, 3.0))
+    np.testing.assert_array_equal(loaded["bob"], vectors(1, 2.0))
+    assert reader.refresh() == {}
+
+    # And incremental refresh works again on the new journal.
+    writer.put("carol", vectors(1, 5.0))
+    assert set(reader.refresh()) == {"carol"}
+
+
+def test_rows_without_a_journal_line_are_ignored(tmp_path):
+    prefix = str(tmp_path / "embeddings")
+    store = EmbeddingStore(prefix)
+    store.put("alice", vectors(2, 1.0))
+    with open(store.data_path, "ab") as f:
+        f.write(vectors(5, 9.0).tobytes())  # a writer crashed before committing
+    store.put("bob", vectors(1, 2.0))
+    loaded = EmbeddingStore(prefix).load()
+    np.testing.assert_array_equal(loaded["bob"], vectors(1, 2.0))
@@ -0,0 +1,55 @@
+import json
+import os
+import time
+
+from event_log import EventLog
+
+
+def write_segment(directory, start, pid, events):
+    path = os.path.join(directory, f"{int(start * 1000)}-{pid}.jsonl")
+    with open(path, "w") as f:
+        for event in events:
+            f.write(json.dumps(event) + "\n")
+    return path
+
+
+def test_query_across_sealed_and_live_segments(tmp_path):
+    # Tiny segments so every batch rotates into a new, sealed one.
+    log = EventLog(str(tmp_path), segment_bytes=200)
+    for i in range(30):
+        log._write_batch([{"ts": 1000.0 + i, "type": "auth" if i % 2 else "control", "n": i}])
+    other = EventLog(str(tmp_path))  # another worker, reading only
+    assert sum(n.endswith(".idx") for n in os.listdir(tmp_path)) > 2
+
+    newest = other.query(types=["auth"], limit=3)
+    assert [e["n"] for e in newest] == [29, 27, 25]
+    oldest = other.query(since=1010, until=1015, limit=100, newest_first=False)
+    assert [e["n"] for e in oldest] == list(range(10, 16))
+    assert [e["n"] for e in other.query(n=7)] == [7]
+    log.stop()
+
+
+def test_merges_segments_of_different_workers(tmp_path):
+    write_segment(str(tmp_path), 100, 1, [{"ts": 100 + 2 * i, "type": "auth", "w": 1} for i in range(5)])
+    write_segment(str(tmp_path), 101, 2, [{"ts": 101 + 2 * i, "type": "auth", "w": 2} for i in range(5)])
+    events = EventLog(str(tmp_path)).query(limit=100, newest_first=False)
+    assert [e["ts"] for e in events] == list(range(100, 110))
+
+
+def test_unordered_timestamps_inside_a_segment_are_not_missed(tmp_path):
+    ts = [100.0, 102.0, 101.0, 103.0]  # stamped on request threads, written later
+    write_segment(str(tmp_path), 100, 1, [{"ts": t, "type": "auth"} for t in ts])
+    events = EventLog(str(tmp_path)).query(since=100.5, until=101.5)
+    assert [e["ts"] for e in events] == [101.0]
+
+
+def test_retention_expires_segments_of_dead_workers(tmp_path):
+    old = time.time() - 10 * 86400
+    dead_pid = 2 ** 22 + 12345  # above the default pid_max: never a live process
+    stale = write_segment(str(tmp_path), old, dead_pid, [{"ts": old, "type": "auth"}])
+    log = EventLog(str(tmp_path), retention_days=1)
+    log.record("auth", ok=True)
+    log.stop()
+    assert not os.path.exists(stale)
+    assert log.stats()["segments_expired"] == 1
+    assert [e["type"] for e in log.query()] == ["auth"]
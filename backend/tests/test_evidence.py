@@ -0,0 +1,64 @@
+import os
+import time
+
+import cv2
+import numpy as np
+
+from evidence import EvidenceStore, dhash
+
+
+def frame(seed):
+    return np.random.default_rng(seed).integers(0, 255, (48, 64, 3), dtype=np.uint8)
+
+
+def wait_for(predicate, timeout=5.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.02)
+    return False
+
+
+def test_incident_is_written_and_indexed(tmp_path):
+    store = EvidenceStore(str(tmp_path), sweep_interval=3600)
+    saved = store.save_incident([frame(1), frame(2)], "intruder", ip="10.0.0.5")
+    assert saved and len(saved["images"]) == 2
+    thumb = store.thumbnail(saved)
+    assert thumb and os.path.exists(thumb)
+    assert wait_for(lambda: store.incident(saved["id"]) is not None)
+    store.stop()
+    assert [r["id"] for r in store.find(ip="10.0.0.5")] == [saved["id"]]
+    assert store.stats()["written"] == 2
+
+
+def test_full_queue_drops_the_whole_incident(tmp_path):
+    store = EvidenceStore(str(tmp_path), sweep_interval=3600)
+    store._start = lambda: None  # no writer: the queue only fills
+    store._queue.maxsize = 1
+    assert store.save_incident([frame(1)], "intruder")
+    dropped = store.save_incident([frame(2), frame(3)], "intruder")
+    assert dropped is None
+    assert store.stats()["dropped"] == 1
+    # Nothing waits on files that will never be written (only the queued
+    # image and its thumbnail are pending)...
+    assert len(store._pending) == 2
+    # ...and a later identical frame is stored, not deduplicated against it.
+    assert store._near_duplicate(dhash(frame(2)), time.time()) is None
+
+
+def test_legacy_snapshots_are_indexed_once_and_pruned(tmp_path):
+    old = time.time() - 10 * 86400
+    for name in ("intruder_1700000000.jpg", "face_fail_1700000001.jpg"):
+        path = str(tmp_path / name)
+        cv2.imwrite(path, frame(len(name)))
+        os.utime(path, (old, old))
+
+    store = EvidenceStore(str(tmp_path), retention_days=5, sweep_interval=3600)
+    kinds = sorted(r["kind"] for r in store.find())
+    assert kinds == ["face_fail", "intruder"]
+    assert EvidenceStore(str(tmp_path)).stats()["images"] == 2  # not indexed twice
+
+    assert store.sweep() == 2
+    assert not any(n.endswith(".jpg") for n in os.listdir(tmp_path))
+    assert os.path.isdir(tmp_path)
@@ -0,0 +1,61 @@
+import os
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from inference_server import InferenceError, InferenceServer, RemoteFaceEngine, read_server_info, server_config
+
+
+class StubEngine:
+    ready = True
+    load_seconds = 0.0
+    path_counts = {}
+
+    def load(self):
+        pass
+
+    def analyze_batch(self, frames, enforce_detection=True, fast=None):
+        return [(np.full(4, f.mean(), np.float32), {"faces": 1}) for f in frames]
+
+    def embed_face(self, crop, path="stream"):
+        return np.zeros(4, np.float32)
+
+
+@pytest.fixture
+def served(tmp_path):
+    path = str(tmp_path / "inference.sock")
+    config = server_config("Facenet", "opencv", batching=False)
+    server = InferenceServer(path, StubEngine(), batching=False, config=config)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    deadline = time.time() + 5
+    while not os.path.exists(path) and time.time() < deadline:
+        time.sleep(0.01)
+    return path, config
+
+
+def test_round_trip_and_recorded_config(served):
+    path, config = served
+    engine = RemoteFaceEngine(path, spawn=False, config=config)
+    vec, info = engine.analyze(np.full((8, 8, 3), 7, np.uint8))
+    assert vec.tolist() == [7.0] * 4 and info == {"faces": 1}
+    recorded = read_server_info(path)
+    assert recorded == {"pid": os.getpid(), "spawned": False, "config": config}
+
+
+def test_refuses_a_server_with_other_settings(served):
+    path, config = served
+    other = dict(config, batching=True)
+    with pytest.raises(InferenceError, match="different configuration"):
+        RemoteFaceEngine(path, spawn=False, config=other).analyze(np.zeros((8, 8, 3), np.uint8))
+    # A supervised server is never stopped by a worker, even one that may spawn.
+    with pytest.raises(InferenceError, match="different configuration"):
+        RemoteFaceEngine(path, spawn=True, config=other, connect_timeout=1).analyze(np.zeros((8, 8, 3), np.uint8))
+    assert RemoteFaceEngine(path, spawn=False).ready  # no config: anything goes
+
+
+def test_config_tracks_the_server_code():
+    config = server_config("Facenet", "opencv")
+    assert len(config["code"]) == 8
+    assert config == server_config("Facenet", "opencv", "single", True, 8, 5, 4, 80)
@@ -0,0 +1,180 @@
+import socket
+import threading
+import time
+from email.mime.text import MIMEText
+
+import pytest
+
+from mailer import MailDispatcher
+
+
+class FakeSMTPServer:
+    """Just enough SMTP for smtplib with SMTP_SECURITY=none; scripted replies to DATA."""
+
+    def __init__(self, data_replies=()):
+        self.data_replies = list(data_replies)  # e.g. ["451 try later"]; then 250
+        self.messages = []
+        self.connections = 0
+        self._sock = socket.socket()
+        self._sock.bind(("127.0.0.1", 0))
+        self._sock.listen(8)
+        self.port = self._sock.getsockname()[1]
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        while True:
+            try:
+                conn, _ = self._sock.accept()
+            except OSError:
+                return
+            self.connections += 1
+            threading.Thread(target=self._session, args=(conn,), daemon=True).start()
+
+    def _session(self, conn):
+        f = conn.makefile("rb")
+
+        def reply(line):
+            conn.sendall(line.encode() + b"\r\n")
+
+        reply("220 fake ESMTP")
+        try:
+            for raw in f:
+                cmd = raw.decode().strip().upper()
+                if cmd.startswith(("EHLO", "HELO")):
+                    reply("250 fake")
+                elif cmd.startswith(("MAIL", "RCPT", "RSET", "NOOP")):
+                    reply("250 ok")
+                elif cmd == "DATA":
+                    reply("354 go ahead")
+                    lines = []
+                    for line in f:
+                        if line == b".\r\n":
+                            break
+                        lines.append(line)
+                    code = self.data_replies.pop(0) if self.data_replies else "250 queued"
+                    if code.startswith("250"):
+                        self.messages.append(b"".join(lines).decode())
+                    reply(code)
+                elif cmd == "QUIT":
+                    reply("221 bye")
+                    return
+                else:
+                    reply("502 not implemented")
+        finally:
+            conn.close()
+
+    def close(self):
+        self._sock.close()
+
+
+def wait_for(predicate, timeout=5.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.02)
+    return False
+
+
+def message(subject):
+    msg = MIMEText(f"<p>{subject}</p>", "html")
+    msg["Subject"] = subject
+    return msg
+
+
+@pytest.fixture
+def server():
+    srv = FakeSMTPServer()
+    yield srv
+    srv.close()
+
+
+def dispatcher(port, **kw):
+    kw.setdefault("backoff", 0.01)
+    return MailDispatcher("127.0.0.1", port, security="none", **kw)
+
+
+def test_delivers_over_one_reused_connection(server):
+    mail = dispatcher(server.port)
+    for i in range(3):
+        assert mail.submit("lock@example.com", "owner@example.com", message(f"alert {i}"))
+    assert wait_for(lambda: mail.stats()["sent"] == 3)
+    mail.stop()
+    assert server.connections == 1
+    assert "Subject: alert 2" in "".join(server.messages)
+    assert mail.stats()["send_latency_ms"]["max"] >= 0
+
+
+def test_message_is_built_on_the_worker(server):
+    mail = dispatcher(server.port)
+    built = []
+    mail.submit("a@example.com", "b@example.com", lambda: built.append(threading.current_thread().name)
+                or message("lazy"))
+    assert wait_for(lambda: mail.stats()["sent"] == 1)
+    mail.stop()
+    assert built == ["mail-worker-0"]
+
+
+def test_transient_failure_is_retried():
+    srv = FakeSMTPServer(data_replies=["451 try again later"])
+    mail = dispatcher(srv.port, max_retries=2)
+    mail.submit("a@example.com", "b@example.com", message("retry me"))
+    assert wait_for(lambda: mail.stats()["sent"] == 1)
+    mail.stop()
+    srv.close()
+    stats = mail.stats()
+    assert stats["retries"] == 1 and stats["failed"] == 0
+
+
+def test_permanent_failure_is_not_retried():
+    srv = FakeSMTPServer(data_replies=["550 no such user"])
+    mail = dispatcher(srv.port, max_retries=3)
+    mail.submit("a@example.com", "nobody@example.com", message("bounce"))
+    assert wait_for(lambda: mail.stats()["failed"] == 1)
+    mail.stop()
+    srv.close()
+    assert mail.stats()["retries"] == 0
+    assert "550" in mail.stats()["last_error"]
+
+
+def test_unencodable_payload_fails_one_message_not_the_worker(server):
+    class BadMessage:
+        def as_string(self):
+            return "Subject: café\r\n\r\nnon-ASCII headers smtplib refuses to send"
+
+        def get(self, key):
+            return "bad"
+
+    mail = dispatcher(server.port, workers=1)
+    mail.submit("a@example.com", "b@example.com", BadMessage())
+    mail.submit("a@example.com", "b@example.com", message("after the bad one"))
+    assert wait_for(lambda: mail.stats()["sent"] == 1)
+    mail.stop()
+    stats = mail.stats()
+    assert stats["failed"] == 1
+    assert stats["last_error"].startswith("UnicodeEncodeError")
+
+
+def test_unreachable_server_counts_failure():
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()  # nothing listens here
+    mail = dispatcher(port, max_retries=1, timeout=1)
+    mail.submit("a@example.com", "b@example.com", message("nowhere"))
+    assert wait_for(lambda: mail.stats()["failed"] == 1)
+    mail.stop()
+    assert mail.stats()["connects"] == 0
+
+
+def test_full_queue_drops_instead_of_blocking(server):
+    release = threading.Event()
+    mail = dispatcher(server.port, maxsize=1)
+    mail.submit("a@example.com", "b@example.com", lambda: release.wait(5) and message("slow"))
+    assert wait_for(lambda: mail.queue_depth() == 0)  # the worker is stuck building it
+    assert mail.submit("a@example.com", "b@example.com", message("queued"))
+    assert not mail.submit("a@example.com", "b@example.com", message("dropped"))
+    release.set()
+    assert wait_for(lambda: mail.stats()["sent"] == 2)
+    mail.stop()
+    assert mail.stats()["dropped"] == 1
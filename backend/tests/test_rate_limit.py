@@ -0,0 +1,93 @@
+from state_backend import MemoryBackend, Namespace, SQLiteBackend
+from rate_limit import AlertRollup, AuthLimiter
+
+
+def limiter(backend=None, **kw):
+    return AuthLimiter(Namespace(backend or MemoryBackend(), "auth_limit", 3600), **kw)
+
+
+def test_lockout_after_consecutive_failures():
+    lim = limiter(max_failures=3, lockout=30, lockout_max=3600)
+    assert lim.record("1.2.3.4", "pin", False) == 0
+    assert lim.record("1.2.3.4", "pin", False) == 0
+    locked = lim.record("1.2.3.4", "pin", False)
+    assert 29 < locked <= 30
+    allowed, retry_after = lim.check("1.2.3.4", "pin")
+    assert not allowed and retry_after > 29
+    assert lim.check("5.6.7.8", "pin")[0]  # other clients are unaffected
+
+
+def test_lockout_doubles_and_success_resets_the_streak():
+    lim = limiter(max_failures=2, lockout=10, lockout_max=25)
+    for _ in range(2):
+        lim.record("ip", "otp", False)
+    for _ in range(2):
+        second = lim.record("ip", "otp", False)
+    assert 19 < second <= 20
+    for _ in range(2):
+        third = lim.record("ip", "otp", False)
+    assert 24 < third <= 25  # capped at lockout_max
+
+    fresh = limiter(max_failures=3)
+    fresh.record("ip", "pin", False)
+    fresh.record("ip", "pin", False)
+    fresh.record("ip", "pin", True)
+    assert fresh.record("ip", "pin", False) == 0
+
+
+class LosingStore:
+    """Every compare-and-set loses, as if other workers always got there first."""
+
+    def __init__(self):
+        self.inner = Namespace(MemoryBackend(), "auth_limit", 3600)
+
+    def get(self, key):
+        return self.inner.get(key)
+
+    def cas(self, key, expected, new, ttl=None):
+        return False
+
+
+def test_contention_fails_closed():
+    lim = AuthLimiter(LosingStore())
+    allowed, retry_after = lim.check("ip", "pin")
+    assert not allowed and retry_after > 0
+    assert lim.record("ip", "pin", False) == 0
+    assert lim.stats()["contended"] >= 3
+
+    sent = []
+    rollup = AlertRollup(LosingStore(), lambda e, s: sent.append(e), sent.append)
+    assert rollup.report("Wrong PIN", "ip", "pin") is False
+    assert sent == []
+
+
+def test_token_bucket_throttles_bursts(tmp_path):
+    lim = limiter(SQLiteBackend(str(tmp_path / "state.db")), method_rate=0.01, method_burst=3)
+    results = [lim.check("ip", "pin")[0] for _ in range(5)]
+    assert results == [True, True, True, False, False]
+    assert lim.check("ip", "otp")[0]  # per-method bucket
+
+
+def test_alert_rollup_windows_are_per_ip():
+    firsts, digests = [], []
+    rollup = AlertRollup(Namespace(MemoryBackend(), "alerts", 600), lambda e, s: firsts.append((e["ip"], s)),
+                         digests.append, window=60)
+    assert rollup.report("bad pin", "1.1.1.1", "pin", lambda: "snap-1")
+    assert not rollup.report("bad pin", "1.1.1.1", "pin", lambda: "never")
+    assert rollup.report("bad otp", "2.2.2.2", "otp", lambda: "snap-2")
+    assert firsts == [("1.1.1.1", "snap-1"), ("2.2.2.2", "snap-2")]
+
+
+def test_alert_digest_is_flushed_by_any_worker():
+    backend, digests = MemoryBackend(), []
+    opener = AlertRollup(Namespace(backend, "alerts", 600), lambda e, s: None, digests.append, window=60)
+    other = AlertRollup(Namespace(backend, "alerts", 600), lambda e, s: None, digests.append, window=60)
+    opener.report("bad pin", "1.1.1.1", "pin")
+    opener.report("bad pin", "1.1.1.1", "pin")
+    other.report("bad otp", "1.1.1.1", "otp")
+
+    assert other.flush_due() == 0  # window still open
+    opened = backend.get("alerts", "open")["1.1.1.1"]
+    assert other.flush_due(now=opened + 61) == 1
+    assert opener.flush_due(now=opened + 61) == 0  # consumed exactly once
+    assert digests[0]["count"] == 2 and digests[0]["by_method"] == {"pin": 1, "otp": 1}
@@ -0,0 +1,66 @@
+import threading
+
+from state_backend import MemoryBackend, Namespace, SQLiteBackend
+
+
+def test_otp_consume_across_connections_only_one_wins(tmp_path):
+    # Two backends on one file stand in for two gunicorn workers.
+    path = str(tmp_path / "state.db")
+    a, b = SQLiteBackend(path), SQLiteBackend(path)
+    a.set("otp", "current", "123456", 60)
+
+    assert b.consume("otp", "current", expected="000000") is None  # wrong code leaves it in place
+    assert b.consume("otp", "current", expected="123456") == "123456"
+    assert a.consume("otp", "current", expected="123456") is None
+    assert a.get("otp", "current") is None
+
+
+def test_concurrent_consume_hands_out_the_value_once(tmp_path):
+    path = str(tmp_path / "state.db")
+    SQLiteBackend(path).set("otp", "current", "42", 60)
+    backends = [SQLiteBackend(path) for _ in range(8)]
+    results, start = [], threading.Barrier(len(backends))
+
+    def worker(backend):
+        start.wait()
+        results.append(backend.consume("otp", "current", expected="42"))
+
+    threads = [threading.Thread(target=worker, args=(b,)) for b in backends]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert sorted(results, key=str) == ["42"] + [None] * 7
+
+
+def test_cas_across_connections(tmp_path):
+    path = str(tmp_path / "state.db")
+    a, b = SQLiteBackend(path), SQLiteBackend(path)
+    req = {"name": "x", "status": "pending"}
+    assert a.cas("qr", "t", None, req, ttl=60)
+    assert not b.cas("qr", "t", None, req, ttl=60)  # insert-if-absent
+
+    approved, denied = {**req, "status": "approved"}, {**req, "status": "denied"}
+    assert a.cas("qr", "t", req, approved)
+    assert not b.cas("qr", "t", req, denied)  # lost the race: value changed underneath
+    assert b.get("qr", "t") == approved
+
+
+def test_sqlite_cap_is_enforced_on_set(tmp_path):
+    backend = SQLiteBackend(str(tmp_path / "state.db"), max_per_ns=5)
+    for i in range(20):
+        backend.set("s", f"k{i}", i, 60 + i)
+    stats = backend.stats("s")
+    assert stats["live"] == 5
+    assert stats["evicted_total"] == 15
+    assert backend.get("s", "k19") == 19
+    assert backend.get("s", "k0") is None
+
+
+def test_namespaces_are_isolated():
+    backend = MemoryBackend()
+    sessions, otps = Namespace(backend, "sessions", 60), Namespace(backend, "otp", 60)
+    sessions.set("k", "session")
+    otps.set("k", "otp")
+    assert sessions.consume("k") == "session"
+    assert otps.get("k") == "otp"
@@ -0,0 +1,101 @@
+"""Expiring key/value store for tokens.
+
+Entries live in a dict; a min-heap ordered by expiry lets the sweeper drop
+expired entries in O(log n) each without scanning the whole dict. A size cap
+evicts the entries closest to expiry first, so memory stays bounded no
+matter how many tokens are issued.
+"""
+import heapq
+import threading
+import time
+
+
+class TTLStore:
+    def __init__(self, default_ttl, max_size=10000, sweep_batch=64):
+        self.default_ttl = default_ttl
+        self.max_size = max_size
+        self.sweep_batch = sweep_batch
+        self._data = {}  # key -> (expires_at, value)
+        self._heap = []  # (expires_at, key); may hold stale entries for re-set keys
+        self._lock = threading.Lock()
+        self.expired_total = 0
+        self.evicted_total = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def set(self, key, value=True, ttl=None):
+        expires_at = time.time() + (self.default_ttl if ttl is None else ttl)
+        with self._lock:
+            self._sweep_locked(self.sweep_batch)
+            if key not in self._data:
+                while len(self._data) >= self.max_size and self._evict_one_locked():
+                    pass
+            self._data[key] = (expires_at, value)
+            heapq.heappush(self._heap, (expires_at, key))
+            if len(self._heap) > 2 * len(self._data) + 64:
+                self._rebuild_heap_locked()
+        return expires_at
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+            if entry[0] <= time.time():
+                del self._data[key]
+                self.expired_total += 1
+                return default
+            return entry[1]
+
+    def expires_at(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            return None if entry is None else entry[0]
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is None or entry[0] <= time.time():
+                return default
+            return entry[1]
+
+    def sweep(self, limit=None):
+        """Drop expired entries (all of them when limit is None); returns how many."""
+        with self._lock:
+            return self._sweep_locked(limit)
+
+    def _sweep_locked(self, limit):
+        now = time.time()
+        removed = 0
+        while self._heap and self._heap[0][0] <= now and (limit is None or removed < limit):
+            expires_at, key = heapq.heappop(self._heap)
+            entry = self._data.get(key)
+            if entry is not None and entry[0] == expires_at:
+                del self._data[key]
+                self.expired_total += 1
+                removed += 1
+        return removed
+
+    def _evict_one_locked(self):
+        while self._heap:
+            expires_at, key = heapq.heappop(self._heap)
+            entry = self._data.get(key)
+            if entry is not None and entry[0] == expires_at:
+                del self._data[key]
+                self.evicted_total += 1
+                return True
+        return False
+
+    def _rebuild_heap_locked(self):
+        self._heap = [(exp, key) for key, (exp, _) in self._data.items()]
+        heapq.heapify(self._heap)
+
+    def stats(self):
+        with self._lock:
+            self._sweep_locked(None)
+            return {"live": len(self._data), "expired_total": self.expired_total,
+                    "evicted_total": self.evicted_total, "max_size": self.max_size}